@@ -1,5 +1,8 @@
 import abc
+import asyncio
 import smtplib
+import threading
+from typing import Optional
 
 from allocation import config
 
@@ -10,19 +13,52 @@ class AbstractNotifications(abc.ABC):
         raise NotImplementedError
 
 
-DEFAULT_HOST = config.get_email_host_and_port()["host"]
-DEFAULT_PORT = config.get_email_host_and_port()["port"]
-
-
 class EmailNotifications(AbstractNotifications):
-    def __init__(self, smtp_host=DEFAULT_HOST, port=DEFAULT_PORT):
-        self.server = smtplib.SMTP(smtp_host, port=port)
-        self.server.noop()
+    def __init__(self, smtp_host=None, port=None):
+        settings = config.get_email_host_and_port()
+        self.smtp_host = smtp_host or settings["host"]
+        self.port = port or settings["port"]
+        self._server = None
+        # one SMTP conversation at a time, when sent from several threads
+        self._lock = threading.Lock()
+
+    @property
+    def server(self) -> smtplib.SMTP:
+        """The SMTP connection, opened on first use"""
+        if self._server is None:
+            self._server = smtplib.SMTP(self.smtp_host, port=self.port)
+            self._server.noop()
+        return self._server
 
     def send(self, destination, message):
         msg = f'Subject: allocation service notification\n{message}'
+        with self._lock:
+            try:
+                self._sendmail(destination, msg)
+            except smtplib.SMTPServerDisconnected:
+                self._server = None
+                self._sendmail(destination, msg)
+
+    def _sendmail(self, destination, msg):
         self.server.sendmail(
             from_addr='allocations@example.com',
             to_addrs=[destination],
             msg=msg
-        )
\ No newline at end of file
+        )
+
+
+class AsyncEmailNotifications(AbstractNotifications):
+    """
+    EmailNotifications for asyncio code: smtplib blocks, so messages are
+    sent from a thread, one at a time over the one SMTP connection.
+    """
+
+    def __init__(self, smtp_host=None, port=None):
+        self.email = EmailNotifications(smtp_host, port)
+        self._lock = None  # type: Optional[asyncio.Lock]
+
+    async def send(self, destination, message):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            await asyncio.to_thread(self.email.send, destination, message)
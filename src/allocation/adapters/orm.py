@@ -1,4 +1,6 @@
 import logging
+from collections import deque
+from datetime import datetime
 from sqlalchemy import (
     Table,
     MetaData,
@@ -6,10 +8,21 @@ from sqlalchemy import (
     Integer,
     String,
     Date,
+    DateTime,
     ForeignKey,
+    Index,
+    Text,
     event,
+    inspect,
+)
+from sqlalchemy.orm import (
+    mapper,
+    relationship,
+    lazyload,
+    selectinload,
+    joinedload,
+    subqueryload,
 )
-from sqlalchemy.orm import mapper, relationship
 
 from allocation.domain import model
 
@@ -37,8 +50,8 @@ batches = Table(
     "batches",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("reference", String(255)),
-    Column("sku", ForeignKey("products.sku")),
+    Column("reference", String(255), index=True, unique=True),
+    Column("sku", ForeignKey("products.sku"), index=True),
     Column("_purchased_quantity", Integer, nullable=False),
     Column("eta", Date, nullable=True),
 )
@@ -47,21 +60,81 @@ allocations = Table(
     "allocations",
     metadata,
     Column("id", Integer, primary_key=True, autoincrement=True),
-    Column("orderline_id", ForeignKey("order_lines.id")),
+    Column("orderline_id", ForeignKey("order_lines.id"), index=True),
     Column("batch_id", ForeignKey("batches.id")),
+    Index(
+        "ix_allocations_batch_id_orderline_id", "batch_id", "orderline_id", unique=True
+    ),
 )
 
 allocations_view = Table(
     "allocations_view",
     metadata,
-    Column("orderid", String(255)),
+    Column("orderid", String(255), index=True),
     Column("sku", String(255)),
     Column("batchref", String(255)),
 )
 
+# events to publish, written in the same transaction as the change that
+# raised them and relayed by allocation.entrypoints.outbox_relay
+outbox = Table(
+    "outbox",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("channel", String(255), nullable=False),
+    Column("payload", Text, nullable=False),
+    Column("created_at", DateTime, nullable=False, default=datetime.utcnow),
+    Column("sent_at", DateTime, nullable=True),
+)
+Index(
+    "ix_outbox_unsent", outbox.c.id, postgresql_where=outbox.c.sent_at.is_(None)
+)
+
+
+def create_missing_indexes(engine):
+    """
+    Brings the indexes of a database created before they were declared
+    up to date. Fails on the unique ones if there is duplicate data.
+    """
+    inspector = inspect(engine)
+    existing = {
+        index["name"]
+        for table in inspector.get_table_names()
+        for index in inspector.get_indexes(table)
+    }
+    created = []
+    for table in metadata.sorted_tables:
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            if index.name not in existing:
+                logger.info("Creating index %s", index.name)
+                index.create(bind=engine)
+                created.append(index.name)
+    return created
+
+
+LOADING_STRATEGIES = {
+    "select": lazyload,
+    "selectin": selectinload,
+    "joined": joinedload,
+    "subquery": subqueryload,
+}
+
+
+# the default cascade, plus detaching the whole aggregate along with its
+# product (see SqlAlchemyUnitOfWork._commit)
+CASCADE = "save-update, merge, expunge"
 
-def start_mappers():
+
+def start_mappers(loading: str = "selectin"):
+    """
+    ``loading`` is how a product's batches and their allocations are loaded
+    by default, one of LOADING_STRATEGIES. "select" is plain lazy loading,
+    one query per collection; the others load the whole aggregate in a
+    fixed number of queries.
+    """
     logger.info("Starting mappers")
+    if loading not in LOADING_STRATEGIES:
+        raise ValueError(f"Unknown loading strategy {loading}")
     lines_mapper = mapper(model.OrderLine, order_lines)
     batches_mapper = mapper(
         model.Batch,
@@ -71,16 +144,52 @@ def start_mappers():
                 lines_mapper,
                 secondary=allocations,
                 collection_class=set,
+                lazy=loading,
+                cascade=CASCADE,
             )
         },
     )
     mapper(
         model.Product,
         products,
-        properties={"batches": relationship(batches_mapper)},
+        # the domain increments version_number itself, and every UPDATE of a
+        # product checks it still has the version that was loaded
+        version_id_col=products.c.version_number,
+        version_id_generator=False,
+        properties={
+            "batches": relationship(batches_mapper, lazy=loading, cascade=CASCADE)
+        },
     )
 
 
+def loading_options(loading: str):
+    """Query options loading a product's batches and allocations with ``loading``"""
+    loader = LOADING_STRATEGIES[loading]
+    batches_option = loader(model.Product.batches)
+    return [getattr(batches_option, loader.__name__)(model.Batch._allocations)]
+
+
+def summary_loading_options():
+    """Query options loading a product's batches but none of their allocations"""
+    return [selectinload(model.Product.batches).noload(model.Batch._allocations)]
+
+
 @event.listens_for(model.Product, "load")
 def receive_load(product, _):
-    product.events = []
+    product.events = deque()
+
+
+@event.listens_for(model.Product, "expire")
+@event.listens_for(model.Product, "refresh")
+def receive_expire(product, *_):
+    if product is not None:  # already garbage collected
+        product._batch_index = None
+
+
+@event.listens_for(model.Batch, "load")
+@event.listens_for(model.Batch, "expire")
+@event.listens_for(model.Batch, "refresh")
+def receive_batch_load(batch, *_):
+    if batch is not None:
+        batch._allocated_quantity = None
+        batch._unloaded_quantity = 0
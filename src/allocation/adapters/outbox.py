@@ -0,0 +1,82 @@
+"""
+Publishes the events that units of work wrote to the outbox table, in
+batches, through a Redis pipeline. Rows are marked sent in the same
+transaction that selected them, after Redis has taken the whole batch,
+so an event is published at least once even if the relay dies midway.
+"""
+
+import logging
+import time
+from datetime import datetime
+
+from sqlalchemy import func, select
+
+from allocation.adapters import orm
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxRelay:
+    def __init__(self, session_factory, redis_client, batch_size: int = 500):
+        self.session_factory = session_factory
+        self.redis = redis_client
+        self.batch_size = batch_size
+        self.sent = 0
+        self.batches = 0
+        self.last_batch_seconds = 0.0
+
+    def relay_once(self) -> int:
+        """Publishes up to one batch of unsent events, returns how many"""
+        start = time.perf_counter()
+        session = self.session_factory()
+        try:
+            rows = session.execute(
+                select([orm.outbox.c.id, orm.outbox.c.channel, orm.outbox.c.payload])
+                .where(orm.outbox.c.sent_at.is_(None))
+                .order_by(orm.outbox.c.id)
+                .limit(self.batch_size)
+                # concurrent relays share the work instead of waiting
+                .with_for_update(skip_locked=True)
+            ).fetchall()
+            if not rows:
+                return 0
+            pipe = self.redis.pipeline(transaction=False)
+            for _, channel, payload in rows:
+                pipe.publish(channel, payload)
+            pipe.execute()
+            session.execute(
+                orm.outbox.update()
+                .where(orm.outbox.c.id.in_([row.id for row in rows]))
+                .values(sent_at=datetime.utcnow())
+            )
+            session.commit()
+        finally:
+            session.close()
+        self.sent += len(rows)
+        self.batches += 1
+        self.last_batch_seconds = time.perf_counter() - start
+        logger.debug('relayed %d outbox events', len(rows))
+        return len(rows)
+
+    def stats(self):
+        """
+        Relay totals, plus the number of unsent events and the age in
+        seconds of the oldest one: the outbox lag.
+        """
+        session = self.session_factory()
+        try:
+            [(pending, oldest)] = session.execute(
+                select([func.count(), func.min(orm.outbox.c.created_at)])
+                .where(orm.outbox.c.sent_at.is_(None))
+            ).fetchall()
+        finally:
+            session.close()
+        if isinstance(oldest, str):  # sqlite hands back text for aggregates
+            oldest = datetime.fromisoformat(oldest)
+        return dict(
+            pending=pending,
+            lag_seconds=(datetime.utcnow() - oldest).total_seconds() if oldest else 0.0,
+            sent=self.sent,
+            batches=self.batches,
+            last_batch_seconds=self.last_batch_seconds,
+        )
@@ -0,0 +1,106 @@
+"""
+A process-wide cache of Product aggregates, shared by every unit of work so
+hot SKUs are not reloaded from the database on each request.
+
+Cached products are detached from any session, exactly as they were last
+committed. A unit of work takes a product out of the cache, once its
+version_number has been checked against the database, attaches it to its
+own session and puts it back when it commits. Products in use are not in
+the cache, so a unit of work that fails simply loses its entry.
+"""
+
+import sys
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+from allocation import config
+from allocation.domain import model
+
+
+class ProductCache:
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # type: OrderedDict[str, model.Product]
+        self._sizes = {}  # type: Dict[str, int]
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.stale = self.evictions = 0
+
+    def __reduce__(self):
+        # a worker process gets an empty cache of its own
+        return ProductCache, (self.max_entries, self.max_bytes)
+
+    def take(
+        self, sku: str, current_version: Callable[[], Optional[int]]
+    ) -> Optional[model.Product]:
+        """
+        Removes and returns the cached product for ``sku`` if its
+        version_number matches ``current_version()``, which is only called
+        when there is an entry.
+        """
+        with self._lock:
+            product = self._entries.get(sku)
+            if product is None:
+                self.misses += 1
+                return None
+            self._remove(sku)
+        if product.version_number != current_version():
+            with self._lock:
+                self.stale += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return product
+
+    def put(self, product: model.Product):
+        size = approximate_size(product)
+        with self._lock:
+            self._remove(product.sku)
+            if size > self.max_bytes or any(b.summarised for b in product.batches):
+                return
+            self._entries[product.sku] = product
+            self._sizes[product.sku] = size
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, sku: str):
+        with self._lock:
+            self._remove(sku)
+
+    def _remove(self, sku: str):
+        if self._entries.pop(sku, None) is not None:
+            self._bytes -= self._sizes.pop(sku)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                stale=self.stale,
+                evictions=self.evictions,
+                entries=len(self._entries),
+                bytes=self._bytes,
+            )
+
+
+def approximate_size(product: model.Product) -> int:
+    """Rough memory footprint, counting instance dicts and allocation lines"""
+    size = sys.getsizeof(product.__dict__)
+    for batch in product.__dict__.get("batches", ()):
+        size += sys.getsizeof(batch.__dict__)
+        allocations = batch.__dict__.get("_allocations", ())
+        size += sys.getsizeof(allocations)
+        size += sum(sys.getsizeof(line.__dict__) for line in allocations)
+    return size
+
+
+def from_config() -> Optional[ProductCache]:
+    """The cache configured in the environment, None if it is turned off"""
+    settings = config.get_product_cache_settings()
+    if not settings["max_entries"]:
+        return None
+    return ProductCache(**settings)
@@ -0,0 +1,134 @@
+"""
+Where GET /allocations/<orderid> is answered from, other than a query of
+the allocations_view table on the database that handles allocations: a
+Redis hash per order, kept current by the read model handlers in place
+of the table, or a cache of that query in Redis, which those handlers
+invalidate. See views.allocations().
+"""
+
+import json
+import logging
+import threading
+from typing import Iterable, List, Optional, Union
+
+from allocation.adapters import redis_eventpublisher
+
+logger = logging.getLogger(__name__)
+
+
+def _key(orderid: str) -> str:
+    return f"allocations:{orderid}"
+
+
+def _cache_key(orderid: str) -> str:
+    return f"allocations-view:{orderid}"
+
+
+class RedisReadModel:
+    """
+    Each order's allocations as a Redis hash of SKU to batch reference.
+    Allocations and deallocations are given as the events that made them.
+    """
+
+    def __init__(self, client=None):
+        self._client = client
+
+    @property
+    def client(self):
+        return self._client if self._client is not None else redis_eventpublisher.get_client()
+
+    def add(self, allocated: Iterable):
+        pipe = self.client.pipeline(transaction=False)
+        for event in allocated:
+            pipe.hset(_key(event.orderid), event.sku, event.batchref)
+        pipe.execute()
+
+    def remove(self, deallocated: Iterable):
+        pipe = self.client.pipeline(transaction=False)
+        for event in deallocated:
+            pipe.hdel(_key(event.orderid), event.sku)
+        pipe.execute()
+
+    def allocations(self, orderid: str) -> List[dict]:
+        return sorted(
+            (
+                {'sku': sku.decode(), 'batchref': batchref.decode()}
+                for sku, batchref in self.client.hgetall(_key(orderid)).items()
+            ),
+            key=lambda row: row['sku'],
+        )
+
+
+class AllocationsCache:
+    """
+    The results of views.allocations() queries, kept in Redis for ``ttl``
+    seconds, or until invalidate() is called for the order, after each
+    change to it has been committed. A query that was answered just
+    before a change, and cached just after its invalidation, is served
+    until its TTL runs out, which bounds how stale a result can be.
+
+    Redis being unavailable makes every read a miss, rather than an error.
+    """
+
+    def __init__(self, client=None, ttl: float = 60):
+        self._client = client
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.invalidations = self.errors = 0
+
+    @property
+    def client(self):
+        return self._client if self._client is not None else redis_eventpublisher.get_client()
+
+    def get(self, orderid: str) -> Optional[List[dict]]:
+        try:
+            cached = self.client.get(_cache_key(orderid))
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Failed reading cached allocations of %s', orderid)
+            self._count("errors")
+            cached = None
+        self._count("misses" if cached is None else "hits")
+        return None if cached is None else json.loads(cached)
+
+    def set(self, orderid: str, allocations: List[dict]):
+        try:
+            self.client.set(
+                _cache_key(orderid), json.dumps(allocations), px=int(self.ttl * 1000)
+            )
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Failed caching allocations of %s', orderid)
+            self._count("errors")
+
+    def invalidate(self, orderids: Iterable[str]):
+        keys = [_cache_key(orderid) for orderid in set(orderids)]
+        try:
+            self.client.delete(*keys)
+        except Exception:  # pylint: disable=broad-except
+            # served stale until the TTL runs out
+            logger.exception('Failed invalidating cached allocations of %s', keys)
+            self._count("errors")
+            return
+        self._count("invalidations", len(keys))
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                hits=self.hits, misses=self.misses,
+                invalidations=self.invalidations, errors=self.errors,
+            )
+
+
+ReadModel = Union[RedisReadModel, AllocationsCache]
+
+
+def from_settings(backend: str = "postgres", cache_ttl: float = 0) -> Optional[ReadModel]:
+    """The read model config.get_read_model_settings() describes, None for the table alone"""
+    if backend == "redis":
+        return RedisReadModel()
+    if backend != "postgres":
+        raise ValueError(f"Unknown read model {backend!r}")
+    return AllocationsCache(ttl=cache_ttl) if cache_ttl > 0 else None
@@ -5,22 +5,232 @@ detail."""
 
 import json
 import logging
-import redis
+import threading
+import time
 from dataclasses import asdict
+from typing import Callable, List, Optional, Tuple
 
-from allocation import config
+from allocation import config, metrics
 from allocation.domain import events
 
 logger = logging.getLogger(__name__)
 
-r = redis.Redis(**config.get_redis_host_and_port())
+_client = None
+
+def get_client():
+    """
+    The Redis client, created on first use. redis is imported here too,
+    as importing it takes longer than the rest of the service.
+
+    Its connections come from a pool of at most REDIS_MAX_CONNECTIONS,
+    shared by every thread; one more waits for a connection to be free.
+    """
+    global _client  # pylint: disable=global-statement
+    if _client is None:
+        import redis  # pylint: disable=import-outside-toplevel
+        pool = redis.BlockingConnectionPool(
+            **config.get_redis_host_and_port(), **config.get_redis_pool_settings()
+        )
+        _client = redis.Redis(connection_pool=pool)
+    return _client
+
+_async_client = None
+
+def get_async_client():
+    """The asyncio Redis client, created on first use"""
+    global _async_client  # pylint: disable=global-statement
+    if _async_client is None:
+        import redis.asyncio  # pylint: disable=import-outside-toplevel
+        _async_client = redis.asyncio.Redis(**config.get_redis_host_and_port())
+    return _async_client
 
 def publish(channel, event: events.Event):
     logger.debug('publishing: channel=%s, event=%s', channel, event)
-    r.publish(channel, json.dumps(asdict(event)))
+    get_client().publish(channel, json.dumps(asdict(event)))
+
+async def publish_async(channel, event: events.Event):
+    logger.debug('publishing: channel=%s, event=%s', channel, event)
+    await get_async_client().publish(channel, json.dumps(asdict(event)))
+
+PUBLISH_SECONDS = "allocation_publish_seconds"
+
+
+class RedisEventPublisher:
+    """
+    Publishes events like publish(), but buffered, and sent in one pipeline
+    a buffer at a time: one round trip for all the events raised while
+    the bus handled a message, which it flushes when done (see end_cycle).
+    Each thread has a buffer of its own.
+    """
+
+    def __init__(self, client=None):
+        self._client = client
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.published = self.flushes = self.errors = 0
+
+    @property
+    def client(self):
+        return self._client if self._client is not None else get_client()
+
+    def __call__(self, channel, event: events.Event):
+        logger.debug('publishing: channel=%s, event=%s', channel, event)
+        self._buffer().append((channel, json.dumps(asdict(event))))
+
+    def _buffer(self) -> List[Tuple[str, str]]:
+        buffer = getattr(self._local, "events", None)
+        if buffer is None:
+            buffer = self._local.events = []
+        return buffer
+
+    def end_cycle(self):
+        """Called by the bus when it has handled a message and its events"""
+        self.flush()
+
+    def flushing(self, call: Callable) -> Callable:
+        """``call``, flushing what it published, for calls made off the bus's thread"""
+        def flushed(message):
+            try:
+                return call(message)
+            finally:
+                self.flush()
+        flushed.__name__ = flushed.__qualname__ = call.__name__
+        return flushed
+
+    def flush(self) -> int:
+        """Sends this thread's buffer, returns how many events were sent"""
+        buffer = self._buffer()
+        if not buffer:
+            return 0
+        self._local.events = []
+        return self._send(buffer)
+
+    def _send(self, batch: List[Tuple[str, str]]) -> int:
+        start = time.perf_counter()
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for channel, payload in batch:
+                pipe.publish(channel, payload)
+            pipe.execute()
+        except Exception:  # pylint: disable=broad-except
+            # as a failed publish() was, by the bus: logged, not raised
+            logger.exception('Failed publishing %d events', len(batch))
+            with self._lock:
+                self.errors += len(batch)
+            return 0
+        metrics.REGISTRY.observe(PUBLISH_SECONDS, time.perf_counter() - start)
+        with self._lock:
+            self.published += len(batch)
+            self.flushes += 1
+        return len(batch)
+
+    def close(self):
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return dict(published=self.published, flushes=self.flushes, errors=self.errors)
+
+
+class BufferedRedisEventPublisher(RedisEventPublisher):
+    """
+    A RedisEventPublisher for long-running consumers, whose events are
+    worth batching across messages: one buffer, shared by every thread,
+    sent once it holds ``max_events``, or its oldest event has waited
+    ``max_delay`` seconds, whichever comes first.
+
+    Whoever takes a batch from the buffer, a publishing thread or the
+    flusher, takes ``_sending`` with it, before letting go of the buffer,
+    so batches are sent one at a time, in the order they were taken.
+    """
+
+    def __init__(self, client=None, max_events: int = 500, max_delay: float = 0.02):
+        super().__init__(client)
+        self.max_events = max_events
+        self.max_delay = max_delay
+        self._events = []  # type: List[Tuple[str, str]]
+        self._oldest = 0.0
+        self._closed = False
+        self._changed = threading.Condition()
+        self._sending = threading.Lock()
+        self._flusher = None  # type: Optional[threading.Thread]
+
+    def __call__(self, channel, event: events.Event):
+        logger.debug('publishing: channel=%s, event=%s', channel, event)
+        payload = json.dumps(asdict(event))
+        with self._changed:
+            if self._closed:  # nothing is left to send it later
+                batch = [(channel, payload)]
+            else:
+                if self._flusher is None:
+                    # started on first use, so that an unused publisher has no thread
+                    self._flusher = threading.Thread(
+                        target=self._flush_when_due, name="publisher", daemon=True
+                    )
+                    self._flusher.start()
+                if not self._events:
+                    self._oldest = time.monotonic()
+                    self._changed.notify()
+                self._events.append((channel, payload))
+                if len(self._events) < self.max_events:
+                    return
+                batch, self._events = self._events, []
+            self._sending.acquire()
+        self._send_taken(batch)
+
+    def end_cycle(self):
+        pass
+
+    def flush(self) -> int:
+        """Sends the buffer now"""
+        with self._changed:
+            batch, self._events = self._events, []
+            if not batch:
+                return 0
+            self._sending.acquire()
+        return self._send_taken(batch)
+
+    def _send_taken(self, batch: List[Tuple[str, str]]) -> int:
+        """Sends ``batch``, taken from the buffer along with ``_sending``"""
+        try:
+            return self._send(batch)
+        finally:
+            self._sending.release()
+
+    def _flush_when_due(self):
+        while True:
+            with self._changed:
+                while not self._closed and (
+                    not self._events or time.monotonic() < self._oldest + self.max_delay
+                ):
+                    self._changed.wait(
+                        self._oldest + self.max_delay - time.monotonic()
+                        if self._events else None
+                    )
+                if self._closed:
+                    return
+                batch, self._events = self._events, []
+                self._sending.acquire()
+            self._send_taken(batch)
+
+    def close(self):
+        """Stops the flusher, then sends what's left"""
+        with self._changed:
+            self._closed = True
+            self._changed.notify()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+
+    def stats(self):
+        stats = super().stats()
+        with self._changed:
+            stats["buffered"] = len(self._events)
+        return stats
 
-def update_readmodel(orderid, sku, batchref):
-    r.hset(orderid, sku, batchref)
 
-def get_readmodel(orderid):
-    return r.hgetall(orderid)
\ No newline at end of file
+def event_publisher(max_events: int = 0, max_delay: float = 0.02) -> RedisEventPublisher:
+    """A publisher as get_event_publisher_settings() describes"""
+    if max_events > 0:
+        return BufferedRedisEventPublisher(max_events=max_events, max_delay=max_delay)
+    return RedisEventPublisher()
@@ -1,29 +1,68 @@
 import abc
-from typing import Protocol, Set
+import csv
+import io
+from collections import defaultdict, deque
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Protocol, Set
+from sqlalchemy import exc, func
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 from allocation.adapters import orm
+from allocation.adapters.product_cache import ProductCache
+from allocation.domain import events
 import allocation.domain.model as model
 
 
 class AbstractRepository(abc.ABC):
     def __init__(self):
         self.seen: Set[model.Product] = set()
+        # products handed out since their events were last collected, the
+        # only ones that can have raised any; a dict to keep them in order
+        self.recent: Dict[model.Product, None] = {}
+        # bulk writes bypass the aggregates, so their events are kept here,
+        # as are those of products handed to a ProductCache
+        self.events: Deque[events.Event] = deque()
 
     def add(self, product: model.Product):
         self._add(product)
-        self.seen.add(product)
+        self._saw([product])
 
     def get(self, sku) -> model.Product:
         product = self._get(sku)
         if product:
-            self.seen.add(product)
+            self._saw([product])
         return product
 
     def get_by_batchref(self, batchref) -> model.Product:
         product = self._get_by_batchref(batchref)
         if product:
-            self.seen.add(product)
+            self._saw([product])
         return product
 
+    def get_many(self, skus: Iterable[str]) -> List[model.Product]:
+        products = self._get_many(set(skus))
+        self._saw(products)
+        return products
+
+    def get_many_by_batchref(self, batchrefs: Iterable[str]) -> List[model.Product]:
+        products = self._get_many_by_batchref(set(batchrefs))
+        self._saw(products)
+        return products
+
+    def _saw(self, products: List[model.Product]):
+        self.seen.update(products)
+        self.recent.update(dict.fromkeys(products))
+
+    def add_batches(self, batches: List[model.Batch]):
+        """
+        Inserts new batches, creating any missing products, without loading
+        the products they belong to.
+        """
+        self._add_batches(batches)
+        self.events.append(events.BatchesCreated([
+            events.BatchCreated(b.reference, b.sku, b._purchased_quantity, b.eta)
+            for b in batches
+        ]))
+
     @abc.abstractmethod
     def _add(self, product: model.Product):
         raise NotImplementedError
@@ -36,19 +75,229 @@ class AbstractRepository(abc.ABC):
     def _get_by_batchref(self, batchref) -> model.Product:
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def _add_batches(self, batches: List[model.Batch]):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _get_many(self, skus: Set[str]) -> List[model.Product]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _get_many_by_batchref(self, batchrefs: Set[str]) -> List[model.Product]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def sku_for_batchref(self, batchref: str) -> Optional[str]:
+        """The SKU of the batch ``batchref``, without loading its product"""
+        raise NotImplementedError
+
 
 class SqlAlchemyRepository(AbstractRepository):
-    def __init__(self, session):
+    def __init__(
+        self, session,
+        loading: Optional[str] = None,
+        cache: Optional[ProductCache] = None,
+    ):
+        """
+        ``loading`` overrides the strategy the mappers were started with
+        for loading batches and allocations, see orm.LOADING_STRATEGIES.
+
+        "summary" loading is for allocation: get and get_many load batches
+        with only the total quantity allocated to each, and new allocations
+        are added without loading the existing ones. The by-batchref
+        lookups, used to change batches, still load whole aggregates.
+        Lines allocated before the product was loaded are not in
+        _allocations, so allocating the same line again is not a no-op.
+
+        Products found in ``cache`` and still current are attached to the
+        session instead of being loaded.
+        """
         super().__init__()
         self.session = session
+        self.loading = loading
+        self.cache = cache
 
     def _add(self, product):
         self.session.add(product)
 
+    def _add_batches(self, batches):
+        skus = {b.sku for b in batches}
+        existing = {sku for sku, in self.session.query(orm.products.c.sku).filter(
+            orm.products.c.sku.in_(skus),
+        )}
+        if skus - existing:
+            self.session.execute(orm.products.insert(), [
+                dict(sku=sku, version_number=0) for sku in sorted(skus - existing)
+            ])
+        if existing:
+            # so cached copies of these products go stale
+            self.session.execute(orm.products.update().where(
+                orm.products.c.sku.in_(existing),
+            ).values(version_number=orm.products.c.version_number + 1))
+
+        if self.session.get_bind().dialect.name == "postgresql":
+            self._copy_batches(batches)
+        else:
+            self.session.execute(orm.batches.insert(), [
+                dict(
+                    reference=b.reference, sku=b.sku,
+                    _purchased_quantity=b._purchased_quantity, eta=b.eta,
+                )
+                for b in batches
+            ])
+
+    def _copy_batches(self, batches):
+        rows = io.StringIO()
+        csv.writer(rows).writerows(
+            (b.reference, b.sku, b._purchased_quantity, b.eta) for b in batches
+        )
+        rows.seek(0)
+        statement = (
+            "COPY batches (reference, sku, _purchased_quantity, eta)"
+            " FROM STDIN WITH (FORMAT csv)"
+        )
+        dialect = self.session.get_bind().dialect
+        cursor = self.session.connection().connection.cursor()
+        try:
+            cursor.copy_expert(statement, rows)
+        except dialect.dbapi.Error as e:
+            # raised by the driver's cursor, not through SQLAlchemy, so
+            # translated as it would be: a duplicate to an IntegrityError
+            raise exc.DBAPIError.instance(
+                statement, None, e, dialect.dbapi.Error, dialect=dialect,
+            ) from e
+
+    def _query(self, summarise=False):
+        query = self.session.query(model.Product)
+        if self.loading == "summary":
+            if summarise:
+                query = query.options(*orm.summary_loading_options())
+        elif self.loading:
+            query = query.options(*orm.loading_options(self.loading))
+        return query
+
     def _get(self, sku):
-        return self.session.query(model.Product).filter_by(sku=sku).first()
+        return self._load(sku, summarise=True)
 
     def _get_by_batchref(self, batchref):
-        return (self.session.query(model.Product).join(model.Batch).filter(
+        sku = self.sku_for_batchref(batchref)
+        return self._load(sku, summarise=False) if sku is not None else None
+
+    def _get_many(self, skus):
+        return self._load_many(skus, summarise=True)
+
+    def _get_many_by_batchref(self, batchrefs):
+        if not batchrefs:
+            return []
+        skus = self.session.query(orm.batches.c.sku).filter(
+            orm.batches.c.reference.in_(batchrefs),
+        ).distinct()
+        return self._load_many({sku for sku, in skus}, summarise=False)
+
+    def _load(self, sku, summarise):
+        if self._in_session(sku):
+            product = self._query().get(sku)
+            if not summarise:
+                self._load_allocations([product])
+            return product
+        if self.cache is not None:
+            cached = self.cache.take(sku, lambda: self._version_number(sku))
+            if cached is not None:
+                self.session.add(cached)
+                return cached
+        product = self._query(summarise).get(sku)
+        if product is not None and summarise:
+            self._summarise([product])
+        return product
+
+    def _load_many(self, skus, summarise):
+        products = []
+        if self.cache is not None:
+            current_version = self._version_numbers(skus)
+            for sku in skus:
+                if self._in_session(sku):
+                    continue
+                cached = self.cache.take(sku, lambda: current_version(sku))
+                if cached is not None:
+                    self.session.add(cached)
+                    products.append(cached)
+            skus = skus - {p.sku for p in products}
+        loaded = {sku for sku in skus if self._in_session(sku)}
+        if skus:
+            queried = self._query(summarise).filter(model.Product.sku.in_(skus)).all()
+            if summarise:
+                self._summarise([p for p in queried if p.sku not in loaded])
+            else:
+                self._load_allocations([p for p in queried if p.sku in loaded])
+            products += queried
+        return products
+
+    def _summarise(self, products):
+        """
+        In "summary" loading, batches come without their allocations; each
+        gets the total allocated to it from one GROUP BY query instead.
+        """
+        if self.loading != "summary":
+            return
+        batches = {b.id: b for p in products for b in p.batches}
+        if not batches:
+            return
+        totals = dict(self.session.query(
+            orm.allocations.c.batch_id, func.sum(orm.order_lines.c.qty),
+        ).join(
+            orm.order_lines, orm.order_lines.c.id == orm.allocations.c.orderline_id,
+        ).filter(
+            orm.allocations.c.batch_id.in_(batches),
+        ).group_by(orm.allocations.c.batch_id))
+        for batch_id, batch in batches.items():
+            batch.summarise(totals.get(batch_id, 0))
+
+    def _load_allocations(self, products):
+        """
+        Makes whole aggregates of products summary loading left without
+        their allocations, when they're looked up again in the same session
+        (as within a unit of work group) to change their batches.
+        """
+        batches = {b.id: b for p in products for b in p.batches if b.summarised}
+        if not batches:
+            return
+        # the lines allocated since loading, still only in _allocations
+        self.session.flush()
+        lines = defaultdict(set)  # type: Dict[int, Set[model.OrderLine]]
+        for batch_id, line in self.session.query(
+            orm.allocations.c.batch_id, model.OrderLine,
+        ).join(
+            orm.allocations, orm.allocations.c.orderline_id == orm.order_lines.c.id,
+        ).filter(orm.allocations.c.batch_id.in_(batches)):
+            lines[batch_id].add(line)
+        for batch_id, batch in batches.items():
+            set_committed_value(batch, "_allocations", lines[batch_id])
+            batch.summarise(0)
+            batch._allocated_quantity = None
+
+    def _in_session(self, sku) -> bool:
+        return identity_key(model.Product, sku) in self.session.identity_map
+
+    def _version_number(self, sku) -> Optional[int]:
+        return self.session.query(orm.products.c.version_number).filter(
+            orm.products.c.sku == sku,
+        ).scalar()
+
+    def _version_numbers(self, skus) -> Callable[[str], Optional[int]]:
+        """Looks up every version number in one query, the first time it's called"""
+        versions = {}  # type: Dict[str, int]
+
+        def current_version(sku):
+            if not versions:
+                versions.update(self.session.query(
+                    orm.products.c.sku, orm.products.c.version_number,
+                ).filter(orm.products.c.sku.in_(skus)))
+            return versions.get(sku)
+
+        return current_version
+
+    def sku_for_batchref(self, batchref) -> Optional[str]:
+        return self.session.query(orm.batches.c.sku).filter(
             orm.batches.c.reference == batchref,
-        ).first())
\ No newline at end of file
+        ).scalar()
\ No newline at end of file
@@ -1,47 +1,224 @@
-import inspect
-from typing import Callable, Dict
-from allocation.adapters import orm, redis_eventpublisher, notifications
-from allocation.service_layer import unit_of_work, handlers, messagebus
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Sequence
+from allocation import config, metrics
+from allocation.adapters import orm, read_model as read_models, redis_eventpublisher
+from allocation.adapters.notifications import (
+    AbstractNotifications, AsyncEmailNotifications, EmailNotifications,
+)
+from allocation.domain import model
+from allocation.service_layer import dispatch, unit_of_work, handlers, messagebus, partitions
+from allocation.service_layer.deferred import DeferredHandlers
+
+
+PUBLISHING_HANDLERS = {
+    handlers.publish_allocated_event,
+    handlers.publish_allocated_event_async,
+    handlers.publish_allocated_events,
+}
 
 
 def bootstrap(
     start_orm: bool = True,
-    uow: unit_of_work.AbstractUnitOfWork = unit_of_work.SqlAlchemyUnitOfWork(),
-    notifications: notifications.AbstractNotifications = notifications.EmailNotifications(),
-    publish: Callable = redis_eventpublisher.publish,
+    uow: Optional[unit_of_work.AbstractUnitOfWork] = None,
+    notifications: Optional[AbstractNotifications] = None,
+    publish: Optional[Callable] = None,
+    asynchronous: bool = False,
+    workers: Optional[int] = None,
+    middleware: Optional[Sequence[dispatch.Middleware]] = None,
+    read_model: Optional[read_models.ReadModel] = None,
 ):
+    """
+    Builds a MessageBus or, if ``asynchronous``, a
+    messagebus.AsyncMessageBus using the async Redis and email adapters.
+
+    With ``workers`` (BUS_WORKERS by default) above 0, messages are handled
+    by that many processes instead, each bootstrapping a bus of its own
+    from the arguments given here, which must then be picklable; see
+    partitions.PartitionedMessageBus.
+
+    Every handler call goes through ``middleware``, by default timing it
+    and retrying conflicts as configured, see dispatch.default_middleware.
+
+    The read model handlers keep ``read_model`` (as READ_MODEL says by
+    default, see read_model.from_settings) current instead of, or as well
+    as, allocations_view.
+
+    Events are published, by default, through a RedisEventPublisher, which
+    sends those each message raised in one pipeline, or buffers them across
+    messages as PUBLISH_BUFFER_EVENTS says.
+    """
+    # as given: each worker process builds the defaults for itself
+    worker_bus_factory = functools.partial(
+        bootstrap, start_orm=True, uow=uow, notifications=notifications, publish=publish,
+        workers=0, middleware=middleware, read_model=read_model,
+    )
+
+    # built here rather than as default arguments, which would run on import
+    if uow is None:
+        uow = unit_of_work.SqlAlchemyUnitOfWork()
     if notifications is None:
-        notifications = notifications.EmailNotifications()
+        notifications = AsyncEmailNotifications() if asynchronous else EmailNotifications()
+    if publish is None and asynchronous:
+        publish = redis_eventpublisher.publish_async
+
+    if read_model is None:
+        read_model = read_models.from_settings(**config.get_read_model_settings())
+
+    if config.get_debug_checks():
+        model.DEBUG_CHECKS = True
 
     if start_orm:
-        orm.start_mappers()
+        orm.start_mappers(loading=config.get_orm_loading())
+
+    worker_settings = config.get_bus_worker_settings()
+    if workers is None:
+        workers = worker_settings["workers"]
+    if workers > 0 and not asynchronous:
+        bus = partitions.PartitionedMessageBus(
+            uow=uow,
+            bus_factory=worker_bus_factory,
+            sku_for_batchref=functools.partial(sku_for_batchref, uow),
+            workers=workers,
+            queue_size=worker_settings["queue_size"],
+        )
+        metrics.REGISTRY.register_collector(
+            "bus_workers",
+            lambda: metrics.samples("allocation_bus_workers", bus.stats(), "worker"),
+        )
+        return bus
 
-    dependencies = {'uow': uow, 'notifications': notifications, 'publish': publish}
+    # built only for a bus in this process, each worker building its own
+    if publish is None:
+        publish = redis_eventpublisher.event_publisher(
+            **config.get_event_publisher_settings()
+        )
+    publisher = publish if isinstance(publish, redis_eventpublisher.RedisEventPublisher) else None
 
-    injected_event_handlers = {
-        event_type: [
-            inject_dependencies(handler, dependencies)
-            for handler in event_handlers
-        ]
-        for event_type, event_handlers in handlers.EVENT_HANDLERS.items()
+    dependencies = {
+        'uow': uow, 'notifications': notifications, 'publish': publish,
+        'read_model': read_model,
     }
+    if isinstance(read_model, read_models.RedisReadModel):
+        replaced = handlers.REDIS_READ_MODEL_HANDLERS
+    elif isinstance(read_model, read_models.AllocationsCache):
+        replaced = handlers.CACHED_READ_MODEL_HANDLERS
+    else:
+        replaced = {}
+    retry_settings = config.get_concurrency_retry_settings()
+    if middleware is None:
+        middleware = dispatch.default_middleware(
+            uow,
+            retry=(
+                dispatch.concurrency_retry(**retry_settings)
+                if retry_settings["attempts"] > 1 else None
+            ),
+            trace=config.get_handler_tracing(),
+        )
+
+    # events the unit of work writes to the outbox reach Redis through the
+    # outbox relay, so they aren't published from here as well
+    outboxed = getattr(uow, "outbox_channels", {})
+    deferred = None
+    deferred_settings = config.get_deferred_handler_settings()
+    if deferred_settings["workers"] > 0 and not asynchronous:
+        deferred = DeferredHandlers(**deferred_settings)
+
+    def inject_event_handler(handler):
+        injected = inject_dependencies(handler, dependencies, middleware)
+        if deferred is not None and handler in handlers.DEFERRED_HANDLERS:
+            if publisher is not None and handler in PUBLISHING_HANDLERS:
+                # it publishes on a deferred thread, outside the bus's cycle
+                injected = publisher.flushing(injected)
+            return deferred.defer(handler.__name__, injected)
+        return injected
+
+    def inject_event_handlers(handler_map):
+        return {
+            event_type: [
+                inject_event_handler(handler)
+                for original in event_handlers
+                for handler in replaced.get(original, [original])
+                if not (event_type in outboxed and handler in PUBLISHING_HANDLERS)
+            ]
+            for event_type, event_handlers in handler_map.items()
+        }
+
+    injected_event_handlers = inject_event_handlers(
+        handlers.ASYNC_EVENT_HANDLERS if asynchronous else handlers.EVENT_HANDLERS
+    )
+    injected_coalesced_handlers = inject_event_handlers(handlers.COALESCED_EVENT_HANDLERS)
 
     injected_command_handlers = {
-        command_type: inject_dependencies(handler, dependencies)
+        command_type: inject_dependencies(handler, dependencies, middleware)
         for command_type, handler in handlers.COMMAND_HANDLERS.items()
     }
 
+    register_metrics(uow, deferred, publisher, read_model)
+
+    if asynchronous:
+        return messagebus.AsyncMessageBus(
+            uow=uow,
+            event_handlers=injected_event_handlers,
+            command_handlers=injected_command_handlers,
+            executor=ThreadPoolExecutor(
+                config.get_async_bus_threads(), thread_name_prefix="bus"
+            ),
+        )
+
+    group_commit = config.get_group_commit_settings()
+    if group_commit["max_size"] > 0:
+        return messagebus.GroupCommitMessageBus(
+            uow=uow,
+            event_handlers=injected_event_handlers,
+            command_handlers=injected_command_handlers,
+            coalesced_event_handlers=injected_coalesced_handlers,
+            deferred=deferred,
+            publisher=publisher,
+            rerun_conflicts=retry_settings["attempts"] > 1,
+            **group_commit,
+        )
+
     return messagebus.MessageBus(
         uow=uow,
         event_handlers=injected_event_handlers,
-        command_handlers=injected_command_handlers
+        command_handlers=injected_command_handlers,
+        coalesced_event_handlers=injected_coalesced_handlers,
+        deferred=deferred,
+        publisher=publisher,
     )
 
-def inject_dependencies(handler: Callable, dependencies: Dict):
-    params = inspect.signature(handler).parameters
-    deps = {
-        name: dependency
-        for name, dependency in dependencies.items()
-        if name in params
-    }
-    return lambda message: handler(message, **deps)
\ No newline at end of file
+def sku_for_batchref(uow: unit_of_work.AbstractUnitOfWork, batchref: str):
+    with uow:
+        return uow.products.sku_for_batchref(batchref)
+
+def register_metrics(uow, deferred, publisher=None, read_model=None):
+    metrics.REGISTRY.register_collector(
+        "db_pool", lambda: metrics.samples("allocation_db_pool", unit_of_work.pool_stats())
+    )
+    cache = getattr(uow, "product_cache", None)
+    if cache is not None:
+        metrics.REGISTRY.register_collector(
+            "product_cache",
+            lambda: metrics.samples("allocation_product_cache", cache.stats()),
+        )
+    if deferred is not None:
+        metrics.REGISTRY.register_collector(
+            "deferred",
+            lambda: metrics.samples("allocation_deferred", deferred.stats(), "handler"),
+        )
+    if publisher is not None:
+        metrics.REGISTRY.register_collector(
+            "publisher", lambda: metrics.samples("allocation_publisher", publisher.stats())
+        )
+    if isinstance(read_model, read_models.AllocationsCache):
+        metrics.REGISTRY.register_collector(
+            "allocations_cache",
+            lambda: metrics.samples("allocation_allocations_cache", read_model.stats()),
+        )
+
+def inject_dependencies(
+    handler: Callable, dependencies: Dict, middleware: Sequence[dispatch.Middleware] = (),
+):
+    """``handler`` with its dependencies bound, wrapped in ``middleware``"""
+    return dispatch.chain(handler, dispatch.bind(handler, dependencies), middleware)
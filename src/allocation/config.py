@@ -1,4 +1,5 @@
 import os
+import socket
 
 
 def get_postgres_uri():
@@ -9,6 +10,21 @@ def get_postgres_uri():
     return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 
 
+def get_db_pool_settings():
+    return dict(
+        pool_size=int(os.environ.get("DB_POOL_SIZE", 5)),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        pool_pre_ping=os.environ.get("DB_POOL_PRE_PING", "1") == "1",
+    )
+
+
+def get_db_statement_timeout_ms():
+    # 0 leaves the server's default in place
+    return int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 0))
+
+
 def get_api_url():
     host = os.environ.get("API_HOST", "localhost")
     port = 5005 if host == "localhost" else 80
@@ -21,8 +37,136 @@ def get_redis_host_and_port():
     return dict(host=host, port=port)
 
 
+def get_redis_pool_settings():
+    # connections beyond max_connections wait up to timeout seconds for one
+    return dict(
+        max_connections=int(os.environ.get("REDIS_MAX_CONNECTIONS", 50)),
+        timeout=float(os.environ.get("REDIS_POOL_TIMEOUT", 5)),
+    )
+
+
+def get_event_publisher_settings():
+    # 0 events publishes what each message raised once it's handled; above
+    # 0, events are sent when that many are buffered, or the oldest has
+    # waited max_delay seconds
+    return dict(
+        max_events=int(os.environ.get("PUBLISH_BUFFER_EVENTS", 0)),
+        max_delay=int(os.environ.get("PUBLISH_BUFFER_MS", 20)) / 1000,
+    )
+
+
 def get_email_host_and_port():
     host = os.environ.get("EMAIL_HOST", "localhost")
     port = 11025 if host == "localhost" else 1025
     http_port = 18025 if host == "localhost" else 8025
-    return dict(host=host, port=port, http_port=http_port)
\ No newline at end of file
+    return dict(host=host, port=port, http_port=http_port)
+
+
+def get_orm_loading():
+    return os.environ.get("ORM_LOADING", "selectin")
+
+
+def get_repository_loading():
+    # "summary" loads allocation totals instead of order lines, see repository
+    return os.environ.get("REPOSITORY_LOADING") or None
+
+
+def get_product_cache_settings():
+    max_entries = int(os.environ.get("PRODUCT_CACHE_ENTRIES", 0))
+    max_bytes = int(os.environ.get("PRODUCT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+    return dict(max_entries=max_entries, max_bytes=max_bytes)
+
+
+def get_group_commit_settings():
+    # max_size 0 (the default) handles each message in its own transaction
+    return dict(
+        max_size=int(os.environ.get("GROUP_COMMIT_MAX_SIZE", 0)),
+        window=int(os.environ.get("GROUP_COMMIT_WINDOW_MS", 5)) / 1000,
+    )
+
+
+def get_concurrency_retry_settings():
+    # attempts in all, so 1 doesn't retry
+    return dict(
+        attempts=int(os.environ.get("CONCURRENCY_RETRY_ATTEMPTS", 5)),
+        wait=int(os.environ.get("CONCURRENCY_RETRY_WAIT_MS", 10)) / 1000,
+        max_wait=int(os.environ.get("CONCURRENCY_RETRY_MAX_WAIT_MS", 500)) / 1000,
+    )
+
+
+def get_handler_tracing():
+    # logs every handler call at debug level
+    return os.environ.get("HANDLER_TRACING", "0") == "1"
+
+
+def get_async_bus_threads():
+    # threads running the blocking handlers, each holding a DB connection
+    return int(os.environ.get("ASYNC_BUS_THREADS", 10))
+
+
+def get_read_model_settings():
+    # READ_MODEL=redis answers GET /allocations from a Redis hash per order;
+    # with postgres, a cache_ttl above 0 caches its query in Redis
+    return dict(
+        backend=os.environ.get("READ_MODEL", "postgres"),
+        cache_ttl=float(os.environ.get("READ_MODEL_CACHE_TTL", 0)),
+    )
+
+
+def get_outbox_settings():
+    # when enabled, Allocated events go to Redis via the outbox relay
+    return dict(
+        enabled=os.environ.get("OUTBOX_ENABLED", "0") == "1",
+        batch_size=int(os.environ.get("OUTBOX_BATCH_SIZE", 500)),
+        poll_interval=int(os.environ.get("OUTBOX_POLL_INTERVAL_MS", 200)) / 1000,
+    )
+
+
+def get_consumer_settings():
+    # the channels, or streams, the event consumer reads commands from
+    channels = os.environ.get("REDIS_CONSUMER_CHANNELS", "change_batch_quantity,allocate")
+    return dict(
+        channels=[channel.strip() for channel in channels.split(",") if channel.strip()],
+        workers=int(os.environ.get("CONSUMER_WORKERS", 4)),
+        queue_size=int(os.environ.get("CONSUMER_QUEUE_SIZE", 100)),
+    )
+
+
+def get_stream_consumer_settings():
+    # REDIS_CONSUMER=streams reads commands from Redis streams in a consumer
+    # group, instead of from pubsub channels
+    return dict(
+        enabled=os.environ.get("REDIS_CONSUMER", "pubsub") == "streams",
+        group=os.environ.get("REDIS_STREAM_GROUP", "allocation"),
+        # unique per process, so that consumers share a group's messages
+        consumer=os.environ.get("REDIS_STREAM_CONSUMER")
+        or f"{socket.gethostname()}-{os.getpid()}",
+        batch_size=int(os.environ.get("REDIS_STREAM_BATCH_SIZE", 100)),
+        block=int(os.environ.get("REDIS_STREAM_BLOCK_MS", 1000)),
+        claim_idle=int(os.environ.get("REDIS_STREAM_CLAIM_IDLE_MS", 60000)),
+        max_deliveries=int(os.environ.get("REDIS_STREAM_MAX_DELIVERIES", 5)),
+    )
+
+
+def get_deferred_handler_settings():
+    # 0 threads runs deferred handlers inline, like any other
+    return dict(
+        workers=int(os.environ.get("DEFERRED_HANDLER_THREADS", 0)),
+        queue_size=int(os.environ.get("DEFERRED_HANDLER_QUEUE_SIZE", 1000)),
+    )
+
+
+def get_bus_worker_settings():
+    # 0 workers handles messages in the calling process
+    return dict(
+        workers=int(os.environ.get("BUS_WORKERS", 0)),
+        queue_size=int(os.environ.get("BUS_WORKER_QUEUE_SIZE", 1000)),
+    )
+
+
+def get_import_chunk_size():
+    return int(os.environ.get("IMPORT_CHUNK_SIZE", 5000))
+
+
+def get_debug_checks():
+    return os.environ.get("DEBUG_CHECKS", "0") == "1"
@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional
+from typing import List, Optional, Tuple
 
 
 class Command:
@@ -14,6 +14,12 @@ class Allocate(Command):
     qty: int
 
 
+@dataclass
+class AllocateOrder(Command):
+    orderid: str
+    lines: List[Tuple[str, int]]  # (sku, qty) pairs
+
+
 @dataclass
 class CreateBatch(Command):
     ref: str
@@ -25,4 +31,9 @@ class CreateBatch(Command):
 @dataclass
 class ChangeBatchQuantity(Command):
     ref: str
-    qty: int
\ No newline at end of file
+    qty: int
+
+
+@dataclass
+class ImportBatches(Command):
+    batches: List[CreateBatch]
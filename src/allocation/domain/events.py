@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional
+from typing import List, Optional
 
 class Event:
     ...
@@ -34,6 +34,11 @@ class BatchCreated(Event):
     eta: Optional[date] = None
 
 
+@dataclass
+class BatchesCreated(Event):
+    batches: List[BatchCreated]
+
+
 @dataclass
 class AllocationRequired(Event):
     orderid: str
@@ -1,23 +1,55 @@
 from __future__ import annotations
+import bisect
+import itertools
+from collections import deque
 from dataclasses import dataclass
 from datetime import date
-from typing import Optional, List, Set
+from typing import Deque, Dict, Iterable, Iterator, Optional, List, Set, Tuple
 from allocation.domain import commands
 
 import allocation.domain.events as events
 
+# When set, Batch cross-checks its running allocated total against the
+# allocations it holds on every read.
+DEBUG_CHECKS = False
+
+# Products with fewer batches than this sort them on each allocation, which
+# is quicker than building a BatchIndex for them (see bench_allocate).
+INDEX_MIN_BATCHES = 8
+
 
 class Product:
+    _batch_index = None  # type: Optional[BatchIndex]
+
     def __init__(self, sku: str, batches: List[Batch], version_number: int = 0):
         self.sku = sku
         self.batches = batches
         self.version_number = version_number
-        self.events: List[events.Event] = [] # type: List[events.Event]
+        self.events = deque()  # type: Deque[events.Event]
+
+    @property
+    def batch_index(self) -> BatchIndex:
+        index = self._batch_index
+        if index is None or len(index) != len(self.batches):
+            index = self._batch_index = BatchIndex(self.batches)
+        return index
+
+    def _in_allocation_order(self) -> Iterable[Batch]:
+        if len(self.batches) < INDEX_MIN_BATCHES:
+            return sorted(self.batches)
+        return self.batch_index
+
+    def add_batch(self, batch: Batch):
+        self.batches.append(batch)
+        self.version_number += 1
+        if self._batch_index is not None:
+            self._batch_index.add(batch)
 
     def allocate(self, line: OrderLine) -> str:
+        candidates = self._in_allocation_order() if line.qty > 0 else sorted(self.batches)
         try:
             batch = next(
-                b for b in sorted(self.batches) if b.can_allocate(line)
+                b for b in candidates if b.can_allocate(line)
             )
             batch.allocate(line)
             self.version_number += 1
@@ -33,13 +65,110 @@ class Product:
             # raise OutOfStock(f'Out of stock for sku {line.sku}')
             return None
 
+    def allocate_many(self, lines: List[OrderLine]) -> List[Optional[str]]:
+        """
+        Allocates several lines in a single pass over the batches, giving
+        the same allocations and events as calling allocate on each line
+        in turn.
+        """
+        if any(line.qty <= 0 for line in lines):
+            return [self.allocate(line) for line in lines]
+
+        allocated = {}  # type: Dict[int, Batch]
+        pending = list(range(len(lines)))
+        # a copy, as allocating drops exhausted batches from the index
+        for batch in list(self._in_allocation_order()):
+            if not pending:
+                break
+            unallocated = []
+            for n, i in enumerate(pending):
+                if batch.available_quantity <= 0:
+                    unallocated.extend(pending[n:])
+                    break
+                if batch.can_allocate(lines[i]):
+                    batch.allocate(lines[i])
+                    allocated[i] = batch
+                else:
+                    unallocated.append(i)
+            pending = unallocated
+
+        refs = []  # type: List[Optional[str]]
+        for i, line in enumerate(lines):
+            if i not in allocated:
+                self.events.append(events.OutOfStock(line.sku))
+                refs.append(None)
+                continue
+            batch = allocated[i]
+            self.version_number += 1
+            self.events.append(events.Allocated(
+                orderid=line.orderid,
+                sku=line.sku,
+                qty=line.qty,
+                batchref=batch.reference
+            ))
+            refs.append(batch.reference)
+        return refs
+
     def change_batch_quantity(self, ref: str, qty: int):
         batch = next(b for b in self.batches if b.reference == ref)
         batch._purchased_quantity = qty
+        self.version_number += 1
         while batch.available_quantity < 0:
             line = batch.deallocate_one()
             self.events.append(events.Deallocated(
                 line.orderid, line.sku, line.qty))
+        if self._batch_index is not None:
+            self._batch_index.update(batch)
+
+
+class BatchIndex:
+    """
+    The batches of a product that still have stock, kept in allocation
+    order: warehouse stock first, then shipments by ETA, ties broken by
+    the order in which the batches were added (the same order
+    ``sorted(product.batches)`` gives).
+
+    Each batch updates the index it's in as it's allocated or
+    deallocated; a change to its purchased quantity has to be followed by
+    update().
+    """
+
+    def __init__(self, batches: Iterable[Batch]):
+        self._counter = itertools.count()
+        self._keys = {}  # type: Dict[Batch, Tuple]
+        for batch in batches:
+            self._keys[batch] = self._key(batch)
+            batch._index = self
+        self._entries = sorted(
+            key + (batch,)
+            for batch, key in self._keys.items()
+            if batch.available_quantity > 0
+        )
+
+    def _key(self, batch: Batch) -> Tuple:
+        return (batch.eta is not None, batch.eta or date.min, next(self._counter))
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __iter__(self) -> Iterator[Batch]:
+        return (entry[-1] for entry in self._entries)
+
+    def add(self, batch: Batch):
+        key = self._keys[batch] = self._key(batch)
+        batch._index = self
+        if batch.available_quantity > 0:
+            bisect.insort(self._entries, key + (batch,))
+
+    def update(self, batch: Batch):
+        """Drop an exhausted batch from the index, or put a restocked one back."""
+        key = self._keys[batch]
+        i = bisect.bisect_left(self._entries, key)
+        indexed = i < len(self._entries) and self._entries[i][-1] is batch
+        if batch.available_quantity > 0 and not indexed:
+            self._entries.insert(i, key + (batch,))
+        elif batch.available_quantity <= 0 and indexed:
+            del self._entries[i]
 
 
 @dataclass(unsafe_hash=True)
@@ -50,12 +179,20 @@ class OrderLine:
     
 
 class Batch:
+    # running total of self._allocations, None until (re)computed
+    _allocated_quantity = None  # type: Optional[int]
+    # allocated to lines left out of self._allocations, see summarise()
+    _unloaded_quantity = 0
+    # the BatchIndex this batch is in, if any
+    _index = None  # type: Optional[BatchIndex]
+
     def __init__(self, ref: str, sku: str, qty: int, eta: Optional[date]):
         self.reference = ref
         self.sku = sku
         self.eta = eta
         self._purchased_quantity = qty
         self._allocations = set()  # type: Set[OrderLine]
+        self._allocated_quantity = 0
 
     def __repr__(self):
         return f"<Batch {self.reference}>"
@@ -76,16 +213,39 @@ class Batch:
         return self.eta > other.eta
 
     def allocate(self, line: OrderLine):
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self._allocations:
             self._allocations.add(line)
+            # set by can_allocate(); if it weren't, it'd be summed when next read
+            if self._allocated_quantity is not None:
+                self._allocated_quantity += line.qty
+            self._reindex()
 
     def deallocate(self, line: OrderLine):
         if line in self._allocations:
+            allocated = self.allocated_quantity
             self._allocations.remove(line)
+            self._allocated_quantity = allocated - line.qty
+            self._reindex()
+
+    def _reindex(self):
+        if self._index is not None:
+            self._index.update(self)
 
     @property
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        if self._allocated_quantity is None:
+            self._allocated_quantity = self._unloaded_quantity + sum(
+                line.qty for line in self._allocations
+            )
+        elif DEBUG_CHECKS:
+            expected = self._unloaded_quantity + sum(
+                line.qty for line in self._allocations
+            )
+            assert self._allocated_quantity == expected, (
+                f"{self} allocated quantity is {self._allocated_quantity},"
+                f" allocations add up to {expected}"
+            )
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
@@ -94,5 +254,21 @@ class Batch:
     def can_allocate(self, line: OrderLine) -> bool:
         return self.sku == line.sku and self.available_quantity >= line.qty
 
+    def summarise(self, allocated_quantity: int):
+        """
+        For a batch loaded without its allocations: ``allocated_quantity``
+        is the total allocated so far, and _allocations will only hold the
+        lines allocated from now on.
+        """
+        self._unloaded_quantity = self._allocated_quantity = allocated_quantity
+
+    @property
+    def summarised(self) -> bool:
+        return self._unloaded_quantity > 0
+
     def deallocate_one(self) -> OrderLine:
-        return self._allocations.pop()
+        allocated = self.allocated_quantity
+        line = self._allocations.pop()
+        self._allocated_quantity = allocated - line.qty
+        self._reindex()
+        return line
@@ -0,0 +1,117 @@
+"""
+Imports incoming batches in bulk from CSV (with a ref,sku,qty,eta header)
+or NDJSON (one {"ref", "sku", "qty", "eta"} object per line). The input is
+read as a stream and sent to the bus in chunks, one transaction each, so
+memory use does not grow with the size of the file. Importing stops at
+the first invalid row or duplicate reference, with the chunks before it
+imported.
+
+    python -m allocation.entrypoints.bulk_import batches.csv
+    python -m allocation.entrypoints.bulk_import --format ndjson - < batches.ndjson
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import logging
+import sys
+from datetime import datetime
+from typing import Iterable, Iterator, List
+
+from sqlalchemy import exc
+
+from allocation import bootstrap, config
+from allocation.domain import commands
+
+logger = logging.getLogger(__name__)
+
+
+def parse_eta(eta):
+    return datetime.fromisoformat(eta).date() if eta else None
+
+
+def create_batch(data) -> commands.CreateBatch:
+    """The CreateBatch for one row, raising ValueError if it isn't one"""
+    if not isinstance(data, dict) or any(data.get(f) is None for f in ('ref', 'sku', 'qty')):
+        raise ValueError(f'Invalid row {data!r}, ref, sku and qty are required')
+    try:
+        qty = int(data['qty'])
+    except TypeError as e:
+        raise ValueError(f'Invalid qty {data["qty"]!r}') from e
+    return commands.CreateBatch(data['ref'], data['sku'], qty, parse_eta(data.get('eta')))
+
+
+def parse_csv(lines: Iterable[str]) -> Iterator[commands.CreateBatch]:
+    for row in csv.DictReader(lines):
+        # a short row has None for the columns it lacks
+        yield create_batch(row)
+
+
+def parse_ndjson(lines: Iterable[str]) -> Iterator[commands.CreateBatch]:
+    for line in lines:
+        if line.strip():
+            yield create_batch(json.loads(line))
+
+
+PARSERS = {'csv': parse_csv, 'ndjson': parse_ndjson}
+
+
+class ImportFailed(Exception):
+    """Importing stopped at ``error``, once ``imported`` batches were"""
+
+    def __init__(self, imported: int, error: Exception):
+        super().__init__(f'{error} ({imported} batches imported before it)')
+        self.imported = imported
+        self.error = error
+
+    @property
+    def duplicate(self) -> bool:
+        return isinstance(self.error, exc.IntegrityError)
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_batches(bus, lines: Iterable[str], fmt: str, chunk_size: int) -> int:
+    imported = 0
+    try:
+        for chunk in chunked(PARSERS[fmt](lines), chunk_size):
+            bus.handle(commands.ImportBatches(chunk))
+            imported += len(chunk)
+            logger.info('imported %d batches', imported)
+    except (KeyError, ValueError, exc.IntegrityError) as e:
+        raise ImportFailed(imported, e) from e
+    return imported
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Import batches in bulk')
+    parser.add_argument('file', help='file to import, - for stdin')
+    parser.add_argument('--format', choices=sorted(PARSERS), default='csv')
+    parser.add_argument('--chunk-size', type=int, default=config.get_import_chunk_size())
+    args = parser.parse_args()
+
+    bus = bootstrap.bootstrap()
+    try:
+        if args.file == '-':
+            import_batches(bus, sys.stdin, args.format, args.chunk_size)
+        else:
+            with open(args.file, newline='') as lines:
+                import_batches(bus, lines, args.format, args.chunk_size)
+    except ImportFailed as e:
+        logger.error('import failed: %s', e)
+        sys.exit(1)
+    finally:
+        bus.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,24 @@
+import atexit
+import io
 from datetime import datetime
-from flask import Flask, jsonify, request
-from sqlalchemy import create_engine
+from flask import Flask, Response, jsonify, request
+from sqlalchemy import create_engine, exc
 from sqlalchemy.orm import sessionmaker
-from allocation import bootstrap, views
+from allocation import bootstrap, config, metrics, views
+from allocation.entrypoints import bulk_import
 
 from allocation.service_layer import messagebus, unit_of_work
 from allocation.domain import events, commands
 import allocation.adapters.orm as orm
+import allocation.adapters.read_model as read_models
 import allocation.domain.model as model
 import allocation.service_layer.handlers as handlers
 
 app = Flask(__name__)
-bus = bootstrap.bootstrap()
+read_model = read_models.from_settings(**config.get_read_model_settings())
+bus = bootstrap.bootstrap(read_model=read_model)
+# let deferred handlers finish when the server stops
+atexit.register(bus.close)
 
 
 @app.route('/add_batch', methods=["POST"])
@@ -32,6 +39,23 @@ def add_batch():
     return 'OK', 201
 
 
+@app.route('/import_batches', methods=["POST"])
+def import_batches_endpoint():
+    """Import batches in bulk from a CSV or NDJSON request body"""
+    fmt = 'ndjson' if request.mimetype == 'application/x-ndjson' else 'csv'
+    lines = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+    try:
+        imported = bulk_import.import_batches(
+            bus, lines, fmt, config.get_import_chunk_size()
+        )
+    except bulk_import.ImportFailed as e:
+        # the chunks before the failure stay imported
+        if e.duplicate:
+            return {'message': 'Duplicate batch reference', 'imported': e.imported}, 409
+        return {'message': f'Invalid batch: {e.error}', 'imported': e.imported}, 400
+    return {'imported': imported}, 201
+
+
 @app.route('/allocate', methods=['POST'])
 def allocate_endpoint():
     """Allocate"""
@@ -45,11 +69,39 @@ def allocate_endpoint():
 
     return "OK", 202
 
+@app.route('/allocate_order', methods=['POST'])
+def allocate_order_endpoint():
+    """Allocate every line of an order in one transaction"""
+    try:
+        command = commands.AllocateOrder(
+            request.json['orderid'],
+            [(line['sku'], line['qty']) for line in request.json['lines']],
+        )
+        bus.handle(command)
+    except handlers.InvalidSku as e:
+        return {'message': str(e)}, 400
+
+    return "OK", 202
+
 @app.route('/allocations/<orderid>', methods=['GET'])
 def allocations_view_endpoint(orderid):
-    result = views.allocations(orderid, bus.uow)
+    result = views.allocations(orderid, bus.uow, read_model)
 
     if not result:
         return 'not found', 404
 
-    return jsonify(result), 200
\ No newline at end of file
+    return jsonify(result), 200
+
+
+@app.errorhandler(exc.SQLAlchemyError)
+def database_error(e):
+    """Conflicts that outlasted the bus's retries are the client's to retry"""
+    if unit_of_work.is_concurrency_error(e):
+        return {'message': 'Conflicting update, try again'}, 409
+    raise e
+
+
+@app.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics for this process"""
+    return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
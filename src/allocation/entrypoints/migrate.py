@@ -0,0 +1,63 @@
+"""
+Adds the tables, indexes and unique constraints declared in orm.py to an
+existing database. With READ_MODEL=redis, also writes every allocation
+to the Redis read model, which is only kept current from then on; run it
+before switching to that read model. Safe to run more than once.
+
+    python -m allocation.entrypoints.migrate
+"""
+
+import itertools
+import logging
+
+from sqlalchemy import create_engine, select
+
+from allocation import config
+from allocation.adapters import orm
+from allocation.adapters.read_model import RedisReadModel
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    engine = create_engine(config.get_postgres_uri())
+    orm.metadata.create_all(engine)  # only the missing tables
+    created = orm.create_missing_indexes(engine)
+    logger.info("Created %d indexes", len(created))
+    if config.get_read_model_settings()["backend"] == "redis":
+        written = backfill_read_model(engine, RedisReadModel())
+        logger.info("Wrote %d allocations to the Redis read model", written)
+
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+def backfill_read_model(
+    engine, read_model: RedisReadModel, batch_size: int = BACKFILL_BATCH_SIZE,
+) -> int:
+    """
+    Writes every allocation to ``read_model``, ``batch_size`` per round
+    trip, from the allocations themselves rather than allocations_view,
+    which isn't kept current with READ_MODEL=redis. Returns how many.
+    """
+    query = select([
+        orm.order_lines.c.orderid, orm.order_lines.c.sku,
+        orm.batches.c.reference.label("batchref"),
+    ]).select_from(
+        orm.allocations
+        .join(orm.order_lines, orm.allocations.c.orderline_id == orm.order_lines.c.id)
+        .join(orm.batches, orm.allocations.c.batch_id == orm.batches.c.id)
+    )
+    written = 0
+    with engine.connect() as connection:
+        rows = iter(connection.execution_options(stream_results=True).execute(query))
+        # rows have the orderid, sku and batchref that add() takes from events
+        for batch in iter(lambda: list(itertools.islice(rows, batch_size)), []):
+            read_model.add(batch)
+            written += len(batch)
+    return written
+
+
+if __name__ == '__main__':
+    main()
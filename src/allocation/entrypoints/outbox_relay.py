@@ -0,0 +1,42 @@
+"""
+This is an entrypoint that moves events from the outbox table, written by
+the units of work when OUTBOX_ENABLED=1, to Redis.
+
+    python -m allocation.entrypoints.outbox_relay
+"""
+
+import logging
+import signal
+import time
+
+from allocation import config, metrics
+from allocation.adapters import redis_eventpublisher
+from allocation.adapters.outbox import OutboxRelay
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    settings = config.get_outbox_settings()
+    relay = OutboxRelay(
+        unit_of_work.DEFAULT_SESSION_FACTORY,
+        redis_eventpublisher.get_client(),
+        batch_size=settings["batch_size"],
+    )
+    metrics.REGISTRY.register_collector(
+        "outbox", lambda: metrics.samples("allocation_outbox", relay.stats())
+    )
+    # kill -USR1 <pid> logs the outbox lag and relay totals
+    signal.signal(signal.SIGUSR1, metrics.dump)
+    logger.info("Outbox relay starting")
+    while True:
+        sent = relay.relay_once()
+        if sent < settings["batch_size"]:
+            # caught up, so wait for more rather than polling flat out
+            time.sleep(settings["poll_interval"])
+
+
+if __name__ == '__main__':
+    main()
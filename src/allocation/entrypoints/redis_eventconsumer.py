@@ -1,47 +1,295 @@
 """
 This is an entrypoint since data from Redis will come and start executing
 the flow of control all the way from the message bus into the business
-logic."""
+logic.
 
+Messages are read from the pubsub channels in REDIS_CONSUMER_CHANNELS,
+or with REDIS_CONSUMER=streams from Redis streams of the same names, by a
+consumer group, and their commands handled on a pool of threads.
+"""
+
+import functools
 import json
 import logging
-import redis
+import signal
+import time
+from concurrent.futures import Future
+from typing import Optional, Sequence
 
-from allocation import config, bootstrap
-from allocation.adapters import orm
+from allocation import config, bootstrap, metrics
+from allocation.adapters import redis_eventpublisher
 from allocation.domain import commands
-from allocation.service_layer import messagebus, unit_of_work
+from allocation.service_layer.partitions import WorkerPool
 
 logger = logging.getLogger(__name__)
 
-r = redis.Redis(**config.get_redis_host_and_port())
+UNDECODABLE = "allocation_consumer_undecodable_total"
+PUBSUB_MESSAGES = "allocation_pubsub_messages_total"
+STREAM_MESSAGES = "allocation_stream_messages_total"
+STREAM_CLAIMED = "allocation_stream_claimed_total"
+
+
+def change_batch_quantity(data):
+    return commands.ChangeBatchQuantity(ref=data['batchref'], qty=data['qty'])
+
+
+def allocate(data):
+    return commands.Allocate(orderid=data['orderid'], sku=data['sku'], qty=data['qty'])
+
+
+# the command that each channel's messages are decoded to
+COMMANDS = {
+    'change_batch_quantity': change_batch_quantity,
+    'allocate': allocate,
+}
+
+
+def decode(channel: str, data) -> commands.Command:
+    return COMMANDS[channel](json.loads(data))
+
 
 def main():
-    logger.info("Redis pubsub starting")
+    logger.info("Redis consumer starting")
     bus = bootstrap.bootstrap()
-    pubsub = r.pubsub(ignore_subscribe_messages=True)
-    pubsub.subscribe('change_batch_quantity')
+    # kill -USR1 <pid> logs the metrics collected so far
+    signal.signal(signal.SIGUSR1, metrics.dump)
+    settings = config.get_consumer_settings()
+    stream_settings = config.get_stream_consumer_settings()
+    pool = WorkerPool(
+        bus, functools.partial(bootstrap.sku_for_batchref, bus.uow),
+        workers=settings["workers"], queue_size=settings["queue_size"],
+    )
+    metrics.REGISTRY.register_collector(
+        "consumer_pool",
+        lambda: metrics.samples("allocation_consumer", pool.stats(), label="worker"),
+    )
+
+    try:
+        if stream_settings.pop("enabled"):
+            consume_streams(pool, settings["channels"], **stream_settings)
+        else:
+            consume_pubsub(pool, settings["channels"])
+    finally:
+        pool.close()
+        bus.close()
 
+
+def consume_pubsub(pool: WorkerPool, channels: Sequence[str]):
+    """
+    Hands the messages on ``channels`` to ``pool``, waiting while it's
+    full. Redis holds on to the messages sent meanwhile, but only up to
+    its pubsub client-output-buffer-limit, beyond which it disconnects the
+    consumer; streams are safe from that.
+    """
+    pubsub = redis_eventpublisher.get_client().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(*channels)
     for m in pubsub.listen():
-        handle_change_batch_quantity(m, bus)
-    
+        submit(pool, m)
+
 
-def handle_change_batch_quantity(m, bus):
+def submit(pool: WorkerPool, m) -> Optional[Future]:
+    """
+    Hands the command in pubsub message ``m`` to ``pool``, unless it has
+    none. Nobody waits for its outcome, so that's logged and counted when
+    it's done.
+    """
     logger.debug('handling %s', m)
-    data = json.loads(m['data'])
-    cmd = commands.ChangeBatchQuantity(ref=data['batchref'], qty=data['qty'])
-    bus.handle(message=cmd)
+    channel = _text(m['channel'])
+    try:
+        command = decode(channel, m['data'])
+    except Exception:  # pylint: disable=broad-except
+        logger.exception('Cannot decode %s', m)
+        metrics.REGISTRY.inc(UNDECODABLE, (("channel", channel),))
+        return None
+    future = pool.submit(command)
+    future.add_done_callback(functools.partial(_handled, channel, command))
+    return future
 
 
-def handle_allocate(m, bus):
-    logger.debug('handling %s', m)
-    data = json.loads(m['data'])
-    cmd = commands.Allocate(
-        orderid=data['orderid'],
-        sku=data['sku'],
-        qty=data['qty']
+def _handled(channel: str, command: commands.Command, future: Future):
+    error = future.exception()
+    if error is not None:
+        logger.warning('Failed handling %s from %s: %r', command, channel, error)
+    metrics.REGISTRY.inc(
+        PUBSUB_MESSAGES, (("channel", channel), ("result", "ok" if error is None else "error"))
     )
-    bus.handle(message=cmd)
+
+
+def consume_streams(pool: WorkerPool, channels: Sequence[str], **settings):
+    consumer = StreamConsumer(redis_eventpublisher.get_client(), pool, channels, **settings)
+    metrics.REGISTRY.register_collector(
+        "stream_consumer",
+        lambda: metrics.samples("allocation_stream", consumer.stats(), label="stream"),
+    )
+    logger.info("Reading streams as %s in group %s", consumer.consumer, consumer.group)
+    consumer.start()
+    while True:
+        consumer.poll()
+
+
+class StreamConsumer:
+    """
+    Handles the messages on Redis streams as ``consumer`` in the consumer
+    group ``group``, so that the processes sharing a group share its
+    messages. Each stream is named after the channel in COMMANDS whose
+    commands it carries.
+
+    A batch of messages is handed to ``pool`` at once, and acknowledged
+    once the pool has handled them all; one whose consumer died first
+    stays pending, and is claimed by another consumer after ``claim_idle``
+    ms. One that has failed ``max_deliveries`` times, or can't be decoded,
+    is moved to the stream <stream>:dead instead of being retried again.
+    """
+
+    def __init__(
+        self, redis_client, pool: WorkerPool, streams: Sequence[str], group: str,
+        consumer: str, batch_size: int = 100, block: int = 1000,
+        claim_idle: int = 60000, max_deliveries: int = 5,
+    ):
+        self.redis = redis_client
+        self.pool = pool
+        self.streams = list(streams)
+        self.group = group
+        self.consumer = consumer
+        self.batch_size = batch_size
+        self.block = block  # ms to wait for a message
+        self.claim_idle = claim_idle
+        self.max_deliveries = max_deliveries
+        self._claimed_at = None  # type: Optional[float]
+
+    def start(self):
+        """
+        Creates the group on each stream if it's not there yet, then
+        handles the messages this consumer left pending when it last ran
+        """
+        import redis  # pylint: disable=import-outside-toplevel
+        for stream in self.streams:
+            try:
+                # from the start, so that nothing sent before the group was made is missed
+                self.redis.xgroup_create(stream, self.group, id="0", mkstream=True)
+            except redis.exceptions.ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+        # ids after which to read this consumer's pending messages
+        after = {stream: "0" for stream in self.streams}
+        while after:
+            response = self.redis.xreadgroup(
+                self.group, self.consumer, after, count=self.batch_size
+            )
+            read = {_text(stream): entries for stream, entries in response or []}
+            for stream in list(after):
+                if not read.get(stream):
+                    del after[stream]
+                    continue
+                self._handle(stream, read[stream])
+                after[stream] = read[stream][-1][0]
+
+    def poll(self) -> int:
+        """
+        Handles up to ``batch_size`` new messages from each stream, waiting
+        for up to ``block`` ms for there to be any, and those claimed from
+        other consumers, if it's time to look for them. Returns how many
+        messages were handled.
+        """
+        handled = 0
+        if self._claimed_at is None or (
+            time.monotonic() - self._claimed_at >= self.claim_idle / 1000
+        ):
+            handled += self.claim()
+        response = self.redis.xreadgroup(
+            self.group, self.consumer, {stream: ">" for stream in self.streams},
+            count=self.batch_size, block=self.block,
+        )
+        for stream, entries in response or []:
+            handled += self._handle(_text(stream), entries)
+        return handled
+
+    def claim(self) -> int:
+        """Claims and handles the messages that have been pending for too long"""
+        handled = 0
+        for stream in self.streams:
+            start = "0-0"
+            while True:
+                response = self.redis.xautoclaim(
+                    stream, self.group, self.consumer, self.claim_idle,
+                    start_id=start, count=self.batch_size,
+                )
+                start, entries = _text(response[0]), response[1]
+                if entries:
+                    logger.warning('claimed %d idle messages on %s', len(entries), stream)
+                    metrics.REGISTRY.inc(STREAM_CLAIMED, (("stream", stream),), len(entries))
+                    handled += self._handle(stream, entries)
+                if start == "0-0":
+                    break
+        self._claimed_at = time.monotonic()
+        return handled
+
+    def _handle(self, stream, entries) -> int:
+        done, submitted = [], []
+        for message_id, fields in entries:
+            if fields is None:  # trimmed from the stream while it was pending
+                done.append(message_id)
+                continue
+            try:
+                command = decode(stream, fields[b'data'])
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Cannot decode %s from %s', message_id, stream)
+                self._dead_letter(stream, message_id, fields)
+                done.append(message_id)
+                continue
+            submitted.append((message_id, fields, self.pool.submit(command)))
+        for message_id, fields, future in submitted:
+            try:
+                future.result()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.warning('Failed handling %s from %s: %r', message_id, stream, e)
+                self._count(stream, "error")
+                if self._deliveries(stream, message_id) >= self.max_deliveries:
+                    self._dead_letter(stream, message_id, fields)
+                    done.append(message_id)
+                continue
+            self._count(stream, "ok")
+            done.append(message_id)
+        if done:
+            # one acknowledgement for the batch; a crash before it means
+            # the batch is handled again, as handlers must allow for anyway
+            self.redis.xack(stream, self.group, *done)
+        return len(entries)
+
+    def _dead_letter(self, stream, message_id, fields):
+        logger.error('Moving %s from %s to %s:dead', message_id, stream, stream)
+        self.redis.xadd(f"{stream}:dead", fields)
+        self._count(stream, "dead")
+
+    def _deliveries(self, stream, message_id) -> int:
+        pending = self.redis.xpending_range(
+            stream, self.group, min=message_id, max=message_id, count=1
+        )
+        return pending[0]["times_delivered"] if pending else 0
+
+    @staticmethod
+    def _count(stream, result):
+        metrics.REGISTRY.inc(STREAM_MESSAGES, (("stream", stream), ("result", result)))
+
+    def stats(self):
+        """
+        For each stream, the group's lag, the messages it has yet to read,
+        and the messages read but not yet acknowledged
+        """
+        lag, pending = {}, {}
+        for stream in self.streams:
+            for group in self.redis.xinfo_groups(stream):
+                if _text(group["name"]) != self.group:
+                    continue
+                pending[stream] = group["pending"]
+                if group.get("lag") is not None:  # only from Redis 7
+                    lag[stream] = group["lag"]
+        return dict(lag=lag, pending=pending)
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
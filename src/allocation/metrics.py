@@ -0,0 +1,151 @@
+"""
+In-process counters, gauges and latency histograms, rendered in the
+Prometheus text format by the /metrics route of the Flask app.
+"""
+
+import bisect
+import logging
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# seconds
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+
+# (name, value) pairs, sorted by name
+Labels = Tuple[Tuple[str, str], ...]
+Sample = Tuple[str, Labels, float]
+# yields (name, labels, value) samples, read when metrics are rendered
+Collector = Callable[[], Iterable[Sample]]
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)  # type: Dict[Tuple[str, Labels], float]
+        self._gauges = {}  # type: Dict[Tuple[str, Labels], float]
+        self._histograms = {}  # type: Dict[Tuple[str, Labels], Histogram]
+        self._collectors = {}  # type: Dict[str, Collector]
+
+    def inc(self, name: str, labels: Labels = (), amount: float = 1):
+        with self._lock:
+            self._counters[name, labels] += amount
+
+    def set(self, name: str, value: float, labels: Labels = ()):
+        with self._lock:
+            self._gauges[name, labels] = value
+
+    def observe(
+        self, name: str, value: float, labels: Labels = (), buckets=DEFAULT_BUCKETS,
+    ):
+        """``buckets`` are those of the histogram, if this creates it"""
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[name, labels] = Histogram(buckets)
+            histogram.observe(value)
+
+    def register_collector(self, key: str, collector: Collector):
+        """Adds gauges read from ``collector``, replacing any under ``key``"""
+        with self._lock:
+            self._collectors[key] = collector
+
+    def counter(self, name: str, labels: Labels = ()) -> float:
+        return self._counters.get((name, labels), 0)
+
+    def histogram(self, name: str, labels: Labels = ()) -> Optional[Histogram]:
+        return self._histograms.get((name, labels))
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+            self._collectors.clear()
+
+    def render(self) -> str:
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = {
+                key: (h.buckets, list(h.counts), h.sum, h.count)
+                for key, h in self._histograms.items()
+            }
+            collectors = list(self._collectors.values())
+        for collector in collectors:
+            try:
+                for name, labels, value in collector():
+                    gauges[name, labels] = value
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Exception collecting metrics from %s', collector)
+
+        lines = []  # type: List[str]
+        for kind, series in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({name for name, _ in series}):
+                lines.append(f"# TYPE {name} {kind}")
+                for (sample_name, labels), value in sorted(series.items()):
+                    if sample_name == name:
+                        lines.append(f"{name}{_format(labels)} {value}")
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (sample_name, labels), (buckets, counts, total, count) in sorted(
+                histograms.items(), key=lambda item: item[0]
+            ):
+                if sample_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(buckets + ("+Inf",), counts):
+                    cumulative += bucket_count
+                    le = labels + (("le", str(bound)),)
+                    lines.append(f"{name}_bucket{_format(le)} {cumulative}")
+                lines.append(f"{name}_sum{_format(labels)} {total}")
+                lines.append(f"{name}_count{_format(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _format(labels: Labels) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in labels
+    )
+    return "{" + pairs + "}"
+
+
+def samples(prefix: str, stats: Dict, label: str = "name") -> Iterator[Sample]:
+    """
+    Collector samples from a stats() dict: numbers become gauges named
+    ``prefix``_key, and dicts of numbers one gauge per entry, labelled.
+    """
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            for name, number in value.items():
+                yield f"{prefix}_{key}", ((label, str(name)),), number
+        elif isinstance(value, (int, float)):
+            yield f"{prefix}_{key}", (), value
+
+
+REGISTRY = Registry()
+
+
+def dump(*_):
+    """Logs every metric; a signal handler for processes without /metrics"""
+    logger.info("metrics:\n%s", REGISTRY.render())
@@ -0,0 +1,89 @@
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class DeferredHandlers:
+    """
+    Runs event handlers that nothing waits on (see handlers.DEFERRED_HANDLERS)
+    on a pool of ``workers`` threads, so that a slow SMTP server or Redis
+    doesn't hold up the message that raised the event.
+
+    At most ``queue_size`` calls wait for a thread; beyond that, deferring
+    blocks until one finishes. Deferred handlers can't raise new events,
+    and their errors are logged and counted per handler rather than
+    reaching the bus.
+    """
+
+    def __init__(self, workers: int = 4, queue_size: int = 1000):
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="deferred")
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self._closed = False
+        self.completed = Counter()  # type: Counter[str]
+        self.errors = Counter()  # type: Counter[str]
+        self.in_flight = 0
+        self.backpressure_waits = 0
+
+    def defer(self, name: str, handler: Callable) -> Callable:
+        def deferred(message):
+            self.submit(name, handler, message)
+        deferred.__name__ = deferred.__qualname__ = f"{name} (deferred)"
+        return deferred
+
+    def submit(self, name: str, handler: Callable, message):
+        if self._closed:
+            # shutting down: nothing left to run it later
+            self._run(name, handler, message)
+            return
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.backpressure_waits += 1
+            self._slots.acquire()
+        with self._lock:
+            self.in_flight += 1
+        try:
+            self._executor.submit(self._run_and_release, name, handler, message)
+        except RuntimeError:  # shut down since the check above
+            self._release()
+            self._run(name, handler, message)
+
+    def _run_and_release(self, name, handler, message):
+        try:
+            self._run(name, handler, message)
+        finally:
+            self._release()
+
+    def _release(self):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def _run(self, name, handler, message):
+        try:
+            handler(message)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Exception in deferred handler %s for %s', name, message)
+            with self._lock:
+                self.errors[name] += 1
+        else:
+            with self._lock:
+                self.completed[name] += 1
+
+    def shutdown(self):
+        """Waits for every deferred call to finish"""
+        self._closed = True
+        self._executor.shutdown(wait=True)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                in_flight=self.in_flight,
+                backpressure_waits=self.backpressure_waits,
+                completed=dict(self.completed),
+                errors=dict(self.errors),
+            )
@@ -0,0 +1,257 @@
+"""
+How handlers are called, worked out once when the bus is built: their
+dependencies bound, and the middleware each call goes through wrapped
+around them.
+
+A middleware is called with a handler and the call standing in for it
+so far, and returns the call to use instead: a wrapper around it, or the
+same call if it has nothing to do for that handler, which then costs
+nothing when it's handled.
+"""
+import functools
+import inspect
+import logging
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence
+
+from tenacity import (
+    Retrying, retry_if_exception, stop_after_attempt, wait_random_exponential,
+)
+
+from allocation import metrics
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+Middleware = Callable[[Callable, Callable], Callable]
+
+HANDLER_SECONDS = "allocation_handler_seconds"
+HANDLER_ERRORS = "allocation_handler_errors_total"
+CONCURRENCY_CONFLICTS = "allocation_concurrency_conflicts_total"
+CONCURRENCY_RETRIES = "allocation_concurrency_retries_total"
+
+# kinds of Route
+COMMAND, EVENT, COALESCED = "command", "event", "coalesced"
+
+
+def _not_a_command(message):
+    raise TypeError(f'{message} is not a command')
+
+
+class Route(NamedTuple):
+    """What the bus does with a message of one type"""
+    kind: str
+    # metric labels for the message type, and for its outcomes
+    labels: metrics.Labels
+    ok_labels: metrics.Labels
+    error_labels: metrics.Labels
+    # a command's handler, or an event's handlers
+    command_handler: Callable = _not_a_command
+    event_handlers: Sequence[Callable] = ()
+
+
+def route(
+    kind: str, message_type: type,
+    command_handler: Callable = _not_a_command, event_handlers: Sequence[Callable] = (),
+) -> Route:
+    labels = (("message", message_type.__name__),)  # type: metrics.Labels
+    return Route(
+        kind, labels, labels + (("result", "ok"),), labels + (("result", "error"),),
+        command_handler, event_handlers,
+    )
+
+
+def routes(
+    command_handlers: Dict[type, Callable],
+    event_handlers: Dict[type, List[Callable]],
+    coalesced_event_handlers: Dict[type, List[Callable]],
+) -> Dict[type, Route]:
+    """The Route for each message type, looked up once per message"""
+    plan = {}  # type: Dict[type, Route]
+    for event_type, handlers in event_handlers.items():
+        plan[event_type] = route(EVENT, event_type, event_handlers=handlers)
+    for event_type, handlers in coalesced_event_handlers.items():
+        plan[event_type] = route(COALESCED, event_type, event_handlers=handlers)
+    for command_type, handler in command_handlers.items():
+        plan[command_type] = route(COMMAND, command_type, command_handler=handler)
+    return plan
+
+
+def bind(handler: Callable, dependencies: Dict) -> Callable:
+    """
+    ``handler`` as a function of the message alone, with the dependencies
+    its signature names passed after it, in order
+    """
+    params = list(inspect.signature(handler).parameters)[1:]
+    args = tuple(dependencies[name] for name in params if name in dependencies)
+    if len(args) < len(params):
+        # some are left to their defaults, so the rest must go by name
+        kwargs = {name: dependencies[name] for name in params if name in dependencies}
+        return _named(functools.partial(handler, **kwargs), handler)
+    if inspect.iscoroutinefunction(handler):
+        async def awaited(message):
+            return await handler(message, *args)
+        return _named(awaited, handler)
+    if not args:
+        return handler
+    if len(args) == 1:
+        [arg] = args
+
+        def bound_one(message):
+            return handler(message, arg)
+        return _named(bound_one, handler)
+
+    def bound(message):
+        return handler(message, *args)
+    return _named(bound, handler)
+
+
+def chain(handler: Callable, call: Callable, middleware: Sequence[Middleware]) -> Callable:
+    """``call`` wrapped in ``middleware``, the first outermost"""
+    for wrap in reversed(middleware):
+        call = wrap(handler, call)
+    return call
+
+
+def _named(call, handler):
+    # named after the handler, for logs and metrics
+    call.__name__ = call.__qualname__ = handler.__name__
+    return call
+
+
+def _uses_uow(handler: Callable) -> bool:
+    return "uow" in inspect.signature(handler).parameters
+
+
+def _sku(message) -> str:
+    """The SKU a message, or run of events, is about, for metric labels"""
+    if isinstance(message, list):
+        message = message[0]
+    return getattr(message, "sku", None) or ""
+
+
+def timed(handler: Callable, call: Callable) -> Callable:
+    """Records each call's duration, and counts its errors and conflicts"""
+    labels = (("handler", handler.__name__),)
+    observe, inc = metrics.REGISTRY.observe, metrics.REGISTRY.inc
+
+    def failed(e, message):
+        inc(HANDLER_ERRORS, labels)
+        if unit_of_work.is_concurrency_error(e):
+            inc(CONCURRENCY_CONFLICTS, (("sku", _sku(message)),))
+
+    if inspect.iscoroutinefunction(call):
+        async def timed_await(message):
+            start = time.perf_counter()
+            try:
+                return await call(message)
+            except Exception as e:
+                failed(e, message)
+                raise
+            finally:
+                observe(HANDLER_SECONDS, time.perf_counter() - start, labels)
+        return _named(timed_await, handler)
+
+    def timed_call(message):
+        start = time.perf_counter()
+        try:
+            return call(message)
+        except Exception as e:
+            failed(e, message)
+            raise
+        finally:
+            observe(HANDLER_SECONDS, time.perf_counter() - start, labels)
+    return _named(timed_call, handler)
+
+
+def traced(handler: Callable, call: Callable) -> Callable:
+    """Logs each call and how long it took, at debug level"""
+    if inspect.iscoroutinefunction(call):
+        return call
+
+    def traced_call(message):
+        logger.debug('calling %s with %s', handler.__name__, message)
+        start = time.perf_counter()
+        try:
+            return call(message)
+        finally:
+            logger.debug(
+                '%s returned after %.1f ms', handler.__name__,
+                (time.perf_counter() - start) * 1000,
+            )
+    return _named(traced_call, handler)
+
+
+def concurrency_retry(attempts: int, wait: float, max_wait: float) -> Retrying:
+    """
+    Up to ``attempts`` calls in all, sleeping for a random time of up to
+    ``wait`` seconds after the first conflict, doubling after each one up
+    to ``max_wait``, so that callers which collided don't collide again
+    """
+    return Retrying(
+        stop=stop_after_attempt(attempts),
+        wait=wait_random_exponential(multiplier=wait, max=max_wait),
+        retry=retry_if_exception(unit_of_work.is_concurrency_error),
+        reraise=True,
+    )
+
+
+def retrying(retry: Retrying, uow: unit_of_work.AbstractUnitOfWork) -> Middleware:
+    """
+    Calls handlers that use the unit of work again, as ``retry`` (see
+    concurrency_retry()) says, when another transaction changed the same
+    product first. Not within ``uow.group()``, where the conflict would
+    only recur.
+    """
+    def middleware(handler, call):
+        if not _uses_uow(handler) or inspect.iscoroutinefunction(call):
+            return call
+
+        def retried_call(message):
+            if uow.grouped:
+                return call(message)
+            labels = (("sku", _sku(message)),)
+
+            def before_sleep(retry_state):
+                metrics.REGISTRY.inc(CONCURRENCY_RETRIES, labels)
+                logger.info(
+                    'Retrying %s for %s after attempt %d conflicted',
+                    handler.__name__, message, retry_state.attempt_number,
+                )
+
+            return retry.copy(before_sleep=before_sleep)(call, message)
+        return _named(retried_call, handler)
+    return middleware
+
+
+def transactional(uow: unit_of_work.AbstractUnitOfWork) -> Middleware:
+    """
+    Runs each call of a handler that uses the unit of work in one
+    ``uow.group()`` transaction, so that all of its ``with uow:`` blocks
+    commit together or not at all
+    """
+    def middleware(handler, call):
+        if not _uses_uow(handler) or inspect.iscoroutinefunction(call):
+            return call
+
+        def call_in_transaction(message):
+            if uow.grouped:
+                return call(message)
+            with uow.group():
+                return call(message)
+        return _named(call_in_transaction, handler)
+    return middleware
+
+
+def default_middleware(
+    uow: unit_of_work.AbstractUnitOfWork, retry: Optional[Retrying] = None,
+    trace: bool = False,
+) -> List[Middleware]:
+    middleware = []  # type: List[Middleware]
+    if trace:
+        middleware.append(traced)
+    if retry is not None:
+        middleware.append(retrying(retry, uow))
+    # inside retrying, so that every attempt is timed
+    middleware.append(timed)
+    return middleware
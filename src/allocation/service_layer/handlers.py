@@ -1,8 +1,10 @@
+from collections import defaultdict
 from dataclasses import asdict
-from typing import Callable, Dict, List
+from typing import Callable, Dict, List, Union
 
 from allocation.domain import commands, events
 from allocation.adapters import notifications, redis_eventpublisher
+from allocation.adapters.read_model import AllocationsCache, RedisReadModel
 from allocation.domain.model import OrderLine
 from allocation.service_layer import unit_of_work
 import allocation.domain.model as model
@@ -30,6 +32,25 @@ def allocate(
         product.allocate(line)
         uow.commit()
 
+def allocate_order(
+    command: commands.AllocateOrder,
+    uow: unit_of_work.AbstractUnitOfWork
+):
+    lines_by_sku = defaultdict(list)  # type: Dict[str, List[OrderLine]]
+    for sku, qty in command.lines:
+        lines_by_sku[sku].append(OrderLine(command.orderid, sku, qty))
+
+    with uow:
+        products = {p.sku: p for p in uow.products.get_many(lines_by_sku)}
+        for sku, lines in lines_by_sku.items():
+            product = products.get(sku)
+
+            if product is None:
+                raise InvalidSku(f'Invalid sku {sku}')
+
+            product.allocate_many(lines)
+        uow.commit()
+
 def add_batch(
     event: events.BatchCreated, uow: unit_of_work.AbstractUnitOfWork,
 ):
@@ -38,7 +59,17 @@ def add_batch(
         if product is None:
             product = model.Product(event.sku, batches=[])
             uow.products.add(product)
-        product.batches.append(model.Batch(event.ref, event.sku, event.qty, event.eta))
+        product.add_batch(model.Batch(event.ref, event.sku, event.qty, event.eta))
+        uow.commit()
+
+
+def import_batches(
+    command: commands.ImportBatches, uow: unit_of_work.AbstractUnitOfWork,
+):
+    with uow:
+        uow.products.add_batches([
+            model.Batch(b.ref, b.sku, b.qty, b.eta) for b in command.batches
+        ])
         uow.commit()
 
 
@@ -50,6 +81,14 @@ def send_out_of_stock_notification(
         f'Out of stock for {event.sku}'
     )
 
+async def send_out_of_stock_notification_async(
+    event: events.OutOfStock, notifications: notifications.AbstractNotifications
+):
+    await notifications.send(
+        'stock@made.com',
+        f'Out of stock for {event.sku}'
+    )
+
 def change_batch_quantity(
     event: events.BatchQuantityChanged, uow: unit_of_work.AbstractUnitOfWork
 ):
@@ -65,6 +104,13 @@ def publish_allocated_event(
     publish('line_allocated', event)
 
 
+async def publish_allocated_event_async(
+    event: events.Allocated,
+    publish: Callable
+):
+    await publish('line_allocated', event)
+
+
 def add_allocation_to_read_model(
     event: events.Allocated,
     uow: unit_of_work.AbstractUnitOfWork
@@ -94,21 +140,148 @@ def reallocate(
 ):
     allocate(commands.Allocate(**asdict(event)), uow=uow)
 
-# def add_allocation_to_read_model(event: events.Allocated, _):
-#     redis_eventpublisher.update_readmodel(event.orderid, event.sku, event.batchref)
 
-# def remove_allocation_from_read_model(event: events.Deallocated, _):
-#     redis_eventpublisher.update_readmodel(event.orderid, event.sku, None)
+# coalesced handlers, given a run of consecutive events of one type
+
+def publish_allocated_events(
+    allocated: List[events.Allocated],
+    publish: Callable
+):
+    for event in allocated:
+        publish('line_allocated', event)
+
+
+def add_allocations_to_read_model(
+    allocated: List[events.Allocated],
+    uow: unit_of_work.AbstractUnitOfWork
+):
+    with uow:
+        uow.session.execute(
+            'INSERT INTO allocations_view (orderid, sku, batchref)'
+            ' VALUES (:orderid, :sku, :batchref)',
+            [dict(orderid=e.orderid, sku=e.sku, batchref=e.batchref) for e in allocated]
+        )
+        uow.commit()
+
+
+def reallocate_many(
+    deallocated: List[events.Deallocated],
+    uow: unit_of_work.AbstractUnitOfWork,
+):
+    """
+    What remove_allocation_from_read_model and reallocate do for each
+    event, in one unit of work.
+    """
+    # a single unit of work: the events of any but the last would be lost,
+    # as each starts a new repository
+    with uow:
+        uow.session.execute(
+            'DELETE FROM allocations_view'
+            ' WHERE orderid = :orderid AND sku = :sku',
+            [dict(orderid=e.orderid, sku=e.sku) for e in deallocated]
+        )
+        _reallocate(deallocated, uow)
+        uow.commit()
+
+
+def _reallocate(deallocated: List[events.Deallocated], uow: unit_of_work.AbstractUnitOfWork):
+    lines_by_sku = defaultdict(list)  # type: Dict[str, List[OrderLine]]
+    for event in deallocated:
+        lines_by_sku[event.sku].append(OrderLine(event.orderid, event.sku, event.qty))
+    products = {p.sku: p for p in uow.products.get_many(lines_by_sku)}
+    for sku, lines in lines_by_sku.items():
+        product = products.get(sku)
+        if product is None:
+            raise InvalidSku(f'Invalid sku {sku}')
+        product.allocate_many(lines)
+
+
+# the read model kept in Redis instead of allocations_view
+
+def add_allocation_to_redis_read_model(event: events.Allocated, read_model: RedisReadModel):
+    read_model.add([event])
+
+def remove_allocation_from_redis_read_model(
+    event: events.Deallocated, read_model: RedisReadModel
+):
+    read_model.remove([event])
+
+def add_allocations_to_redis_read_model(
+    allocated: List[events.Allocated], read_model: RedisReadModel
+):
+    read_model.add(allocated)
+
+def reallocate_many_with_redis_read_model(
+    deallocated: List[events.Deallocated],
+    uow: unit_of_work.AbstractUnitOfWork,
+    read_model: RedisReadModel,
+):
+    read_model.remove(deallocated)
+    with uow:
+        _reallocate(deallocated, uow)
+        uow.commit()
+
+
+# and allocations_view's cached queries, invalidated once it's changed
+
+def invalidate_cached_allocation(
+    event: Union[events.Allocated, events.Deallocated], read_model: AllocationsCache
+):
+    read_model.invalidate([event.orderid])
+
+def invalidate_cached_allocations(
+    run: List[Union[events.Allocated, events.Deallocated]], read_model: AllocationsCache
+):
+    read_model.invalidate(event.orderid for event in run)
 
 
 EVENT_HANDLERS: Dict[events.Event, List[Callable]] = {
     events.Allocated: [publish_allocated_event, add_allocation_to_read_model],
     events.Deallocated: [remove_allocation_from_read_model, reallocate],
     events.OutOfStock: [send_out_of_stock_notification],
+    events.BatchesCreated: [],
+}
+
+# used by the sync buses in place of EVENT_HANDLERS for these events
+COALESCED_EVENT_HANDLERS: Dict[events.Event, List[Callable]] = {
+    events.Allocated: [publish_allocated_events, add_allocations_to_read_model],
+    events.Deallocated: [reallocate_many],
+}
+
+# handlers that nothing waits on, run on a thread pool when
+# DEFERRED_HANDLER_THREADS is set (see deferred.DeferredHandlers)
+DEFERRED_HANDLERS = {
+    send_out_of_stock_notification, publish_allocated_event, publish_allocated_events,
+}
+
+# for messagebus.AsyncMessageBus, with async adapters for Redis and email
+ASYNC_EVENT_HANDLERS: Dict[events.Event, List[Callable]] = {
+    **EVENT_HANDLERS,
+    events.Allocated: [publish_allocated_event_async, add_allocation_to_read_model],
+    events.OutOfStock: [send_out_of_stock_notification_async],
+}
+
+# in place of the read model handlers above, by bootstrap, with the read
+# model in Redis (READ_MODEL=redis), or allocations_view's queries cached
+REDIS_READ_MODEL_HANDLERS: Dict[Callable, List[Callable]] = {
+    add_allocation_to_read_model: [add_allocation_to_redis_read_model],
+    remove_allocation_from_read_model: [remove_allocation_from_redis_read_model],
+    add_allocations_to_read_model: [add_allocations_to_redis_read_model],
+    reallocate_many: [reallocate_many_with_redis_read_model],
+}
+CACHED_READ_MODEL_HANDLERS: Dict[Callable, List[Callable]] = {
+    add_allocation_to_read_model: [add_allocation_to_read_model, invalidate_cached_allocation],
+    remove_allocation_from_read_model: [
+        remove_allocation_from_read_model, invalidate_cached_allocation,
+    ],
+    add_allocations_to_read_model: [add_allocations_to_read_model, invalidate_cached_allocations],
+    reallocate_many: [reallocate_many, invalidate_cached_allocations],
 }
 
 COMMAND_HANDLERS: Dict[commands.Command, List[Callable]] = {
     commands.Allocate: allocate,
+    commands.AllocateOrder: allocate_order,
     commands.CreateBatch: add_batch,
     commands.ChangeBatchQuantity: change_batch_quantity,
+    commands.ImportBatches: import_batches,
 }
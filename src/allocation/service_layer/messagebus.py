@@ -1,58 +1,376 @@
+import asyncio
 import email
 import logging
-from typing import Callable, Dict, List, Type, Union
-from tenacity import Retrying, RetryError, stop_after_attempt, wait_exponential
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import (
+    Callable, Deque, Dict, List, Optional, Protocol, Tuple, Type, Union, cast,
+)
 
+from allocation import metrics
 from allocation.domain import commands, events
-from allocation.service_layer import handlers, unit_of_work
+from allocation.service_layer import dispatch, handlers, unit_of_work
+from allocation.service_layer.deferred import DeferredHandlers
 
 logger = logging.getLogger(__name__)
 
 Message = Union[commands.Command, events.Event]
 
+
+class Publisher(Protocol):
+    """
+    What the bus needs of a publisher that buffers the events handlers
+    publish through it, such as RedisEventPublisher
+    """
+
+    def end_cycle(self):
+        """Called when a message and its events have been handled"""
+
+    def close(self):
+        """Called when the bus is closed"""
+
 class MessageBus:
     def __init__(
         self, uow: unit_of_work.AbstractUnitOfWork,
         event_handlers: Dict[Type[events.Event], List[Callable]],
-        command_handlers: Dict[Type[commands.Command], List[Callable]]
+        command_handlers: Dict[Type[commands.Command], Callable],
+        coalesced_event_handlers: Optional[Dict[Type[events.Event], List[Callable]]] = None,
+        deferred: Optional[DeferredHandlers] = None,
+        publisher: Optional[Publisher] = None,
     ):
+        """
+        For event types in ``coalesced_event_handlers``, a run of
+        consecutive events of that type in the queue is taken at once and
+        each of those handlers is called once, with the list of events,
+        instead of the handlers in ``event_handlers``.
+
+        Handlers are called as they are given, bootstrap having bound
+        their dependencies and wrapped them in middleware. ``publisher``,
+        if they publish through one, is told when each message is done.
+        """
         self.uow = uow
         self._event_handlers = event_handlers
         self._command_handlers = command_handlers
-        self._queue = []
+        self._coalesced_event_handlers = coalesced_event_handlers or {}
+        self._routes = dispatch.routes(
+            command_handlers, event_handlers, self._coalesced_event_handlers
+        )
+        self.deferred = deferred
+        self.publisher = publisher
+
+    def close(self):
+        """Waits for the deferred handlers still running, if any, then the publisher"""
+        if self.deferred is not None:
+            self.deferred.shutdown()
+        if self.publisher is not None:
+            self.publisher.close()
 
     def handle(self, message: Message):
+        # local, so that threads can share the bus
+        return self._handle_all(deque([(message, 0)]))
+
+    def _handle_all(self, pending: Deque[Tuple[Message, int]]):
+        """Handles ``pending`` messages, at their cascade depths, and every event they raise"""
         results = []
-        self._queue = [message]
-        while self._queue:
-            message = self._queue.pop(0)
-            if isinstance(message, events.Event):
-                self._handle_event(message, self._queue)
-            elif isinstance(message, commands.Command):
-                cmd_result = self._handle_command(message, self._queue)
-                results.append(cmd_result)
+        max_depth = max_length = 0
+        try:
+            while pending:
+                max_length = max(max_length, len(pending))
+                message, depth = pending.popleft()
+                max_depth = max(max_depth, depth)
+                new_messages = deque()  # type: Deque[Message]
+                route = self._routes.get(type(message))
+                if route is None:
+                    raise Exception(f'{message} was not an Event of Command')
+                # the route's kind says which the message is
+                if route.kind is dispatch.COMMAND:
+                    cmd_result = self._handle_command(
+                        cast(commands.Command, message), route, new_messages
+                    )
+                    results.append(cmd_result)
+                elif route.kind is dispatch.COALESCED:
+                    run = [cast(events.Event, message)]
+                    while pending and type(pending[0][0]) is type(message):
+                        run.append(cast(events.Event, pending.popleft()[0]))
+                    self._handle_events(run, route, new_messages)
+                else:
+                    self._handle_event(cast(events.Event, message), route, new_messages)
+                if new_messages:
+                    pending.extend((m, depth + 1) for m in new_messages)
+        finally:
+            metrics.REGISTRY.observe(CASCADE_DEPTH, max_depth, buckets=DEPTH_BUCKETS)
+            metrics.REGISTRY.set(QUEUE_LENGTH, max_length)
+            if self.publisher is not None:
+                self.publisher.end_cycle()
+        return results
+
+    def _handle_event(self, event: events.Event, route: dispatch.Route, queue: Deque):
+        start = time.perf_counter()
+        for handler in route.event_handlers:
+            try:
+                logger.debug('handling event %s with handler %s', event, handler)
+                handler(event)
+                queue.extend(self.uow.collect_new_events())
+            except Exception as e:
+                logger.error('Exception handling event %s: %s', event, e)
+                continue
+        _record_message(route, start, ok=True)
+
+    def _handle_events(self, run: List[events.Event], route: dispatch.Route, queue: Deque):
+        start = time.perf_counter()
+        for handler in route.event_handlers:
+            try:
+                logger.debug('handling %d events %s with handler %s', len(run), run[0], handler)
+                handler(run)
+                queue.extend(self.uow.collect_new_events())
+            except Exception as e:
+                logger.error('Exception handling %d events %s: %s', len(run), run[0], e)
+                continue
+        _record_message(route, start, ok=True, count=len(run))
+
+    def _handle_command(self, command: commands.Command, route: dispatch.Route, queue: Deque):
+        logger.debug('handling command %s', command)
+        start = time.perf_counter()
+        try:
+            result = route.command_handler(command)
+            queue.extend(self.uow.collect_new_events())
+        except Exception:
+            _record_message(route, start, ok=False)
+            logger.exception('Exception handling command %s', command)
+            raise
+        _record_message(route, start, ok=True)
+        return result
+
+
+MESSAGE_SECONDS = "allocation_message_seconds"
+MESSAGES = "allocation_messages_total"
+CASCADE_DEPTH = "allocation_cascade_depth"
+DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32)
+QUEUE_LENGTH = "allocation_bus_queue_length"
+
+
+def _record_message(route: dispatch.Route, start: float, ok: bool, count: int = 1):
+    """
+    Counts ``count`` messages of ``route``'s type, and the time since
+    ``start`` taken to handle them
+    """
+    metrics.REGISTRY.observe(MESSAGE_SECONDS, time.perf_counter() - start, route.labels)
+    metrics.REGISTRY.inc(MESSAGES, route.ok_labels if ok else route.error_labels, count)
+
+
+# a grouped message, its caller's future, and what _handle_held() returned or raised
+_Outcome = Tuple[Message, Future, Optional[Tuple[List, Deque]], Optional[Exception]]
+
+
+class GroupCommitMessageBus(MessageBus):
+    """
+    Handles messages on one worker thread, which takes whatever arrives
+    within ``window`` seconds of the first message, up to ``max_size``
+    messages, and handles them all in one ``uow.group()`` transaction.
+
+    Each command gets a savepoint, so one that fails is rolled back alone
+    and its exception is raised to its caller; the others are committed
+    together. The events they raise are held until the group has
+    committed, and then handled as MessageBus would, so nothing is
+    published for work that is rolled back. Callers block in handle()
+    until their events are handled. If the group's commit fails, every
+    caller in it gets the exception, and the held events are dropped.
+
+    Within the group's transaction a conflict would only recur, so with
+    ``rerun_conflicts``, messages that conflict with another transaction,
+    or whose group does, are handled again after it, each in a
+    transaction of its own (and retried from there, if the handlers are,
+    see dispatch.retrying). Without it, their callers get the conflict.
+    """
+
+    def __init__(
+        self, uow: unit_of_work.AbstractUnitOfWork,
+        event_handlers: Dict[Type[events.Event], List[Callable]],
+        command_handlers: Dict[Type[commands.Command], Callable],
+        max_size: int = 50,
+        window: float = 0.005,
+        coalesced_event_handlers: Optional[Dict[Type[events.Event], List[Callable]]] = None,
+        deferred: Optional[DeferredHandlers] = None,
+        publisher: Optional[Publisher] = None,
+        rerun_conflicts: bool = False,
+    ):
+        super().__init__(
+            uow, event_handlers, command_handlers, coalesced_event_handlers, deferred,
+            publisher,
+        )
+        self.max_size = max_size
+        self.window = window
+        self.rerun_conflicts = rerun_conflicts
+        self._requests = queue.Queue()  # type: queue.Queue[Optional[Tuple[Message, Future]]]
+        self._worker = threading.Thread(
+            target=self._run, name="group-commit", daemon=True
+        )
+        self._worker.start()
+
+    def handle(self, message: Message):
+        future = Future()  # type: Future
+        self._requests.put((message, future))
+        return future.result()
+
+    def close(self):
+        """Handle the messages already submitted, then stop the worker"""
+        self._requests.put(None)
+        self._worker.join()
+        super().close()
+
+    def _run(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            group = [request]
+            deadline = time.monotonic() + self.window
+            while len(group) < self.max_size:
+                try:
+                    request = self._requests.get(
+                        timeout=max(deadline - time.monotonic(), 0)
+                    )
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._handle_group(group)
+                    return
+                group.append(request)
+            self._handle_group(group)
+
+    def _handle_held(self, message: Message):
+        """
+        Handles a command, returning its result and the events it raised,
+        not yet handled. An event is held as it is.
+        """
+        route = self._routes.get(type(message))
+        if route is None:
+            raise Exception(f'{message} was not an Event of Command')
+        if route.kind is not dispatch.COMMAND:
+            return [], deque([(message, 0)])
+        raised = deque()  # type: Deque[Message]
+        result = self._handle_command(cast(commands.Command, message), route, raised)
+        return [result], deque((event, 1) for event in raised)
+
+    def _handle_group(self, group: List[Tuple[Message, Future]]):
+        outcomes = []  # type: List[_Outcome]
+        try:
+            with self.uow.group():
+                for message, future in group:
+                    try:
+                        outcomes.append((message, future, self._handle_held(message), None))
+                    except Exception as e:  # pylint: disable=broad-except
+                        outcomes.append((message, future, None, e))
+        except Exception as e:  # pylint: disable=broad-except
+            if not (self.rerun_conflicts and unit_of_work.is_concurrency_error(e)):
+                logger.exception('Exception committing a group of %d messages', len(group))
+                for _, future in group:
+                    future.set_exception(e)
+                return
+            logger.info('A group of %d messages conflicted, handling each alone', len(group))
+            outcomes = [(message, future, None, e) for message, future in group]
+        for message, future, held, error in outcomes:
+            try:
+                if (
+                    error is not None and self.rerun_conflicts
+                    and unit_of_work.is_concurrency_error(error)
+                ):
+                    result, error = super().handle(message), None
+                elif held is not None:
+                    results, raised = held
+                    result = results + self._handle_all(raised)
+            except Exception as e:  # pylint: disable=broad-except
+                error = e
+            if error is not None:
+                future.set_exception(error)
             else:
+                future.set_result(result)
+
+
+class AsyncMessageBus:
+    """
+    A message bus for asyncio code, with the same semantics as MessageBus:
+    errors from command handlers are raised, errors from event handlers
+    are logged, and the events a message raises are handled, in order,
+    before handle() returns.
+
+    ``async def`` handlers are awaited on the event loop. They must not
+    use the unit of work. Other handlers block on the database, so they
+    run on ``executor``'s threads, each with its own session, and any
+    events they raise are collected on the same thread. Every handle()
+    call keeps its own queue, so many can run at once.
+    """
+
+    def __init__(
+        self, uow: unit_of_work.AbstractUnitOfWork,
+        event_handlers: Dict[Type[events.Event], List[Callable]],
+        command_handlers: Dict[Type[commands.Command], Callable],
+        executor: Optional[Executor] = None,
+    ):
+        self.uow = uow
+        self._event_handlers = event_handlers
+        self._command_handlers = command_handlers
+        self._routes = dispatch.routes(command_handlers, event_handlers, {})
+        self._executor = executor or ThreadPoolExecutor(thread_name_prefix="bus")
+
+    def close(self):
+        """Waits for the blocking handlers still running, then stops their threads"""
+        self._executor.shutdown()
+
+    async def handle(self, message: Message):
+        results = []
+        queue = deque([message])  # type: Deque[Message]
+        while queue:
+            message = queue.popleft()
+            route = self._routes.get(type(message))
+            if route is None:
                 raise Exception(f'{message} was not an Event of Command')
+            if route.kind is dispatch.COMMAND:
+                cmd_result = await self._handle_command(
+                    cast(commands.Command, message), route, queue
+                )
+                results.append(cmd_result)
+            else:
+                await self._handle_event(cast(events.Event, message), route, queue)
         return results
 
-    def _handle_event(self, event: events.Event, queue: List):
-        for handler in self._event_handlers[type(event)]:
+    async def _handle_event(self, event: events.Event, route: dispatch.Route, queue: Deque):
+        start = time.perf_counter()
+        for handler in route.event_handlers:
             try:
-                logger.debug(
-                    f'handling event {event} with handler {handler}')
-                handler(event)
-                self._queue.extend(self.uow.collect_new_events())
+                logger.debug('handling event %s with handler %s', event, handler)
+                await self._call(handler, event, queue)
             except Exception as e:
                 logger.error('Exception handling event %s: %s', event, e)
                 continue
+        _record_message(route, start, ok=True)
 
-    def _handle_command(self, command: commands.Command, queue: List):
+    async def _handle_command(
+        self, command: commands.Command, route: dispatch.Route, queue: Deque
+    ):
         logger.debug('handling command %s', command)
+        start = time.perf_counter()
         try:
-            handler = self._command_handlers[type(command)]
-            result = handler(command)
-            self._queue.extend(self.uow.collect_new_events())
-            return result
+            result = await self._call(route.command_handler, command, queue)
         except Exception:
+            _record_message(route, start, ok=False)
             logger.exception('Exception handling command %s', command)
             raise
+        _record_message(route, start, ok=True)
+        return result
+
+    async def _call(self, handler: Callable, message: Message, queue: Deque):
+        if asyncio.iscoroutinefunction(handler):
+            return await handler(message)
+        result, new_events = await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._call_blocking, handler, message
+        )
+        queue.extend(new_events)
+        return result
+
+    def _call_blocking(self, handler: Callable, message: Message):
+        result = handler(message)
+        return result, list(self.uow.collect_new_events())
@@ -0,0 +1,451 @@
+"""
+Runs the message bus on several worker processes, each handling the
+messages for its own share of the SKUs, so that command handling can use
+more than one core; or, with WorkerPool, on several threads of one
+process, so that handling doesn't wait for one message at a time.
+"""
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.queues
+import queue
+import signal
+import threading
+import time
+import zlib
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import Future
+from multiprocessing.connection import Connection, wait
+from multiprocessing.process import BaseProcess
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from allocation.domain import commands, events
+from allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+# seconds before restarting a worker that died before it was ready
+RESTART_DELAY = 1.0
+BATCHREF_CACHE_SIZE = 100_000
+# seconds over which WorkerPool.stats() gives the rate messages are handled at
+RATE_WINDOW = 60
+
+
+class WorkerCrashed(Exception):
+    pass
+
+
+def partition_for(sku: str, partitions: int) -> int:
+    # crc32 rather than hash(), which is salted differently in every process
+    return zlib.crc32(sku.encode()) % partitions
+
+
+class Partitioner:
+    """
+    Chooses which of ``partitions`` handles a message by hashing its SKU,
+    so that a product's messages are handled in order by the same one.
+
+    Batch references are resolved to SKUs with ``sku_for_batchref``. An
+    AllocateOrder goes by its first SKU, sorted; its other products are
+    still protected by their version numbers.
+    """
+
+    def __init__(self, partitions: int, sku_for_batchref: Callable[[str], Optional[str]]):
+        self.partitions = partitions
+        self._sku_for_batchref = sku_for_batchref
+        self._skus = {}  # type: Dict[str, str]
+
+    def partition(self, message) -> int:
+        return partition_for(self.sku(message), self.partitions)
+
+    def sku(self, message) -> str:
+        """The SKU ``message`` is partitioned by"""
+        sku = getattr(message, "sku", None)
+        if sku is not None:
+            return sku
+        if isinstance(message, commands.AllocateOrder) and message.lines:
+            return min(sku for sku, _ in message.lines)
+        if isinstance(message, (commands.ChangeBatchQuantity, events.BatchQuantityChanged)):
+            # an unknown batch goes wherever its reference hashes to
+            return self._resolve(message.ref) or message.ref
+        return type(message).__name__
+
+    def _resolve(self, batchref: str) -> Optional[str]:
+        sku = self._skus.get(batchref)
+        if sku is None:
+            sku = self._sku_for_batchref(batchref)
+            if sku is not None:  # a batch's SKU never changes, so it can be kept
+                if len(self._skus) >= BATCHREF_CACHE_SIZE:
+                    del self._skus[next(iter(self._skus))]
+                self._skus[batchref] = sku
+        return sku
+
+
+class PartitionedMessageBus:
+    """
+    Hands each message to one of ``workers`` processes, chosen by hashing
+    its SKU, so that a product's messages are handled one at a time and in
+    order by the same process, and different products' in parallel. Each
+    worker builds its own bus by calling ``bus_factory``.
+
+    Workers, and their replacements, are started by a fork server: a
+    process with a single thread, unlike this one, where a fork can copy a
+    lock another thread holds (the metrics registry's, a logging
+    handler's, a connection pool's) into a child that then waits on it
+    forever. So ``bus_factory`` must be picklable, and what it builds is
+    built afresh in each worker.
+
+    Messages are partitioned by a Partitioner, with ``sku_for_batchref``.
+    ImportBatches is split into one command per worker.
+
+    handle() blocks until a worker has handled the message, and returns
+    what that worker's bus returned or raises what it raised. At most
+    ``queue_size`` messages wait for each worker; beyond that, handle()
+    blocks until one is done.
+
+    A supervisor thread restarts workers that die. The message a worker
+    was handling fails with WorkerCrashed, and those queued behind it are
+    handed to its replacement.
+    """
+
+    def __init__(
+        self,
+        uow: unit_of_work.AbstractUnitOfWork,
+        bus_factory: Callable,
+        sku_for_batchref: Callable[[str], Optional[str]],
+        workers: int = 4,
+        queue_size: int = 1000,
+    ):
+        self.uow = uow
+        self._partitioner = Partitioner(workers, sku_for_batchref)
+        self._ids = itertools.count()
+        self._closed = False
+        context = multiprocessing.get_context("forkserver")
+        # imported once by the fork server, rather than by each worker
+        context.set_forkserver_preload(["allocation.bootstrap"])
+        self._workers = [
+            _Worker(partition, bus_factory, queue_size, context)
+            for partition in range(workers)
+        ]
+        self._supervisor = threading.Thread(
+            target=self._supervise, name="bus-supervisor", daemon=True
+        )
+        self._supervisor.start()
+
+    def handle(self, message):
+        if isinstance(message, commands.ImportBatches):
+            return self._handle_import(message)
+        return self.submit(message).result()
+
+    def submit(self, message) -> Future:
+        if self._closed:
+            raise RuntimeError("the bus is closed")
+        worker = self._workers[self.partition(message)]
+        return worker.submit(next(self._ids), message)
+
+    def _handle_import(self, command: commands.ImportBatches):
+        batches = defaultdict(list)  # type: Dict[int, List[commands.CreateBatch]]
+        for batch in command.batches:
+            batches[partition_for(batch.sku, len(self._workers))].append(batch)
+        futures = [
+            self._workers[partition].submit(next(self._ids), commands.ImportBatches(chunk))
+            for partition, chunk in batches.items()
+        ]
+        return [result for future in futures for result in future.result()]
+
+    def partition(self, message) -> int:
+        return self._partitioner.partition(message)
+
+    def sku(self, message) -> str:
+        """The SKU ``message`` is partitioned by"""
+        return self._partitioner.sku(message)
+
+    def close(self):
+        """Lets the workers handle the messages already submitted, then stops them"""
+        if self._closed:
+            return
+        self._closed = True
+        for worker in self._workers:
+            worker.stop()
+        self._supervisor.join()
+
+    def stats(self):
+        stats = defaultdict(dict)  # type: Dict[str, Dict[str, int]]
+        for worker in self._workers:
+            for key, value in worker.stats().items():
+                stats[key][str(worker.partition)] = value
+        return dict(stats)
+
+    def _supervise(self):
+        while not all(worker.stopped for worker in self._workers):
+            readable, sentinels = {}, {}  # type: Tuple[Dict[Any, _Worker], Dict[Any, _Worker]]
+            for w in self._workers:
+                if w.process is not None:
+                    readable[w.results] = w
+                    sentinels[w.process.sentinel] = w
+            for ready in wait(list(readable) + list(sentinels), timeout=RESTART_DELAY / 4):
+                if ready in readable:
+                    readable[ready].receive()
+            for ready in wait(list(sentinels), timeout=0):
+                sentinels[ready].exited()
+            for worker in self._workers:
+                if (
+                    worker.process is None and not worker.stopped
+                    and worker.restart_at <= time.monotonic()
+                ):
+                    worker.start()
+
+
+class _Worker:
+    # set by start(), and kept once the process has exited, until the next
+    commands: multiprocessing.queues.Queue
+    results: Connection
+    process: Optional[BaseProcess]
+
+    def __init__(self, partition, bus_factory, queue_size, context):
+        self.partition = partition
+        self._bus_factory = bus_factory
+        self._context = context
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._lock = threading.Lock()
+        self.pending = OrderedDict()  # type: OrderedDict[int, tuple]
+        self.process = None
+        self.ready = self.stopping = self.stopped = False
+        self.restart_at = 0.0
+        self.handled = self.errors = self.restarts = self.backpressure_waits = 0
+        self.start()
+
+    def start(self):
+        with self._lock:
+            # a fresh queue each time: one the last worker died reading from
+            # may have been left locked
+            self.commands = self._context.Queue()
+            self.results, results = self._context.Pipe(duplex=False)
+            self.ready = False
+            self.process = process = self._context.Process(
+                target=_work,
+                args=(self._bus_factory, self.commands, results),
+                name=f"bus-worker-{self.partition}",
+                daemon=True,
+            )
+            process.start()
+            results.close()
+            for message_id, (message, _) in self.pending.items():
+                self.commands.put((message_id, message))
+            if self.stopping:
+                self.commands.put(None)
+
+    def submit(self, message_id, message) -> Future:
+        future = Future()  # type: Future
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.backpressure_waits += 1
+            self._slots.acquire()
+        with self._lock:
+            self.pending[message_id] = (message, future)
+            if self.process is not None:
+                self.commands.put((message_id, message))
+        return future
+
+    def stop(self):
+        with self._lock:
+            self.stopping = True
+            if self.process is not None:
+                self.commands.put(None)
+
+    def receive(self):
+        try:
+            while self.results.poll():
+                message_id, ok, value = self.results.recv()
+                if message_id is None:
+                    self.ready = True
+                    continue
+                with self._lock:
+                    _, future = self.pending.pop(message_id)
+                    self.handled += 1
+                    self.errors += not ok
+                self._slots.release()
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+        except (EOFError, OSError):  # the worker is gone; exited() deals with it
+            pass
+
+    def exited(self):
+        process = self.process
+        assert process is not None, "only a running worker can exit"
+        self.receive()
+        process.join()
+        exitcode = process.exitcode
+        with self._lock:
+            if self.ready:
+                # the oldest message still pending is the one it was handling
+                failed_ids = [] if exitcode == 0 else list(itertools.islice(self.pending, 1))
+            else:
+                # it couldn't build its bus, so nothing it was sent will be handled
+                failed_ids = list(self.pending)
+            failed = [(message_id, self.pending.pop(message_id)) for message_id in failed_ids]
+            self.handled += len(failed)
+            self.errors += len(failed)
+            self.commands.close()
+            self.commands.cancel_join_thread()
+            self.results.close()
+            self.process = None
+            if self.stopping and not self.pending:
+                self.stopped = True
+            else:
+                self.restarts += 1
+                self.restart_at = time.monotonic() + (0 if self.ready else RESTART_DELAY)
+        if failed or not self.stopped:
+            logger.error(
+                'bus worker %d exited with %s, failing %d messages',
+                self.partition, exitcode, len(failed),
+            )
+        for message_id, (message, future) in failed:
+            self._slots.release()
+            future.set_exception(WorkerCrashed(
+                f"bus worker {self.partition} exited with {exitcode} handling {message}"
+            ))
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                pending=len(self.pending),
+                handled=self.handled,
+                errors=self.errors,
+                restarts=self.restarts,
+                backpressure_waits=self.backpressure_waits,
+            )
+
+
+def _work(bus_factory, requests, results):
+    # the parent stops its workers through close(), not on Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    bus = bus_factory()
+    results.send((None, True, None))
+    try:
+        while True:
+            request = requests.get()
+            if request is None:
+                return
+            message_id, message = request
+            try:
+                outcome = (message_id, True, bus.handle(message))
+            except Exception as e:  # pylint: disable=broad-except
+                outcome = (message_id, False, e)
+            try:
+                results.send(outcome)
+            except Exception:  # pylint: disable=broad-except
+                results.send((message_id, False, RuntimeError(
+                    f"couldn't send back the outcome of {message}: {outcome[2]!r}"
+                )))
+    finally:
+        bus.close()
+
+
+class WorkerPool:
+    """
+    Hands each message to ``bus`` on one of ``workers`` threads, chosen by
+    a Partitioner, so that a product's messages are handled one at a time
+    and in order, and different products' at once.
+
+    submit() returns a Future of what the bus returned. At most
+    ``queue_size`` messages wait for each thread; beyond that, submit()
+    blocks until one is done, holding back whoever is submitting rather
+    than buffering without limit.
+    """
+
+    def __init__(
+        self,
+        bus,
+        sku_for_batchref: Callable[[str], Optional[str]],
+        workers: int = 4,
+        queue_size: int = 100,
+    ):
+        self.bus = bus
+        self._partitioner = Partitioner(workers, sku_for_batchref)
+        self._queues = [queue.Queue(queue_size) for _ in range(workers)]  # type: List[queue.Queue]
+        self._threads = [
+            threading.Thread(
+                target=self._work, args=(requests,), name=f"bus-thread-{i}", daemon=True
+            )
+            for i, requests in enumerate(self._queues)
+        ]
+        self._lock = threading.Lock()
+        self._closed = False
+        self.in_flight = self.handled = self.errors = self.backpressure_waits = 0
+        # (time, handled) at most once a second, for the rate in stats()
+        self._samples = deque([(time.monotonic(), 0)], maxlen=RATE_WINDOW)
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, message) -> Future:
+        if self._closed:
+            raise RuntimeError("the pool is closed")
+        future = Future()  # type: Future
+        requests = self._queues[self._partitioner.partition(message)]
+        with self._lock:
+            self.in_flight += 1
+        try:
+            requests.put_nowait((message, future))
+        except queue.Full:
+            with self._lock:
+                self.backpressure_waits += 1
+            requests.put((message, future))
+        return future
+
+    def _work(self, requests):
+        while True:
+            request = requests.get()
+            if request is None:
+                return
+            message, future = request
+            try:
+                ok, value = True, self.bus.handle(message)
+            except Exception as e:  # pylint: disable=broad-except
+                ok, value = False, e
+            # counted first, so that stats() agree with what's been answered
+            now = time.monotonic()
+            with self._lock:
+                self.in_flight -= 1
+                self.handled += 1
+                self.errors += not ok
+                if now - self._samples[-1][0] >= 1:
+                    self._samples.append((now, self.handled))
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def close(self):
+        """Lets the threads handle the messages already submitted, then stops them"""
+        if self._closed:
+            return
+        self._closed = True
+        for requests in self._queues:
+            requests.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self):
+        """
+        Totals, the messages submitted but not yet handled, and the messages
+        handled per second over about the last RATE_WINDOW seconds
+        """
+        now = time.monotonic()
+        with self._lock:
+            since, handled_then = next(
+                (sample for sample in self._samples if sample[0] >= now - RATE_WINDOW),
+                self._samples[-1],
+            )
+            return dict(
+                in_flight=self.in_flight,
+                queued={str(i): requests.qsize() for i, requests in enumerate(self._queues)},
+                handled=self.handled,
+                errors=self.errors,
+                backpressure_waits=self.backpressure_waits,
+                messages_per_second=(
+                    (self.handled - handled_then) / (now - since) if now > since else 0.0
+                ),
+            )
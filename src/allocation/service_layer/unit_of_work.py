@@ -1,29 +1,89 @@
 # pylint: disable=attribute-defined-outside-init
 from __future__ import annotations
 import abc
+import contextlib
+import json
+import os
+import threading
+import time
+from dataclasses import asdict
+from typing import Dict, Optional, Tuple, Type
+from sqlalchemy import event, exc, inspect
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.engine import create_engine
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.engine import Engine, create_engine
+from sqlalchemy.pool import QueuePool
 
 import allocation.config as config
-from allocation.adapters import repository
+from allocation import metrics
+from allocation.adapters import orm, product_cache, repository
+from allocation.domain import events
+from allocation.adapters.product_cache import ProductCache
+
+
+COMMIT_SECONDS = "allocation_uow_commit_seconds"
+ROLLBACK_SECONDS = "allocation_uow_rollback_seconds"
+
+# postgres' serialization_failure and deadlock_detected
+SERIALIZATION_FAILURES = {"40001", "40P01"}
+
+
+def is_concurrency_error(error: BaseException) -> bool:
+    """
+    Whether ``error`` means another transaction changed the same rows
+    first, so that the work can be retried from the start
+    """
+    if isinstance(error, StaleDataError):  # a product's version_number moved on
+        return True
+    if isinstance(error, exc.DBAPIError):
+        return getattr(error.orig, "pgcode", None) in SERIALIZATION_FAILURES
+    return False
 
 
 class AbstractUnitOfWork(abc.ABC):
     products: repository.AbstractRepository
 
     def __enter__(self) -> AbstractUnitOfWork:
+        self._committed = False
         return self
 
     def __exit__(self, *args):
+        if self._committed:
+            self.rollback()  # nothing left to undo
+            return
+        start = time.perf_counter()
         self.rollback()
+        metrics.REGISTRY.observe(ROLLBACK_SECONDS, time.perf_counter() - start)
 
     def commit(self):
+        start = time.perf_counter()
         self._commit()
+        self._committed = True
+        metrics.REGISTRY.observe(COMMIT_SECONDS, time.perf_counter() - start)
+
+    def group(self):
+        """
+        A context manager in which every ``with uow:`` block shares one
+        transaction, committed when it exits. Units of work that can't
+        group leave each block to commit on its own.
+        """
+        return contextlib.nullcontext()
+
+    @property
+    def grouped(self) -> bool:
+        """Whether this thread is within group()"""
+        return False
 
     def collect_new_events(self):
-        for product in self.products.seen:
-            while product.events:
-                yield product.events.pop(0)
+        if getattr(self, "products", None) is None:
+            return  # no unit of work has started in this thread
+        recent, self.products.recent = self.products.recent, {}
+        for product in recent:
+            product_events = product.events
+            while product_events:
+                yield product_events.popleft()
+        while self.products.events:
+            yield self.products.events.popleft()
 
     @abc.abstractmethod
     def _commit(self):
@@ -34,28 +94,256 @@ class AbstractUnitOfWork(abc.ABC):
         raise NotImplementedError
 
 
-DEFAULT_SESSION_FACTORY = sessionmaker(
-    bind=create_engine(
+class InstrumentedQueuePool(QueuePool):
+    """A QueuePool that records how long checkouts wait for a connection"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.checkout_wait_seconds = 0.0
+        self.max_checkout_wait_seconds = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            self.checkouts += 1
+            self.checkout_wait_seconds += waited
+            self.max_checkout_wait_seconds = max(self.max_checkout_wait_seconds, waited)
+
+    def stats(self):
+        capacity = self.size() + self._max_overflow
+        return dict(
+            size=self.size(),
+            checked_out=self.checkedout(),
+            overflow=max(self.overflow(), 0),
+            utilisation=self.checkedout() / capacity if capacity > 0 else 0.0,
+            checkouts=self.checkouts,
+            checkout_wait_seconds=self.checkout_wait_seconds,
+            max_checkout_wait_seconds=self.max_checkout_wait_seconds,
+        )
+
+
+def _make_fork_safe(engine):
+    """
+    Connections opened before a fork are unusable in the child: invalidate
+    any checked out in a process other than the one that opened it.
+    """
+
+    @event.listens_for(engine, "connect")
+    def connect(_, connection_record):
+        connection_record.info["pid"] = os.getpid()
+
+    @event.listens_for(engine, "checkout")
+    def checkout(_, connection_record, connection_proxy):
+        if connection_record.info["pid"] != os.getpid():
+            connection_record.connection = connection_proxy.connection = None
+            raise exc.DisconnectionError(
+                "Connection record belongs to pid %s, attempting to check out in pid %s"
+                % (connection_record.info["pid"], os.getpid())
+            )
+
+
+def create_default_engine():
+    connect_args = {}
+    timeout_ms = config.get_db_statement_timeout_ms()
+    if timeout_ms:
+        connect_args["options"] = f"-c statement_timeout={timeout_ms}"
+    engine = create_engine(
         config.get_postgres_uri(),
-        isolation_level="REPEATABLE READ"
+        isolation_level="REPEATABLE READ",
+        poolclass=InstrumentedQueuePool,
+        connect_args=connect_args,
+        **config.get_db_pool_settings(),
     )
+    _make_fork_safe(engine)
+    return engine
+
+
+_engines = {}  # type: Dict[int, Tuple[Engine, sessionmaker]]
+_engines_lock = threading.Lock()
+
+
+def _default_engine_and_sessionmaker():
+    # keyed by pid, so a forked worker builds its own pool rather than
+    # sharing its parent's sockets; the parent's engine is kept, not
+    # disposed, as disposing it would close connections the parent uses
+    pid = os.getpid()
+    if pid not in _engines:
+        with _engines_lock:
+            if pid not in _engines:
+                engine = create_default_engine()
+                _engines[pid] = engine, sessionmaker(bind=engine)
+    return _engines[pid]
+
+
+def get_default_engine() -> Engine:
+    return _default_engine_and_sessionmaker()[0]
+
+
+def DEFAULT_SESSION_FACTORY():  # pylint: disable=invalid-name
+    """Sessions on the default engine, which is created on first use"""
+    return _default_engine_and_sessionmaker()[1]()
+
+
+def pool_stats():
+    """Pool statistics for this process, empty if no engine was created yet"""
+    if os.getpid() not in _engines:
+        return {}
+    return get_default_engine().pool.stats()
+
+DEFAULT_PRODUCT_CACHE = product_cache.from_config()
+DEFAULT_REPOSITORY_LOADING = config.get_repository_loading()
+
+# the events the outbox takes, and the channels they are relayed to
+OUTBOX_CHANNELS = {events.Allocated: "line_allocated"}  # type: Dict[Type[events.Event], str]
+DEFAULT_OUTBOX_CHANNELS = (
+    OUTBOX_CHANNELS if config.get_outbox_settings()["enabled"] else {}
 )
 
+
+class _ThreadState(threading.local):
+    session = None
+    products = None
+    group_session = None
+    savepoint = None
+    outboxed = None
+    committed = False
+
+
+def _thread_local(name):
+    return property(
+        lambda self: getattr(self._state, name),
+        lambda self, value: setattr(self._state, name, value),
+    )
+
+
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
+    # per thread, so that handlers running on several threads at once
+    # (see messagebus.AsyncMessageBus) each get their own session
+    session = _thread_local("session")
+    products = _thread_local("products")
+    _group_session = _thread_local("group_session")
+    _savepoint = _thread_local("savepoint")
+    _outboxed = _thread_local("outboxed")
+    _committed = _thread_local("committed")
+
+    def __init__(
+        self,
+        session_factory=DEFAULT_SESSION_FACTORY,
+        product_cache: Optional[ProductCache] = DEFAULT_PRODUCT_CACHE,
+        loading: Optional[str] = DEFAULT_REPOSITORY_LOADING,
+        outbox_channels: Dict[Type[events.Event], str] = DEFAULT_OUTBOX_CHANNELS,
+    ):
+        """
+        Events of the types in ``outbox_channels`` are written to the
+        outbox table on commit, in the same transaction, for the outbox
+        relay to publish.
+        """
         self.session_factory = session_factory
-    
+        self.product_cache = product_cache
+        self.loading = loading
+        self.outbox_channels = outbox_channels
+        self._state = _ThreadState()
+
+    def __getstate__(self):
+        # pickled for worker processes, without this process' sessions
+        return {k: v for k, v in self.__dict__.items() if k != "_state"}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._state = _ThreadState()
+
     def __enter__(self):
+        self._outboxed = set()
+        if self._group_session is not None:
+            # inside group(): each block is a savepoint in the shared session
+            self._savepoint = self.session.begin_nested()
+            return super().__enter__()
         self.session = self.session_factory()
-        self.products = repository.SqlAlchemyRepository(self.session)
+        self._start_repository()
         return super().__enter__()
 
+    def _start_repository(self):
+        self.products = repository.SqlAlchemyRepository(
+            self.session, loading=self.loading, cache=self.product_cache
+        )
+        if self.product_cache is not None:
+            # committed products stay loaded, ready to be cached
+            self.session.expire_on_commit = False
+
     def __exit__(self, *args):
         super().__exit__(*args)
-        self.session.close()
+        if self._group_session is None:
+            self.session.close()
+
+    @property
+    def grouped(self):
+        return self._group_session is not None
+
+    @contextlib.contextmanager
+    def group(self):
+        self.session = self._group_session = self.session_factory()
+        self._start_repository()
+        try:
+            yield self
+            self.session.commit()
+            self._cache_seen_products()
+        finally:
+            self._group_session = self._savepoint = None
+            self.session.rollback()
+            self.session.close()
 
     def _commit(self):
+        if self.outbox_channels:
+            self._write_outbox()
+        if self._group_session is not None:
+            self._savepoint.commit()
+            return
         self.session.commit()
+        self._cache_seen_products()
+
+    def _write_outbox(self):
+        rows = []
+        for product in self.products.seen:
+            for event in product.events:
+                channel = self.outbox_channels.get(type(event))
+                if channel is not None and id(event) not in self._outboxed:
+                    # still in product.events, so its id can't be reused
+                    self._outboxed.add(id(event))
+                    rows.append(dict(channel=channel, payload=json.dumps(asdict(event))))
+        if rows:
+            self.session.execute(orm.outbox.insert(), rows)
+
+    def _cache_seen_products(self):
+        if self.product_cache is not None:
+            for product in self.products.seen:
+                if product not in self.session:
+                    continue  # added by a block that was rolled back
+                state = inspect(product)
+                if state.expired_attributes:
+                    # changed by a block that was rolled back, so expired:
+                    # whatever was cached for it is out of date
+                    self.product_cache.invalidate(state.identity[0])
+                    continue
+                # once cached, another thread can take the product and raise
+                # events of its own on it, so this one's are collected apart
+                self.products.recent.pop(product, None)
+                self.products.events.extend(product.events)
+                product.events.clear()
+                # detached, so the session's rollback on exit can't expire it
+                self.session.expunge(product)
+                self.product_cache.put(product)
 
     def rollback(self):
-        self.session.rollback()
+        if self._group_session is None:
+            self.session.rollback()
+        elif self._savepoint is not None and not self._committed:
+            # even once inactive, as a failed flush in commit() leaves it,
+            # or the group's session can't be used again
+            self._savepoint.rollback()
+            # events raised by the work just undone must not be handled
+            for product in self.products.seen:
+                product.events.clear()
@@ -1,7 +1,34 @@
+from typing import Optional
+
+from allocation import metrics
+from allocation.adapters import read_model as read_models
 from allocation.service_layer import unit_of_work
 
+VIEW_QUERIES = "allocation_view_queries_total"
+
+
+def allocations(
+    orderid: str,
+    uow: unit_of_work.SqlAlchemyUnitOfWork,
+    read_model: Optional[read_models.ReadModel] = None,
+):
+    """
+    From ``read_model`` if it's a RedisReadModel, otherwise from
+    allocations_view, through ``read_model`` if it's an AllocationsCache
+    """
+    if isinstance(read_model, read_models.RedisReadModel):
+        return read_model.allocations(orderid)
+    if isinstance(read_model, read_models.AllocationsCache):
+        results = read_model.get(orderid)
+        if results is None:
+            results = _query(orderid, uow)
+            read_model.set(orderid, results)
+        return results
+    return _query(orderid, uow)
+
 
-def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
+def _query(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
+    metrics.REGISTRY.inc(VIEW_QUERIES)
     with uow:
         results = uow.session.execute(
             """
@@ -9,4 +36,4 @@ def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
             """,
             dict(orderid=orderid),
         )
-    return [dict(r) for r in results]
+        return [dict(r) for r in results]
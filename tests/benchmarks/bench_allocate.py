@@ -0,0 +1,73 @@
+"""
+Product.allocate latency against the number of batches on a product,
+sorting them on every call and keeping a batch index, which decides
+model.INDEX_MIN_BATCHES.
+
+    python -m tests.benchmarks.bench_allocate
+"""
+import random
+import time
+from datetime import date, timedelta
+
+from allocation.domain import model
+from allocation.domain.model import Batch, OrderLine, Product
+
+BATCH_COUNTS = [5, 10, 20, 50, 100, 1000, 5000]
+LINES = 1000
+FRESH_PRODUCTS = 200
+
+
+def make_product(batch_count):
+    rng = random.Random(batch_count)
+    batches = [
+        Batch(
+            f"batch-{i}", "BENCH-SKU", qty=LINES,
+            eta=None if i % 10 == 0 else date.today() + timedelta(days=rng.randint(1, 365)),
+        )
+        for i in range(batch_count)
+    ]
+    return Product("BENCH-SKU", batches)
+
+
+def time_allocations(product, allocate):
+    start = time.perf_counter()
+    for i in range(LINES):
+        allocate(product, OrderLine(f"order-{i}", "BENCH-SKU", 1))
+    return (time.perf_counter() - start) / LINES * 1e6
+
+
+def time_first_allocations(batch_count):
+    """Per product freshly loaded, as by a request without the product cache"""
+    products = [make_product(batch_count) for _ in range(FRESH_PRODUCTS)]
+    start = time.perf_counter()
+    for i, product in enumerate(products):
+        product.allocate(OrderLine(f"order-{i}", "BENCH-SKU", 1))
+    return (time.perf_counter() - start) / FRESH_PRODUCTS * 1e6
+
+
+def with_index_from(min_batches, measure, *args):
+    default, model.INDEX_MIN_BATCHES = model.INDEX_MIN_BATCHES, min_batches
+    try:
+        return measure(*args)
+    finally:
+        model.INDEX_MIN_BATCHES = default
+
+
+def main():
+    print(f"per line, {LINES} lines / first line of {FRESH_PRODUCTS} fresh products")
+    print(f"{'batches':>8} {'sorted (us)':>20} {'index (us)':>20}")
+    for batch_count in BATCH_COUNTS:
+        results = []
+        for min_batches in [batch_count + 1, 0]:
+            results.append(with_index_from(
+                min_batches, time_allocations, make_product(batch_count), Product.allocate
+            ))
+            results.append(with_index_from(min_batches, time_first_allocations, batch_count))
+        print(
+            f"{batch_count:>8} {results[0]:>9.1f} / {results[1]:>8.1f}"
+            f" {results[2]:>9.1f} / {results[3]:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
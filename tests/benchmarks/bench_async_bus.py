@@ -0,0 +1,98 @@
+"""
+Throughput of Allocate commands handled one at a time by MessageBus and
+concurrently by AsyncMessageBus, against a sqlite database file, with the
+Redis publish replaced by a sleep standing in for its network round trip.
+
+    python -m tests.benchmarks.bench_async_bus
+"""
+import asyncio
+import os
+import tempfile
+import time
+from unittest import mock
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from allocation import bootstrap
+from allocation.adapters import orm
+from allocation.domain import commands, model
+from allocation.service_layer import unit_of_work
+
+COMMANDS = 400
+SKUS = 40
+PUBLISH_LATENCY = 0.005
+CONCURRENCY = [10, 50]
+
+
+def make_uow(path):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"timeout": 30})
+    orm.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    session = session_factory()
+    for i in range(SKUS):
+        session.add(model.Product(
+            f"SKU-{i}", [model.Batch(f"batch-{i}", f"SKU-{i}", qty=10 ** 6, eta=None)]
+        ))
+    session.commit()
+    return unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+
+
+def allocations():
+    return [
+        commands.Allocate(f"order-{i}", f"SKU-{i % SKUS}", 1) for i in range(COMMANDS)
+    ]
+
+
+def time_sync(path):
+    bus = bootstrap.bootstrap(
+        start_orm=False, uow=make_uow(path), notifications=mock.Mock(),
+        publish=lambda *_: time.sleep(PUBLISH_LATENCY),
+    )
+    start = time.perf_counter()
+    for command in allocations():
+        bus.handle(command)
+    return COMMANDS / (time.perf_counter() - start)
+
+
+def time_async(path, concurrency):
+    async def publish(*_):
+        await asyncio.sleep(PUBLISH_LATENCY)
+
+    bus = bootstrap.bootstrap(
+        start_orm=False, uow=make_uow(path), notifications=mock.Mock(),
+        publish=publish, asynchronous=True,
+    )
+
+    async def run():
+        limit = asyncio.Semaphore(concurrency)
+
+        async def handle(command):
+            async with limit:
+                await bus.handle(command)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(handle(c) for c in allocations()))
+        return COMMANDS / (time.perf_counter() - start)
+
+    return asyncio.run(run())
+
+
+def main():
+    orm.start_mappers()
+    print(
+        f"{COMMANDS} allocations over {SKUS} skus,"
+        f" {PUBLISH_LATENCY * 1000:.0f} ms publish"
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        throughput = time_sync(os.path.join(tmp, "sync.db"))
+        print(f"MessageBus:                    {throughput:6.0f} commands/s")
+        for concurrency in CONCURRENCY:
+            throughput = time_async(
+                os.path.join(tmp, f"async-{concurrency}.db"), concurrency
+            )
+            print(f"AsyncMessageBus, {concurrency:>2} in flight: {throughput:6.0f} commands/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Many threads allocating against one SKU through MessageBus, against a
+sqlite database file, without and with retrying the allocations that
+lost their version check to another thread.
+
+    python -m tests.benchmarks.bench_contention
+"""
+import logging
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from allocation import bootstrap, metrics
+from allocation.adapters import orm
+from allocation.domain import commands, model
+from allocation.service_layer import dispatch, unit_of_work
+
+THREADS = 16
+PER_THREAD = 25
+SKU = "HOT-SKU"
+ATTEMPTS = [1, 5, 20]
+
+
+def make_uow(path):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"timeout": 30})
+    orm.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    session = session_factory()
+    session.add(model.Product(SKU, [model.Batch("batch", SKU, qty=10 ** 6, eta=None)]))
+    session.commit()
+    # summary loading, so that a load doesn't grow with the allocations made
+    return unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, product_cache=None, loading="summary"
+    )
+
+
+def run(path, attempts):
+    metrics.REGISTRY.reset()
+    uow = make_uow(path)
+    retry = (
+        dispatch.concurrency_retry(attempts, wait=0.002, max_wait=0.1)
+        if attempts > 1 else None
+    )
+    bus = bootstrap.bootstrap(
+        start_orm=False, uow=uow, notifications=mock.Mock(),
+        publish=lambda *_: None, middleware=dispatch.default_middleware(uow, retry),
+    )
+    failed = []
+
+    def allocate(thread):
+        for i in range(PER_THREAD):
+            try:
+                bus.handle(commands.Allocate(f"order-{thread}-{i}", SKU, 1))
+            except Exception as e:  # pylint: disable=broad-except
+                if not unit_of_work.is_concurrency_error(e):
+                    raise
+                failed.append(e)
+
+    threads = [threading.Thread(target=allocate, args=(t,)) for t in range(THREADS)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    labels = (("sku", SKU),)
+    conflicts = metrics.REGISTRY.counter(dispatch.CONCURRENCY_CONFLICTS, labels)
+    retries = metrics.REGISTRY.counter(dispatch.CONCURRENCY_RETRIES, labels)
+    allocated = THREADS * PER_THREAD - len(failed)
+    return allocated / elapsed, conflicts, retries, len(failed)
+
+
+def main():
+    # the bus logs every allocation that ran out of attempts
+    logging.disable(logging.CRITICAL)
+    orm.start_mappers()
+    print(f"{THREADS} threads x {PER_THREAD} allocations of one sku")
+    with tempfile.TemporaryDirectory() as tmp:
+        for attempts in ATTEMPTS:
+            throughput, conflicts, retries, failed = run(
+                os.path.join(tmp, f"attempts-{attempts}.db"), attempts
+            )
+            print(
+                f"{attempts:>2} attempts: {throughput:6.0f} allocations/s,"
+                f" {conflicts:4.0f} conflicts, {retries:4.0f} retries, {failed:3d} failed"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Per-message dispatch overhead of MessageBus: the time handle() takes
+beyond calling the handler itself, for a command whose handler does
+nothing, with the fake unit of work from the handler unit tests.
+
+"before" is the dispatch this replaced, rebuilt here for comparison:
+handlers called with their dependencies as keyword arguments and timed
+by the bus, isinstance checks on every message, and metric labels built
+for each. "compiled" binds dependencies by position and looks up each
+message's route, labels included, once; with the default middleware,
+which times handlers, and with none.
+
+    python -m tests.benchmarks.bench_dispatch
+"""
+import inspect
+import time
+from collections import deque
+from dataclasses import dataclass
+
+from allocation import bootstrap, metrics
+from allocation.domain import commands, events
+from allocation.service_layer import dispatch, messagebus
+from tests.unit.test_handlers import FakeUnitOfWork
+
+MESSAGES = 100_000
+
+
+@dataclass
+class Ping(commands.Command):
+    n: int
+
+
+def ping(command: Ping, uow, publish):
+    pass
+
+
+def inject_by_keyword(handler, dependencies):
+    params = inspect.signature(handler).parameters
+    deps = {name: dep for name, dep in dependencies.items() if name in params}
+
+    def injected(message):
+        return handler(message, **deps)
+    return injected
+
+
+def record_message(message, start, ok, count=1):
+    name = type(message).__name__
+    metrics.REGISTRY.observe(
+        messagebus.MESSAGE_SECONDS, time.perf_counter() - start, (("message", name),)
+    )
+    metrics.REGISTRY.inc(
+        messagebus.MESSAGES, (("message", name), ("result", "ok" if ok else "error")), count
+    )
+
+
+class BeforeMessageBus(messagebus.MessageBus):
+    """MessageBus.handle as it was before its dispatch was compiled"""
+
+    def handle(self, message):
+        results = []
+        self._queue = deque([(message, 0)])
+        max_depth = max_length = 0
+        try:
+            while self._queue:
+                max_length = max(max_length, len(self._queue))
+                message, depth = self._queue.popleft()
+                max_depth = max(max_depth, depth)
+                new_messages = deque()
+                if type(message) in self._coalesced_event_handlers:
+                    run = [message]
+                    while self._queue and type(self._queue[0][0]) is type(message):
+                        run.append(self._queue.popleft()[0])
+                    self._handle_events_before(run, new_messages)
+                elif isinstance(message, events.Event):
+                    self._handle_event_before(message, new_messages)
+                elif isinstance(message, commands.Command):
+                    results.append(self._handle_command_before(message, new_messages))
+                else:
+                    raise Exception(f'{message} was not an Event of Command')
+                self._queue.extend((m, depth + 1) for m in new_messages)
+        finally:
+            metrics.REGISTRY.observe(
+                messagebus.CASCADE_DEPTH, max_depth, buckets=messagebus.DEPTH_BUCKETS
+            )
+            metrics.REGISTRY.set(messagebus.QUEUE_LENGTH, max_length)
+        return results
+
+    def _handle_event_before(self, event, queue):
+        start = time.perf_counter()
+        for handler in self._event_handlers[type(event)]:
+            try:
+                self._call_before(handler, event)
+                queue.extend(self.uow.collect_new_events())
+            except Exception:
+                continue
+        record_message(event, start, ok=True)
+
+    def _handle_events_before(self, run, queue):
+        start = time.perf_counter()
+        for handler in self._coalesced_event_handlers[type(run[0])]:
+            try:
+                self._call_before(handler, run)
+                queue.extend(self.uow.collect_new_events())
+            except Exception:
+                continue
+        record_message(run[0], start, ok=True, count=len(run))
+
+    def _handle_command_before(self, command, queue):
+        start = time.perf_counter()
+        try:
+            handler = self._command_handlers[type(command)]
+            result = self._call_before(handler, command)
+            queue.extend(self.uow.collect_new_events())
+        except Exception:
+            record_message(command, start, ok=False)
+            raise
+        record_message(command, start, ok=True)
+        return result
+
+    @staticmethod
+    def _call_before(handler, message):
+        labels = (("handler", getattr(handler, "__name__", str(handler))),)
+        start = time.perf_counter()
+        try:
+            return handler(message)
+        except Exception:
+            metrics.REGISTRY.inc(dispatch.HANDLER_ERRORS, labels)
+            raise
+        finally:
+            metrics.REGISTRY.observe(
+                dispatch.HANDLER_SECONDS, time.perf_counter() - start, labels
+            )
+
+
+def time_per_message(handle):
+    messages = [Ping(i) for i in range(MESSAGES)]
+    start = time.perf_counter()
+    for message in messages:
+        handle(message)
+    return (time.perf_counter() - start) / MESSAGES * 1e6
+
+
+def main():
+    uow = FakeUnitOfWork()
+    dependencies = {"uow": uow, "publish": lambda *_: None, "notifications": None}
+
+    def direct(message):
+        ping(message, uow, dependencies["publish"])
+
+    handler_alone = time_per_message(direct)
+    buses = {
+        "before": BeforeMessageBus(uow, {}, {Ping: inject_by_keyword(ping, dependencies)}),
+        "compiled": messagebus.MessageBus(
+            uow, {}, {Ping: bootstrap.inject_dependencies(
+                ping, dependencies, dispatch.default_middleware(uow),
+            )},
+        ),
+        "no middleware": messagebus.MessageBus(
+            uow, {}, {Ping: bootstrap.inject_dependencies(ping, dependencies)}
+        ),
+    }
+    print(f"{MESSAGES} messages, handler alone {handler_alone:.2f} us each")
+    for name, bus in buses.items():
+        overhead = time_per_message(bus.handle) - handler_alone
+        print(f"{name + ':':<17} {overhead:5.2f} us dispatch overhead per message")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Throughput and latency of Allocate commands sent by concurrent clients,
+committed one transaction per command and in groups of various sizes and
+windows, against a sqlite database file with synchronous=FULL so that
+every commit waits for fsync.
+
+    python -m tests.benchmarks.bench_group_commit
+"""
+import os
+import statistics
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from allocation.adapters import orm
+from allocation.domain import commands, model
+from allocation.service_layer import messagebus, unit_of_work
+from allocation import bootstrap
+
+CLIENTS = 16
+COMMANDS_PER_CLIENT = 25
+SKUS = 8
+SETTINGS = [(0, 0), (10, 0.002), (25, 0.005), (50, 0.010)]  # (max size, window)
+
+
+def make_session_factory(path):
+    engine = create_engine(f"sqlite:///{path}")
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, _):
+        dbapi_connection.isolation_level = None
+        dbapi_connection.execute("PRAGMA synchronous=FULL")
+
+    @event.listens_for(engine, "begin")
+    def begin(connection):
+        connection.execute("BEGIN")
+
+    orm.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    session = session_factory()
+    for i in range(SKUS):
+        session.add(model.Product(
+            f"SKU-{i}", [model.Batch(f"batch-{i}", f"SKU-{i}", qty=10 ** 6, eta=None)]
+        ))
+    session.commit()
+    return session_factory
+
+
+def make_bus(session_factory, max_size, window):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    bus = bootstrap.bootstrap(
+        start_orm=False, uow=uow, notifications=mock.Mock(), publish=mock.Mock(),
+    )
+    if not max_size:
+        # the plain bus handles one message at a time
+        lock = threading.Lock()
+        handle = bus.handle
+
+        def locked_handle(message):
+            with lock:
+                return handle(message)
+        bus.handle = locked_handle
+        return bus
+    return messagebus.GroupCommitMessageBus(
+        uow, bus._event_handlers, bus._command_handlers,
+        max_size=max_size, window=window,
+    )
+
+
+def run(bus):
+    latencies = []
+
+    def client(n):
+        for i in range(COMMANDS_PER_CLIENT):
+            start = time.perf_counter()
+            bus.handle(commands.Allocate(f"order-{n}-{i}", f"SKU-{(n + i) % SKUS}", 1))
+            latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(CLIENTS)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return (
+        len(latencies) / elapsed,
+        statistics.median(latencies) * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000,
+    )
+
+
+def main():
+    orm.start_mappers()
+    print(f"{CLIENTS} clients x {COMMANDS_PER_CLIENT} allocations over {SKUS} skus")
+    with tempfile.TemporaryDirectory() as tmp:
+        for max_size, window in SETTINGS:
+            session_factory = make_session_factory(
+                os.path.join(tmp, f"group-{max_size}.db")
+            )
+            bus = make_bus(session_factory, max_size, window)
+            throughput, p50, p99 = run(bus)
+            if max_size:
+                bus.close()
+            label = (
+                f"group of {max_size:>2}, {window * 1000:>4.0f} ms"
+                if max_size else "one per command     "
+            )
+            print(
+                f"{label}: {throughput:7.0f} commands/s"
+                f"  p50 {p50:6.2f} ms  p99 {p99:6.2f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
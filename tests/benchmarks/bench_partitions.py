@@ -0,0 +1,84 @@
+"""
+Throughput of Allocate commands handled by MessageBus in this process and
+by PartitionedMessageBus with an increasing number of worker processes,
+against a sqlite database file, with the Redis publish replaced by a
+sleep standing in for its network round trip.
+
+    python -m tests.benchmarks.bench_partitions
+"""
+import os
+import tempfile
+import time
+
+from allocation import bootstrap
+from allocation.adapters import orm
+from allocation.domain import commands, model
+from allocation.service_layer import unit_of_work
+from tests.integration.test_uow import FileSessionFactory
+from tests.unit.test_handlers import FakeNotifications
+
+COMMANDS = 800
+SKUS = 40
+PUBLISH_LATENCY = 0.002
+WORKERS = [1, 2, 4, 8]
+
+
+def make_uow(path):
+    session_factory = FileSessionFactory(path)
+    session = session_factory()
+    for i in range(SKUS):
+        session.add(model.Product(
+            f"SKU-{i}", [model.Batch(f"batch-{i}", f"SKU-{i}", qty=10 ** 6, eta=None)]
+        ))
+    session.commit()
+    return unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+
+
+def allocations():
+    return [
+        commands.Allocate(f"order-{i}", f"SKU-{i % SKUS}", 1) for i in range(COMMANDS)
+    ]
+
+
+def slow_publish(*_):
+    time.sleep(PUBLISH_LATENCY)
+
+
+def time_bus(path, workers):
+    bus = bootstrap.bootstrap(
+        start_orm=False, uow=make_uow(path), notifications=FakeNotifications(),
+        publish=slow_publish, workers=workers,
+    )
+    try:
+        start = time.perf_counter()
+        if workers:
+            futures = [bus.submit(command) for command in allocations()]
+            for future in futures:
+                future.result()
+        else:
+            for command in allocations():
+                bus.handle(command)
+        return COMMANDS / (time.perf_counter() - start)
+    finally:
+        bus.close()
+
+
+def main():
+    orm.start_mappers()
+    print(
+        f"{COMMANDS} allocations over {SKUS} skus,"
+        f" {PUBLISH_LATENCY * 1000:.0f} ms publish, {os.cpu_count()} cpus"
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        throughput = time_bus(os.path.join(tmp, "single.db"), workers=0)
+        print(f"MessageBus:                   {throughput:6.0f} commands/s")
+        for workers in WORKERS:
+            throughput = time_bus(os.path.join(tmp, f"workers-{workers}.db"), workers)
+            print(f"PartitionedMessageBus, {workers} x: {throughput:6.0f} commands/s")
+
+
+if __name__ == "__main__":
+    # by its module name, not as __main__, so that the workers can unpickle
+    # slow_publish
+    from tests.benchmarks import bench_partitions
+    bench_partitions.main()
@@ -0,0 +1,64 @@
+"""
+Allocate latency with the product cache turned off and on, against a
+sqlite database file.
+
+    python -m tests.benchmarks.bench_product_cache
+"""
+import os
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from allocation.adapters import orm
+from allocation.adapters.product_cache import ProductCache
+from allocation.domain import commands, model
+from allocation.service_layer import handlers, unit_of_work
+
+BATCHES = 500
+LINES_PER_BATCH = 4
+ALLOCATIONS = 200
+
+
+def make_session_factory(path):
+    engine = create_engine(f"sqlite:///{path}")
+    orm.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    session = session_factory()
+    batches = []
+    for i in range(BATCHES):
+        batch = model.Batch(f"batch-{i}", "BENCH-SKU", qty=100, eta=None)
+        for j in range(LINES_PER_BATCH):
+            batch.allocate(model.OrderLine(f"order-{i}-{j}", "BENCH-SKU", 1))
+        batches.append(batch)
+    session.add(model.Product("BENCH-SKU", batches))
+    session.commit()
+    return session_factory
+
+
+def time_allocations(session_factory, cache):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, product_cache=cache)
+    start = time.perf_counter()
+    for i in range(ALLOCATIONS):
+        handlers.allocate(commands.Allocate(f"new-order-{i}", "BENCH-SKU", 1), uow)
+    return (time.perf_counter() - start) / ALLOCATIONS * 1000
+
+
+def main():
+    orm.start_mappers()
+    with tempfile.TemporaryDirectory() as tmp:
+        uncached = time_allocations(
+            make_session_factory(os.path.join(tmp, "uncached.db")), None
+        )
+        cache = ProductCache(max_entries=100, max_bytes=64 * 1024 * 1024)
+        cached = time_allocations(
+            make_session_factory(os.path.join(tmp, "cached.db")), cache
+        )
+    print(f"{BATCHES} batches, {BATCHES * LINES_PER_BATCH} allocations")
+    print(f"cache off: {uncached:.2f} ms per allocate")
+    print(f"cache on:  {cached:.2f} ms per allocate  {cache.stats()}")
+
+
+if __name__ == "__main__":
+    main()
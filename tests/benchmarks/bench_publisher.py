@@ -0,0 +1,131 @@
+"""
+Events per second published to Redis by publish(), one round trip per
+event, and by RedisEventPublisher, one pipeline per message handled, for
+messages raising 1, 10 and 100 events (a reallocation storm raises one
+per order it moves); and by BufferedRedisEventPublisher, as the consumer
+would, for events raised one per message.
+
+Redis is stood in for by a server answering every command it's sent,
+after waiting LATENCY seconds for each read, the network round trip.
+
+    python -m tests.benchmarks.bench_publisher
+"""
+import socket
+import socketserver
+import threading
+import time
+
+import redis
+
+from allocation.adapters import redis_eventpublisher
+from allocation.adapters.redis_eventpublisher import (
+    BufferedRedisEventPublisher, RedisEventPublisher,
+)
+from allocation.domain import events
+
+EVENTS = 5000
+PER_MESSAGE = [1, 10, 100]
+LATENCY = 0.0002
+
+
+class StubRedis(socketserver.BaseRequestHandler):
+    """Answers each command with 0, or OK to those from the client's handshake"""
+
+    def handle(self):
+        # as Redis does, or replies split across packets wait on delayed acks
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buffer = b""
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                return
+            time.sleep(LATENCY)
+            commands, buffer = parse(buffer + data)
+            self.request.sendall(b"".join(
+                b":0\r\n" if command.upper() == b"PUBLISH" else b"+OK\r\n"
+                for command in commands
+            ))
+
+
+def parse(buffer):
+    """The names of the whole commands in ``buffer``, and what's left of it"""
+    lines = buffer.split(b"\r\n")
+    names, i = [], 0
+    # each command is *<n>, then $<length> and the value of each of n args
+    while i < len(lines) - 1 and i + 2 * int(lines[i][1:]) < len(lines) - 1:
+        names.append(lines[i + 2])
+        i += 1 + 2 * int(lines[i][1:])
+    return names, b"\r\n".join(lines[i:])
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def allocated(i):
+    return events.Allocated(f"order-{i}", "RED-CHAIR", 1, "batch-1")
+
+
+def events_per_second(publish_message, per_message):
+    messages = [
+        [allocated(i * per_message + j) for j in range(per_message)]
+        for i in range(EVENTS // per_message)
+    ]
+    start = time.perf_counter()
+    for raised in messages:
+        publish_message(raised)
+    return EVENTS / (time.perf_counter() - start)
+
+
+def main():
+    server = Server(("localhost", 0), StubRedis)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    client = redis.Redis(connection_pool=redis.BlockingConnectionPool(
+        host=host, port=port, protocol=2,
+    ))
+    client.ping()
+    # publish() uses the module's client
+    redis_eventpublisher._client = client  # pylint: disable=protected-access
+    print(f"{EVENTS} events, {LATENCY * 1e6:.0f} us round trip")
+
+    for per_message in PER_MESSAGE:
+        def one_at_a_time(raised):
+            for event in raised:
+                redis_eventpublisher.publish("line_allocated", event)
+
+        publisher = RedisEventPublisher(client)
+
+        def pipelined(raised):
+            for event in raised:
+                publisher("line_allocated", event)
+            publisher.end_cycle()
+
+        before = events_per_second(one_at_a_time, per_message)
+        after = events_per_second(pipelined, per_message)
+        print(
+            f"{per_message:>3} events per message: publish() {before:7.0f} events/s,"
+            f" RedisEventPublisher {after:7.0f} events/s"
+        )
+
+    buffered = BufferedRedisEventPublisher(client, max_events=500, max_delay=0.02)
+
+    def one_per_message(raised):
+        buffered("line_allocated", raised[0])
+        buffered.end_cycle()
+
+    start = time.perf_counter()
+    events_per_second(one_per_message, 1)
+    buffered.close()
+    print(
+        f"  1 event per message:  BufferedRedisEventPublisher"
+        f" {EVENTS / (time.perf_counter() - start):7.0f} events/s,"
+        f" in {buffered.stats()['flushes']} pipelines"
+    )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    socket.setdefaulttimeout(10)
+    main()
@@ -0,0 +1,106 @@
+"""
+GET /allocations/<orderid> latency, and the SQL it costs, with each read
+model: the allocations_view query alone, that query behind
+AllocationsCache, and RedisReadModel; for skewed reads of ORDERS orders,
+while every order is reallocated ROUNDS times.
+
+The database is a sqlite file, each statement taking DB_LATENCY seconds
+more, the network round trip; Redis is the unit tests' FakeRedis, taking
+REDIS_LATENCY seconds for each.
+
+    python -m tests.benchmarks.bench_read_model
+"""
+import os
+import random
+import tempfile
+import time
+from datetime import date, timedelta
+from unittest import mock
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from allocation import bootstrap, views
+from allocation.adapters import orm
+from allocation.adapters.read_model import AllocationsCache, RedisReadModel
+from allocation.domain import commands
+from allocation.service_layer import unit_of_work
+from tests.unit.test_read_model import FakeRedis
+
+SKU = "BENCH-SKU"
+ORDERS = 200
+READS = 4000
+ROUNDS = 4
+DB_LATENCY = 0.0005
+REDIS_LATENCY = 0.0002
+
+
+def make_bus(path, read_model, statements):
+    engine = create_engine(f"sqlite:///{path}")
+    orm.metadata.create_all(engine)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def round_trip(*_):
+        statements.append(1)
+        time.sleep(DB_LATENCY)
+
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine)),
+        notifications=mock.Mock(),
+        publish=lambda *_: None,
+        read_model=read_model,
+    )
+
+
+def run(path, read_model):
+    statements = []
+    bus = make_bus(path, read_model, statements)
+    today = date.today()
+    # orders go to the earliest batch, and each round empties it
+    for i in range(ROUNDS + 1):
+        bus.handle(commands.CreateBatch(f"batch-{i}", SKU, ORDERS, today + timedelta(i)))
+    for i in range(ORDERS):
+        bus.handle(commands.Allocate(f"order-{i}", SKU, 1))
+
+    rng = random.Random(0)
+    weights = [1 / (i + 1) for i in range(ORDERS)]
+    reads = rng.choices([f"order-{i}" for i in range(ORDERS)], weights, k=READS)
+    read_seconds, read_statements = 0.0, 0
+    for i, orderid in enumerate(reads):
+        if i and i % (READS // ROUNDS) == 0:
+            bus.handle(commands.ChangeBatchQuantity(f"batch-{i // (READS // ROUNDS) - 1}", 0))
+        before = len(statements)
+        start = time.perf_counter()
+        result = views.allocations(orderid, bus.uow, read_model)
+        read_seconds += time.perf_counter() - start
+        read_statements += len(statements) - before
+        assert len(result) == 1, result
+    writes = len(statements) - read_statements
+    return read_seconds / READS * 1e6, read_statements / READS, writes
+
+
+def main():
+    orm.start_mappers()
+    print(
+        f"{READS} reads of {ORDERS} orders, {ROUNDS} reallocations of them all,"
+        f" {DB_LATENCY * 1e6:.0f} us per statement, {REDIS_LATENCY * 1e6:.0f} us per redis call"
+    )
+    backends = [
+        ("postgres", lambda: None),
+        ("postgres+cache", lambda: AllocationsCache(FakeRedis(REDIS_LATENCY), ttl=60)),
+        ("redis", lambda: RedisReadModel(FakeRedis(REDIS_LATENCY))),
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, make_read_model in backends:
+            read_model = make_read_model()
+            per_read, statements, writes = run(os.path.join(tmp, f"{name}.db"), read_model)
+            stats = read_model.stats() if isinstance(read_model, AllocationsCache) else ""
+            print(
+                f"{name:<15} {per_read:6.0f} us per read, {statements:.2f} statements per read,"
+                f" {writes:5d} statements writing  {stats}"
+            )
+
+
+if __name__ == "__main__":
+    main()
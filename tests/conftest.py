@@ -2,6 +2,7 @@
 import shutil
 import subprocess
 import time
+from contextlib import contextmanager
 from pathlib import Path
 
 import pytest
@@ -9,16 +10,22 @@ import redis
 import requests
 from requests.exceptions import ConnectionError
 from sqlalchemy.exc import OperationalError
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, clear_mappers
 from tenacity import retry, stop_after_delay
 
 from allocation.adapters.orm import metadata, start_mappers
+from allocation.domain import model
 from allocation import config
 
 pytest.register_assert_rewrite("tests.e2e.api_client")
 
 
+@pytest.fixture(autouse=True)
+def debug_checks(monkeypatch):
+    monkeypatch.setattr(model, "DEBUG_CHECKS", True)
+
+
 @pytest.fixture
 def in_memory_sqlite_db():
     engine = create_engine("sqlite:///:memory:")
@@ -31,6 +38,42 @@ def sqlite_session_factory(in_memory_sqlite_db):
     yield sessionmaker(bind=in_memory_sqlite_db)
 
 
+@pytest.fixture
+def sqlite_file_session_factory(tmp_path):
+    """A file database, shared between threads, with working SAVEPOINTs"""
+    engine = create_engine(f"sqlite:///{tmp_path}/allocation.db")
+
+    @event.listens_for(engine, "connect")
+    def disable_pysqlite_transactions(dbapi_connection, _):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def begin(connection):
+        connection.execute("BEGIN")
+
+    metadata.create_all(engine)
+    yield sessionmaker(bind=engine)
+
+
+@pytest.fixture
+def max_statements(in_memory_sqlite_db):
+    @contextmanager
+    def max_statements(count):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(in_memory_sqlite_db, "before_cursor_execute", record)
+        try:
+            yield statements
+        finally:
+            event.remove(in_memory_sqlite_db, "before_cursor_execute", record)
+        assert len(statements) <= count, "\n\n".join(statements)
+
+    return max_statements
+
+
 @pytest.fixture
 def mappers():
     start_mappers()
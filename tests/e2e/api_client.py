@@ -10,6 +10,18 @@ def post_to_add_batch(ref, sku, qty, eta):
     assert r.status_code == 201
 
 
+def post_to_import_batches(batches):
+    url = config.get_api_url()
+    csv = "ref,sku,qty,eta\n" + "".join(
+        f"{ref},{sku},{qty},{eta or ''}\n" for ref, sku, qty, eta in batches
+    )
+    r = requests.post(
+        f"{url}/import_batches", data=csv, headers={"Content-Type": "text/csv"}
+    )
+    assert r.status_code == 201
+    return r
+
+
 def post_to_allocate(orderid, sku, qty, expect_success=True):
     url = config.get_api_url()
     r = requests.post(
@@ -25,6 +37,27 @@ def post_to_allocate(orderid, sku, qty, expect_success=True):
     return r
 
 
+def post_to_allocate_order(orderid, lines, expect_success=True):
+    url = config.get_api_url()
+    r = requests.post(
+        f"{url}/allocate_order",
+        json={
+            "orderid": orderid,
+            "lines": [{"sku": sku, "qty": qty} for sku, qty in lines],
+        },
+    )
+    if expect_success:
+        assert r.status_code == 202
+    return r
+
+
 def get_allocation(orderid):
     url = config.get_api_url()
     return requests.get(f"{url}/allocations/{orderid}")
+
+
+def get_metrics():
+    url = config.get_api_url()
+    r = requests.get(f"{url}/metrics")
+    assert r.status_code == 200
+    return r.text
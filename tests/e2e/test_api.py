@@ -45,6 +45,55 @@ def test_unhappy_path_returns_400_and_error_message():
 
     r = api_client.get_allocation(orderid)
     assert r.status_code == 404
+
+
+@pytest.mark.usefixtures('postgres_db')
+@pytest.mark.usefixtures('restart_api')
+def test_allocating_a_whole_order_returns_202_and_allocates_every_line():
+    orderid = random_orderid()
+    sku, othersku = random_sku(), random_sku('other')
+    batch, otherbatch = random_batchref(1), random_batchref(2)
+    api_client.post_to_add_batch(batch, sku, 100, None)
+    api_client.post_to_add_batch(otherbatch, othersku, 100, None)
+
+    r = api_client.post_to_allocate_order(orderid, [(sku, 3), (othersku, 5)])
+    assert r.status_code == 202
+
+    r = api_client.get_allocation(orderid)
+    assert r.ok
+    assert sorted(r.json(), key=lambda a: a['batchref']) == [
+        {'sku': sku, 'batchref': batch},
+        {'sku': othersku, 'batchref': otherbatch},
+    ]
+
+
+@pytest.mark.usefixtures('postgres_db')
+@pytest.mark.usefixtures('restart_api')
+def test_imported_batches_can_be_allocated():
+    orderid, sku = random_orderid(), random_sku()
+    earlybatch, laterbatch = random_batchref(1), random_batchref(2)
+    r = api_client.post_to_import_batches([
+        (laterbatch, sku, 100, '2011-01-02'),
+        (earlybatch, sku, 100, '2011-01-01'),
+    ])
+    assert r.json() == {'imported': 2}
+
+    api_client.post_to_allocate(orderid, sku, qty=3)
+
+    r = api_client.get_allocation(orderid)
+    assert r.json() == [{'sku': sku, 'batchref': earlybatch}]
+
+
+@pytest.mark.usefixtures('postgres_db')
+@pytest.mark.usefixtures('restart_api')
+def test_metrics_report_handler_latencies():
+    sku, batch, orderid = random_sku(), random_batchref(), random_orderid()
+    api_client.post_to_add_batch(batch, sku, 100, None)
+    api_client.post_to_allocate(orderid, sku, qty=3)
+
+    text = api_client.get_metrics()
+    assert 'allocation_handler_seconds_count{handler="allocate"} 1' in text
+    assert 'allocation_messages_total{message="Allocate",result="ok"} 1' in text
 ####################
 # End of new tests #
-####################
\ No newline at end of file
+####################
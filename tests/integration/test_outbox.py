@@ -0,0 +1,102 @@
+# pylint: disable=protected-access
+import json
+from unittest import mock
+import pytest
+from allocation import bootstrap
+from allocation.adapters import orm
+from allocation.adapters.outbox import OutboxRelay
+from allocation.domain import commands
+from allocation.service_layer import handlers, unit_of_work
+from .test_uow import insert_batch
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+class FakeRedis:
+    def __init__(self, fail=False):
+        self.published = []
+        self.pipelines = 0
+        self.fail = fail
+
+    def pipeline(self, transaction=True):
+        self.pipelines += 1
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def publish(self, channel, message):
+        self.commands.append((channel, message))
+
+    def execute(self):
+        if self.redis.fail:
+            raise ConnectionError("redis is down")
+        self.redis.published.extend(self.commands)
+
+
+def outbox_bus(session_factory, publish):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, outbox_channels=unit_of_work.OUTBOX_CHANNELS,
+    )
+    return bootstrap.bootstrap(
+        start_orm=False, uow=uow, notifications=mock.Mock(), publish=publish,
+    )
+
+
+def test_allocated_events_go_to_the_outbox_instead_of_redis(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "b1", "OUTBOX-LAMP", 100, None)
+    session.commit()
+    publish = mock.Mock()
+    bus = outbox_bus(sqlite_session_factory, publish)
+
+    bus.handle(commands.Allocate("o1", "OUTBOX-LAMP", 10))
+    with pytest.raises(handlers.InvalidSku):
+        bus.handle(commands.Allocate("o2", "NO-SUCH-LAMP", 10))
+
+    publish.assert_not_called()
+    rows = sqlite_session_factory().execute(
+        "SELECT channel, payload, sent_at FROM outbox"
+    ).fetchall()
+    assert [(channel, json.loads(payload), sent_at) for channel, payload, sent_at in rows] == [
+        ("line_allocated", dict(orderid="o1", sku="OUTBOX-LAMP", qty=10, batchref="b1"), None),
+    ]
+
+
+def test_relay_publishes_in_batches_and_marks_rows_sent(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "b1", "RELAYED-LAMP", 100, None)
+    session.commit()
+    bus = outbox_bus(sqlite_session_factory, mock.Mock())
+    for i in range(5):
+        bus.handle(commands.Allocate(f"o{i}", "RELAYED-LAMP", 1))
+    redis = FakeRedis()
+    relay = OutboxRelay(sqlite_session_factory, redis, batch_size=2)
+    assert relay.stats()["pending"] == 5
+    assert relay.stats()["lag_seconds"] >= 0
+
+    while relay.relay_once():
+        pass
+
+    assert [json.loads(m)["orderid"] for _, m in redis.published] == [
+        f"o{i}" for i in range(5)
+    ]
+    assert redis.pipelines == 3
+    assert relay.stats()["pending"] == 0
+    assert relay.stats()["lag_seconds"] == 0.0
+    assert relay.stats()["sent"] == 5
+
+
+def test_relay_leaves_rows_unsent_when_redis_fails(sqlite_session_factory):
+    session = sqlite_session_factory()
+    session.execute(orm.outbox.insert(), [dict(channel="line_allocated", payload="{}")])
+    session.commit()
+    relay = OutboxRelay(sqlite_session_factory, FakeRedis(fail=True))
+
+    with pytest.raises(ConnectionError):
+        relay.relay_once()
+
+    assert relay.stats()["pending"] == 1
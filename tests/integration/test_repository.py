@@ -1,7 +1,10 @@
 # pylint: disable=protected-access
 import pytest
+from sqlalchemy.exc import IntegrityError
 import allocation.domain.model as model
+import allocation.adapters.orm as orm
 import allocation.adapters.repository as repository
+from allocation.adapters.product_cache import ProductCache
 
 
 pytestmark = pytest.mark.usefixtures("mappers")
@@ -19,3 +22,159 @@ def test_get_by_batchref(sqlite_session_factory):
     repo.add(p2)
     assert repo.get_by_batchref("b2") == p1
     assert repo.get_by_batchref("b3") == p2
+
+
+def test_allocated_quantity_is_rebuilt_when_a_batch_is_loaded(sqlite_session_factory):
+    session = sqlite_session_factory()
+    batch = model.Batch(ref="b1", sku="sku1", qty=100, eta=None)
+    batch.allocate(model.OrderLine("o1", "sku1", 10))
+    batch.allocate(model.OrderLine("o2", "sku1", 20))
+    session.add(model.Product(sku="sku1", batches=[batch]))
+    session.commit()
+
+    [batch] = repository.SqlAlchemyRepository(sqlite_session_factory()).get("sku1").batches
+    assert batch.allocated_quantity == 30
+    batch.deallocate(model.OrderLine("o1", "sku1", 10))
+    assert batch.available_quantity == 80
+
+
+def insert_product_with_allocations(session, sku, batch_count, lines_per_batch):
+    batches = []
+    for i in range(batch_count):
+        batch = model.Batch(ref=f"{sku}-b{i}", sku=sku, qty=100, eta=None)
+        for j in range(lines_per_batch):
+            batch.allocate(model.OrderLine(f"o{i}-{j}", sku, 1))
+        batches.append(batch)
+    session.add(model.Product(sku=sku, batches=batches))
+    session.commit()
+
+
+def touch_every_allocation(product):
+    return sum(b.allocated_quantity for b in product.batches)
+
+
+@pytest.mark.parametrize("loading, statements", [
+    ("selectin", 3), ("subquery", 3), ("joined", 1),
+])
+def test_loads_a_product_in_a_fixed_number_of_statements(
+    sqlite_session_factory, max_statements, loading, statements
+):
+    insert_product_with_allocations(sqlite_session_factory(), "sku1", 50, 3)
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory(), loading=loading)
+    with max_statements(statements):
+        assert touch_every_allocation(repo.get("sku1")) == 150
+
+    # plus the batchref -> sku lookup
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory(), loading=loading)
+    with max_statements(statements + 1):
+        assert touch_every_allocation(repo.get_by_batchref("sku1-b7")) == 150
+
+
+def test_get_many_loads_every_product_in_a_fixed_number_of_statements(
+    sqlite_session_factory, max_statements
+):
+    for sku in ("sku1", "sku2", "sku3"):
+        insert_product_with_allocations(sqlite_session_factory(), sku, 20, 2)
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory())
+
+    with max_statements(3):
+        products = repo.get_many(["sku1", "sku3", "nonexistent"])
+        assert sum(touch_every_allocation(p) for p in products) == 80
+    assert {p.sku for p in products} == {"sku1", "sku3"}
+    assert repo.seen == set(products)
+
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory())
+    with max_statements(4):
+        products = repo.get_many_by_batchref(["sku1-b1", "sku1-b2", "sku2-b0"])
+        assert sum(touch_every_allocation(p) for p in products) == 80
+    assert {p.sku for p in products} == {"sku1", "sku2"}
+
+
+def test_summary_loading_reads_totals_instead_of_order_lines(
+    sqlite_session_factory, max_statements
+):
+    insert_product_with_allocations(sqlite_session_factory(), "sku1", 50, 3)
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory(), loading="summary")
+    with max_statements(3):
+        product = repo.get("sku1")
+        assert touch_every_allocation(product) == 150
+    assert all(b._allocations == set() for b in product.batches)
+
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory(), loading="summary")
+    with max_statements(3):
+        [product] = repo.get_many(["sku1"])
+        assert touch_every_allocation(product) == 150
+
+
+def test_summary_loading_adds_allocations_without_dropping_old_ones(
+    sqlite_session_factory,
+):
+    insert_product_with_allocations(sqlite_session_factory(), "sku1", 1, 3)
+    session = sqlite_session_factory()
+    repo = repository.SqlAlchemyRepository(session, loading="summary")
+    repo.get("sku1").allocate(model.OrderLine("o-new", "sku1", 10))
+    session.commit()
+
+    # batchref lookups load whole aggregates, with old and new lines
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory(), loading="summary")
+    [batch] = repo.get_by_batchref("sku1-b0").batches
+    assert len(batch._allocations) == 4
+    assert batch.allocated_quantity == 13
+
+
+def test_get_many_takes_current_products_from_the_cache(sqlite_session_factory):
+    for sku in ("sku1", "sku2"):
+        insert_product_with_allocations(sqlite_session_factory(), sku, 2, 1)
+    cache = ProductCache(max_entries=10, max_bytes=10 ** 6)
+    session = sqlite_session_factory()
+    cached = repository.SqlAlchemyRepository(session).get("sku1")
+    session.expunge(cached)
+    cache.put(cached)
+
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory(), cache=cache)
+    products = repo.get_many(["sku1", "sku2"])
+
+    assert cached in products
+    assert {p.sku for p in products} == {"sku1", "sku2"}
+    assert cache.stats()["hits"] == 1
+
+
+def test_add_batches_inserts_batches_and_missing_products(sqlite_session_factory):
+    insert_product_with_allocations(sqlite_session_factory(), "sku1", 1, 0)
+    session = sqlite_session_factory()
+    repo = repository.SqlAlchemyRepository(session)
+    repo.add_batches([
+        model.Batch("new1", "sku1", 10, None),
+        model.Batch("new2", "sku2", 20, None),
+        model.Batch("new3", "sku2", 30, None),
+    ])
+    session.commit()
+
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory())
+    sku1, sku2 = repo.get("sku1"), repo.get("sku2")
+    assert {b.reference for b in sku1.batches} == {"sku1-b0", "new1"}
+    assert sku1.version_number == 1
+    assert sorted(b.available_quantity for b in sku2.batches) == [20, 30]
+
+
+def test_get_by_unknown_batchref_returns_none(sqlite_session_factory):
+    repo = repository.SqlAlchemyRepository(sqlite_session_factory())
+    assert repo.get_by_batchref("nonexistent") is None
+
+
+def test_batch_references_are_unique(sqlite_session_factory):
+    session = sqlite_session_factory()
+    session.add(model.Product(sku="sku1", batches=[model.Batch("b1", "sku1", 10, None)]))
+    session.add(model.Product(sku="sku2", batches=[model.Batch("b1", "sku2", 10, None)]))
+    with pytest.raises(IntegrityError):
+        session.commit()
+
+
+def test_creates_indexes_missing_from_an_existing_database(in_memory_sqlite_db):
+    in_memory_sqlite_db.execute("DROP INDEX ix_batches_reference")
+    in_memory_sqlite_db.execute("DROP INDEX ix_allocations_batch_id_orderline_id")
+
+    assert orm.create_missing_indexes(in_memory_sqlite_db) == [
+        "ix_batches_reference", "ix_allocations_batch_id_orderline_id",
+    ]
+    assert orm.create_missing_indexes(in_memory_sqlite_db) == []
@@ -1,11 +1,20 @@
+import asyncio
 import threading
 import time
 import traceback
 from typing import List
+from unittest import mock
 import pytest
-from allocation.domain import model
-from allocation.service_layer import unit_of_work
+from sqlalchemy import create_engine, exc
+from sqlalchemy.orm import sessionmaker
+from allocation.adapters.product_cache import ProductCache
+from allocation import bootstrap
+from allocation.adapters import orm
+from allocation.domain import commands, events, model
+from allocation.entrypoints import bulk_import
+from allocation.service_layer import handlers, messagebus, unit_of_work
 from ..e2e.test_api import random_batchref, random_orderid, random_sku
+from ..unit.test_handlers import FakeNotifications
 
 pytestmark = pytest.mark.usefixtures("mappers")
 
@@ -59,6 +68,117 @@ def test_rolls_back_uncommitted_work_by_default(sqlite_session_factory):
     rows = list(new_session.execute('SELECT * FROM "batches"'))
     assert rows == []
 
+def allocate_with_cache(session_factory, cache, orderid, sku, qty=10):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, product_cache=cache)
+    with uow:
+        product = uow.products.get(sku=sku)
+        batchref = product.allocate(model.OrderLine(orderid, sku, qty))
+        uow.commit()
+    return batchref
+
+
+def test_cached_products_are_reused_across_units_of_work(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "LAZY-BEANBAG", 100, None)
+    session.commit()
+    cache = ProductCache(max_entries=10, max_bytes=10 ** 6)
+
+    allocate_with_cache(sqlite_session_factory, cache, "o1", "LAZY-BEANBAG")
+    allocate_with_cache(sqlite_session_factory, cache, "o2", "LAZY-BEANBAG")
+    allocate_with_cache(sqlite_session_factory, cache, "o3", "LAZY-BEANBAG")
+
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["hits"] == 2
+    [[allocated]] = session.execute(
+        "SELECT sum(qty) FROM order_lines WHERE sku = 'LAZY-BEANBAG'"
+    )
+    assert allocated == 30
+
+
+def test_stale_cached_products_are_reloaded(sqlite_session_factory):
+    session = sqlite_session_factory()
+    insert_batch(session, "batch1", "TATTY-HAMMOCK", 10, None)
+    session.commit()
+    cache = ProductCache(max_entries=10, max_bytes=10 ** 6)
+    allocate_with_cache(sqlite_session_factory, cache, "o1", "TATTY-HAMMOCK", 5)
+
+    # another process allocates the rest
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=None)
+    with uow:
+        uow.products.get(sku="TATTY-HAMMOCK").allocate(
+            model.OrderLine("o2", "TATTY-HAMMOCK", 5)
+        )
+        uow.commit()
+
+    assert allocate_with_cache(sqlite_session_factory, cache, "o3", "TATTY-HAMMOCK", 5) is None
+    assert cache.stats()["stale"] == 1
+
+
+def test_cached_products_events_stay_with_the_thread_that_raised_them(
+    sqlite_file_session_factory,
+):
+    session_factory = sqlite_file_session_factory
+    session = session_factory()
+    insert_batch(session, "batch1", "SHY-OTTOMAN", 100, None)
+    session.commit()
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        session_factory, product_cache=ProductCache(max_entries=10, max_bytes=10 ** 6)
+    )
+    collected = {}
+
+    def allocate(orderid):
+        with uow:
+            uow.products.get(sku="SHY-OTTOMAN").allocate(
+                model.OrderLine(orderid, "SHY-OTTOMAN", 10)
+            )
+            uow.commit()
+
+    def collect(orderid):
+        collected[orderid] = [e.orderid for e in uow.collect_new_events()]
+
+    # o1's thread commits, and o2's takes the cached product before o1's
+    # events are collected
+    allocate("o1")
+    other = threading.Thread(target=lambda: (allocate("o2"), collect("o2")))
+    other.start()
+    other.join()
+    collect("o1")
+
+    assert collected == {"o1": ["o1"], "o2": ["o2"]}
+
+
+def test_bulk_import_stops_at_a_duplicate_reference(sqlite_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=False, uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(), publish=mock.Mock(),
+    )
+    lines = ["ref,sku,qty,eta\n"] + [
+        f"{ref},ODD-SOCK,10,\n" for ref in ["b1", "b2", "b3", "b4", "b1", "b6"]
+    ]
+
+    with pytest.raises(bulk_import.ImportFailed) as failure:
+        bulk_import.import_batches(bus, lines, "csv", chunk_size=2)
+
+    assert failure.value.duplicate
+    assert failure.value.imported == 4
+
+
+def test_bulk_import_reports_a_duplicate_copied_into_postgres(postgres_session_factory):
+    bus = bootstrap.bootstrap(
+        start_orm=False, uow=unit_of_work.SqlAlchemyUnitOfWork(postgres_session_factory),
+        notifications=mock.Mock(), publish=mock.Mock(),
+    )
+    sku = random_sku()
+    refs = [random_batchref(i) for i in range(4)]
+    lines = ["ref,sku,qty,eta\n"] + [f"{ref},{sku},10,\n" for ref in refs + refs[:1]]
+
+    with pytest.raises(bulk_import.ImportFailed) as failure:
+        bulk_import.import_batches(bus, lines, "csv", chunk_size=2)
+
+    assert failure.value.duplicate
+    assert failure.value.imported == 4
+
+
 def try_to_allocate(orderid, sku, exceptions, session_factory):
     line = model.OrderLine(orderid, sku, 10)
     try:
@@ -116,4 +236,320 @@ def test_concurrent_updates_to_version_are_not_allowed(postgres_session_factory)
 
     assert orders.rowcount == 1
     with unit_of_work.SqlAlchemyUnitOfWork(postgres_session_factory) as uow:
-        uow.session.execute('select 1')
\ No newline at end of file
+        uow.session.execute('select 1')
+
+
+def test_updates_from_a_stale_version_are_rejected(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/versions.db")
+    orm.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    session = session_factory()
+    insert_batch(session, "batch1", "CONTESTED-TABLE", 100, None)
+    session.commit()
+
+    first, second = session_factory(), session_factory()
+    for orderid, s in (("o1", first), ("o2", second)):
+        s.query(model.Product).get("CONTESTED-TABLE").allocate(
+            model.OrderLine(orderid, "CONTESTED-TABLE", 10)
+        )
+    first.commit()
+    with pytest.raises(exc.SQLAlchemyError) as conflict:
+        second.commit()
+    assert unit_of_work.is_concurrency_error(conflict.value)
+
+    [[version]] = session.execute(
+        "SELECT version_number FROM products WHERE sku='CONTESTED-TABLE'"
+    )
+    assert version == 2
+
+
+def test_default_engine_is_created_on_first_use_from_config(monkeypatch):
+    monkeypatch.setattr(unit_of_work, "_engines", {})
+    monkeypatch.setenv("DB_POOL_SIZE", "3")
+    monkeypatch.setenv("DB_MAX_OVERFLOW", "1")
+    assert unit_of_work.pool_stats() == {}
+
+    engine = unit_of_work.get_default_engine()
+    assert engine is unit_of_work.get_default_engine()
+    assert isinstance(engine.pool, unit_of_work.InstrumentedQueuePool)
+    assert unit_of_work.pool_stats()["size"] == 3
+    assert engine.pool._max_overflow == 1
+
+
+def test_pool_records_checkout_wait_and_utilisation(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path}/pool.db",
+        poolclass=unit_of_work.InstrumentedQueuePool,
+        pool_size=1, max_overflow=0, pool_timeout=0.05,
+    )
+    held = engine.connect()
+    assert engine.pool.stats()["utilisation"] == 1.0
+    with pytest.raises(exc.TimeoutError):
+        engine.connect()
+    held.close()
+
+    stats = engine.pool.stats()
+    assert stats["checkouts"] == 2
+    assert stats["max_checkout_wait_seconds"] >= 0.05
+    assert stats["utilisation"] == 0.0
+
+
+def test_connections_from_before_a_fork_are_replaced(tmp_path, monkeypatch):
+    engine = create_engine(
+        f"sqlite:///{tmp_path}/fork.db", poolclass=unit_of_work.InstrumentedQueuePool,
+    )
+    unit_of_work._make_fork_safe(engine)
+    with engine.connect() as connection:
+        parent_dbapi_connection = connection.connection.connection
+
+    monkeypatch.setattr(unit_of_work.os, "getpid", lambda: -1)
+    with engine.connect() as connection:
+        assert connection.connection.connection is not parent_dbapi_connection
+
+
+def allocate_in_group(uow, orderid, sku, qty):
+    with uow:
+        product = uow.products.get(sku=sku)
+        if product is None:
+            raise ValueError(f"no product {sku}")
+        product.allocate(model.OrderLine(orderid, sku, qty))
+        uow.commit()
+
+
+def test_group_commits_blocks_together_and_rolls_back_failures_alone(
+    sqlite_file_session_factory,
+):
+    session = sqlite_file_session_factory()
+    insert_batch(session, "batch1", "GROUPED-LAMP", 100, None)
+    session.commit()
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory)
+    with uow.group():
+        allocate_in_group(uow, "o1", "GROUPED-LAMP", 10)
+        with pytest.raises(ValueError):
+            allocate_in_group(uow, "o2", "MISSING-LAMP", 10)
+        with pytest.raises(ZeroDivisionError):
+            with uow:
+                uow.products.get("GROUPED-LAMP").allocate(
+                    model.OrderLine("o3", "GROUPED-LAMP", 20)
+                )
+                1 / 0
+        allocate_in_group(uow, "o4", "GROUPED-LAMP", 30)
+
+    rows = sqlite_file_session_factory().execute(
+        "SELECT orderid FROM order_lines ORDER BY orderid"
+    ).fetchall()
+    assert [orderid for orderid, in rows] == ["o1", "o4"]
+    [[version]] = sqlite_file_session_factory().execute(
+        "SELECT version_number FROM products"
+    )
+    assert version == 3
+
+
+@pytest.mark.parametrize("cached", [False, True])
+def test_a_duplicate_batch_in_a_group_fails_alone(sqlite_file_session_factory, cached):
+    session = sqlite_file_session_factory()
+    insert_batch(session, "batch1", "DUPLICATED-LAMP", 100, None)
+    session.commit()
+
+    cache = ProductCache(max_entries=10, max_bytes=10 ** 6) if cached else None
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory, product_cache=cache)
+    with uow.group():
+        handlers.add_batch(events.BatchCreated("batch2", "OTHER-LAMP", 100), uow)
+        with pytest.raises(exc.IntegrityError):
+            handlers.add_batch(events.BatchCreated("batch1", "DUPLICATED-LAMP", 50), uow)
+        assert list(uow.collect_new_events()) == []
+
+    rows = sqlite_file_session_factory().execute(
+        "SELECT reference, _purchased_quantity FROM batches ORDER BY reference"
+    )
+    assert list(rows) == [("batch1", 100), ("batch2", 100)]
+    if cached:
+        # the product the failed block changed was expired, not cached
+        assert cache.stats()["entries"] == 1
+
+
+def test_changing_a_batch_in_a_group_loads_the_allocations_summary_loading_left_out(
+    sqlite_file_session_factory,
+):
+    session = sqlite_file_session_factory()
+    insert_batch(session, "batch1", "SUMMED-LAMP", 100, None)
+    session.commit()
+    handlers.allocate(
+        commands.Allocate("o1", "SUMMED-LAMP", 30),
+        unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory, product_cache=None),
+    )
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(
+        sqlite_file_session_factory, product_cache=None, loading="summary"
+    )
+    with uow.group():
+        handlers.allocate(commands.Allocate("o2", "SUMMED-LAMP", 10), uow)
+        handlers.change_batch_quantity(commands.ChangeBatchQuantity("batch1", 5), uow)
+        deallocated = sorted(e.orderid for e in uow.collect_new_events()
+                             if isinstance(e, events.Deallocated))
+
+    assert deallocated == ["o1", "o2"]
+    rows = sqlite_file_session_factory().execute("SELECT count(*) FROM allocations")
+    assert list(rows) == [(0,)]
+
+
+def test_group_commit_bus_commits_concurrent_commands_in_groups(
+    sqlite_file_session_factory, monkeypatch,
+):
+    session = sqlite_file_session_factory()
+    insert_batch(session, "batch1", "BUSY-LAMP", 1000, None)
+    session.commit()
+
+    group_sizes = []
+    uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory)
+    group = uow.group
+
+    def counting_group():
+        group_sizes.append(0)
+        return group()
+    uow.group = counting_group
+
+    monkeypatch.setenv("GROUP_COMMIT_MAX_SIZE", "10")
+    monkeypatch.setenv("GROUP_COMMIT_WINDOW_MS", "50")
+    bus = bootstrap.bootstrap(
+        start_orm=False, uow=uow, notifications=mock.Mock(), publish=mock.Mock(),
+    )
+    assert isinstance(bus, messagebus.GroupCommitMessageBus)
+    errors = []
+
+    def allocate(orderid, sku):
+        try:
+            bus.handle(commands.Allocate(orderid, sku, 1))
+        except Exception as e:  # pylint: disable=broad-except
+            errors.append(e)
+
+    threads = [
+        threading.Thread(target=allocate, args=(f"o{i}", "BUSY-LAMP")) for i in range(20)
+    ] + [threading.Thread(target=allocate, args=("bad", "NO-SUCH-LAMP"))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    bus.close()
+
+    assert [type(e) for e in errors] == [handlers.InvalidSku]
+    [[count]] = sqlite_file_session_factory().execute("SELECT count(*) FROM allocations")
+    assert count == 20
+    assert len(group_sizes) < 21
+
+
+def test_group_commit_bus_publishes_nothing_for_a_group_that_failed_to_commit(
+    sqlite_file_session_factory, monkeypatch,
+):
+    session = sqlite_file_session_factory()
+    insert_batch(session, "batch1", "DOOMED-LAMP", 100, None)
+    session.commit()
+
+    def failing_session_factory():
+        session = sqlite_file_session_factory()
+        session.commit = mock.Mock(side_effect=exc.OperationalError("COMMIT", {}, "disk I/O"))
+        return session
+
+    monkeypatch.setenv("GROUP_COMMIT_MAX_SIZE", "10")
+    publish = mock.Mock()
+    bus = bootstrap.bootstrap(
+        start_orm=False, uow=unit_of_work.SqlAlchemyUnitOfWork(failing_session_factory),
+        notifications=mock.Mock(), publish=publish,
+    )
+    with pytest.raises(exc.OperationalError):
+        bus.handle(commands.Allocate("o1", "DOOMED-LAMP", 10))
+    bus.close()
+
+    assert publish.call_count == 0
+
+
+def test_async_bus_runs_concurrent_commands_with_a_session_each(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path}/async.db", connect_args={"timeout": 30},
+    )
+    orm.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    session = session_factory()
+    for i in range(5):
+        insert_batch(session, f"batch{i}", f"ASYNC-SKU-{i}", 100, None)
+    session.commit()
+
+    sessions = set()
+    def tracking_session_factory():
+        session = session_factory()
+        sessions.add(threading.get_ident())
+        return session
+
+    published = []
+    async def publish(channel, event):
+        await asyncio.sleep(0.01)
+        published.append(event.orderid)
+
+    uow = unit_of_work.SqlAlchemyUnitOfWork(tracking_session_factory)
+    bus = bootstrap.bootstrap(
+        start_orm=False, uow=uow, notifications=mock.Mock(), publish=publish,
+        asynchronous=True,
+    )
+
+    async def allocate_all():
+        await asyncio.gather(*(
+            bus.handle(commands.Allocate(f"o{i}", f"ASYNC-SKU-{i % 5}", 1))
+            for i in range(20)
+        ))
+    asyncio.run(allocate_all())
+    bus.close()
+
+    assert sorted(published) == sorted(f"o{i}" for i in range(20))
+    assert len(sessions) > 1
+    [[count]] = session_factory().execute("SELECT count(*) FROM allocations_view")
+    assert count == 20
+
+
+class FileSessionFactory:
+    """Sessions on a sqlite file, which pickle to the file's path for bus workers"""
+
+    def __init__(self, path):
+        self.path = path
+        self._sessionmaker = None
+
+    def __call__(self):
+        if self._sessionmaker is None:
+            engine = create_engine(f"sqlite:///{self.path}", connect_args={"timeout": 30})
+            orm.metadata.create_all(engine)
+            self._sessionmaker = sessionmaker(bind=engine)
+        return self._sessionmaker()
+
+    def __getstate__(self):
+        return dict(path=self.path, _sessionmaker=None)
+
+
+def discard(*_):
+    pass
+
+
+def test_partitioned_bus_allocates_from_several_processes(tmp_path):
+    session_factory = FileSessionFactory(tmp_path / "partitioned.db")
+    session = session_factory()
+    for i in range(4):
+        insert_batch(session, f"batch{i}", f"PARTITIONED-SKU-{i}", 100, None)
+    session.commit()
+
+    # the workers are handed these pickled, see PartitionedMessageBus
+    bus = bootstrap.bootstrap(
+        start_orm=False, uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory),
+        notifications=FakeNotifications(), publish=discard, workers=2,
+    )
+    try:
+        for i in range(20):
+            bus.handle(commands.Allocate(f"o{i}", f"PARTITIONED-SKU-{i % 4}", 1))
+        bus.handle(commands.ChangeBatchQuantity("batch0", 2))
+        with pytest.raises(handlers.InvalidSku):
+            bus.handle(commands.Allocate("o99", "NONESUCH", 1))
+    finally:
+        bus.close()
+
+    # three of batch0's five lines no longer fit, and have nowhere else to go
+    [[count]] = session_factory().execute("SELECT count(*) FROM allocations_view")
+    assert count == 17
+    assert sum(bus.stats()["handled"].values()) == 22
@@ -3,11 +3,15 @@ import pytest
 from datetime import date
 from sqlalchemy.orm import clear_mappers
 
-from allocation import views
+from allocation import metrics, views
 from allocation import bootstrap
+from allocation.adapters.read_model import AllocationsCache, RedisReadModel
 from allocation.domain import commands
+from allocation.entrypoints import migrate
 from allocation.service_layer import messagebus, unit_of_work
 
+from ..unit.test_read_model import FakeRedis
+
 today = date.today()
 
 
@@ -47,4 +51,128 @@ def test_deallocation(sqlite_bus):
     assert views.allocations("o1", sqlite_bus.uow) == [
         {"sku": "sku1", "batchref": "b2"},
     ]
-    
\ No newline at end of file
+    
+
+def test_deallocating_many_lines_takes_one_transaction_per_step(sqlite_session_factory):
+    sessions = []
+
+    def counting_session_factory():
+        sessions.append(sqlite_session_factory())
+        return sessions[-1]
+
+    bus = bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(counting_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None
+    )
+    try:
+        bus.handle(commands.CreateBatch("b1", "sku1", 200, None))
+        bus.handle(commands.CreateBatch("b2", "sku1", 200, today))
+        for i in range(200):
+            bus.handle(commands.Allocate(f"o{i}", "sku1", 1))
+
+        del sessions[:]
+        bus.handle(commands.ChangeBatchQuantity("b1", 50))
+
+        # the change, the reallocation, and the new read-model rows
+        assert len(sessions) == 3
+        moved = [
+            i for i in range(200)
+            if views.allocations(f"o{i}", bus.uow) == [{"sku": "sku1", "batchref": "b2"}]
+        ]
+        assert len(moved) == 150
+        assert all(
+            views.allocations(f"o{i}", bus.uow) == [{"sku": "sku1", "batchref": "b1"}]
+            for i in set(range(200)) - set(moved)
+        )
+    finally:
+        clear_mappers()
+
+
+def read_model_bus(sqlite_session_factory, read_model):
+    return bootstrap.bootstrap(
+        start_orm=True,
+        uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+        notifications=mock.Mock(),
+        publish=lambda *args: None,
+        read_model=read_model,
+    )
+
+
+@pytest.mark.parametrize("make_read_model", [
+    lambda redis: RedisReadModel(redis),
+    lambda redis: AllocationsCache(redis, ttl=60),
+])
+def test_read_models_answer_as_the_view_does(sqlite_session_factory, make_read_model):
+    read_model = make_read_model(FakeRedis())
+    bus = read_model_bus(sqlite_session_factory, read_model)
+    try:
+        bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+        bus.handle(commands.CreateBatch("b2", "sku1", 50, today))
+        bus.handle(commands.CreateBatch("b3", "sku2", 50, None))
+        bus.handle(commands.Allocate("o1", "sku1", 40))
+        bus.handle(commands.Allocate("o1", "sku2", 10))
+        bus.handle(commands.Allocate("o2", "sku1", 5))
+        assert views.allocations("o1", bus.uow, read_model) == [
+            {"sku": "sku1", "batchref": "b1"}, {"sku": "sku2", "batchref": "b3"},
+        ]
+        # moves o1's sku1 line to b2, but leaves o2's in b1
+        bus.handle(commands.ChangeBatchQuantity("b1", 10))
+
+        def by_sku(orderid):
+            return sorted(views.allocations(orderid, bus.uow, read_model), key=lambda r: r["sku"])
+
+        assert by_sku("o1") == [
+            {"sku": "sku1", "batchref": "b2"}, {"sku": "sku2", "batchref": "b3"},
+        ]
+        assert by_sku("o2") == [{"sku": "sku1", "batchref": "b1"}]
+        assert by_sku("o3") == []
+    finally:
+        clear_mappers()
+
+
+def test_backfilled_read_model_answers_for_orders_allocated_before_it(
+    in_memory_sqlite_db, sqlite_session_factory,
+):
+    bus = read_model_bus(sqlite_session_factory, None)
+    try:
+        bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+        bus.handle(commands.CreateBatch("b2", "sku2", 50, None))
+        for i in range(5):
+            bus.handle(commands.Allocate(f"o{i}", "sku1", 1))
+        bus.handle(commands.Allocate("o0", "sku2", 1))
+    finally:
+        clear_mappers()
+
+    redis = FakeRedis()
+    read_model = RedisReadModel(redis)
+    assert migrate.backfill_read_model(in_memory_sqlite_db, read_model, batch_size=2) == 6
+    assert redis.round_trips == 3
+
+    assert read_model.allocations("o0") == [
+        {"sku": "sku1", "batchref": "b1"}, {"sku": "sku2", "batchref": "b2"},
+    ]
+    assert read_model.allocations("o4") == [{"sku": "sku1", "batchref": "b1"}]
+    assert read_model.allocations("o5") == []
+
+
+def test_cached_allocations_are_read_once_until_invalidated(sqlite_session_factory):
+    cache = AllocationsCache(FakeRedis(), ttl=60)
+    bus = read_model_bus(sqlite_session_factory, cache)
+    try:
+        bus.handle(commands.CreateBatch("b1", "sku1", 50, None))
+        bus.handle(commands.CreateBatch("b2", "sku1", 50, today))
+        bus.handle(commands.Allocate("o1", "sku1", 40))
+
+        queries = metrics.REGISTRY.counter(views.VIEW_QUERIES)
+        for _ in range(3):
+            views.allocations("o1", bus.uow, cache)
+        assert metrics.REGISTRY.counter(views.VIEW_QUERIES) == queries + 1
+
+        bus.handle(commands.ChangeBatchQuantity("b1", 10))
+        assert views.allocations("o1", bus.uow, cache) == [{"sku": "sku1", "batchref": "b2"}]
+        assert metrics.REGISTRY.counter(views.VIEW_QUERIES) == queries + 2
+        assert cache.stats()["hits"] == 2
+    finally:
+        clear_mappers()
@@ -1,4 +1,5 @@
 from datetime import date
+import pytest
 from allocation.domain.model import Batch, OrderLine
 
 
@@ -57,3 +58,19 @@ def test_can_only_deallocate_allocated_lines():
     batch, unallocated_line = make_batch_and_line("DECORATIVE-TRINKET", 20, 2)
     batch.deallocate(unallocated_line)
     assert batch.available_quantity == 20
+
+
+def test_deallocate_one_reduces_the_allocated_quantity():
+    batch, line = make_batch_and_line("SHINY-COASTER", 20, 2)
+    batch.allocate(line)
+    batch.allocate(OrderLine("order-456", "SHINY-COASTER", 5))
+    deallocated = batch.deallocate_one()
+    assert batch.allocated_quantity == 7 - deallocated.qty
+
+
+def test_debug_checks_catch_an_allocated_quantity_out_of_sync():
+    batch, line = make_batch_and_line("CRACKED-VASE", 20, 2)
+    batch.allocate(line)
+    batch._allocations.clear()
+    with pytest.raises(AssertionError):
+        batch.available_quantity
@@ -0,0 +1,65 @@
+import subprocess
+import sys
+import textwrap
+from allocation import bootstrap
+from allocation.adapters import notifications
+from allocation.domain import commands
+from .test_handlers import bootstrap_test_app
+
+# generous, so that only a regression back to connecting at import fails it
+IMPORT_BUDGET_SECONDS = 1.5
+
+IMPORT_WITHOUT_NETWORK = textwrap.dedent("""
+    import socket
+    import time
+
+    def refuse(sock, address):
+        raise AssertionError(f"connection to {address} while starting up")
+
+    socket.socket.connect = refuse
+    start = time.perf_counter()
+    from allocation import bootstrap
+    bootstrap.bootstrap(start_orm=False)
+    print(time.perf_counter() - start)
+""")
+
+
+def test_importing_and_bootstrapping_opens_no_connections():
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_WITHOUT_NETWORK],
+        capture_output=True, text=True, check=False,
+    )
+    assert result.returncode == 0, result.stderr
+    assert float(result.stdout) < IMPORT_BUDGET_SECONDS
+
+
+def test_email_notifications_connect_on_first_send(monkeypatch):
+    connections = []
+
+    class FakeSMTP:
+        def __init__(self, host, port):
+            connections.append((host, port))
+            self.sent = []
+
+        def noop(self):
+            pass
+
+        def sendmail(self, from_addr, to_addrs, msg):
+            self.sent.append(to_addrs)
+
+    monkeypatch.setattr(notifications.smtplib, "SMTP", FakeSMTP)
+    email = notifications.EmailNotifications("mail.example.com", 25)
+    bootstrap.bootstrap(start_orm=False, notifications=email)
+    assert connections == []
+
+    email.send("a@example.com", "hi")
+    email.send("b@example.com", "hi")
+    assert connections == [("mail.example.com", 25)]
+    assert email.server.sent == [["a@example.com"], ["b@example.com"]]
+
+
+def test_looks_up_the_sku_of_a_batchref():
+    bus = bootstrap_test_app()
+    bus.handle(commands.CreateBatch("b1", "DUSTY-SHELF", 10, None))
+    assert bootstrap.sku_for_batchref(bus.uow, "b1") == "DUSTY-SHELF"
+    assert bootstrap.sku_for_batchref(bus.uow, "b2") is None
@@ -0,0 +1,73 @@
+from datetime import date
+import pytest
+from allocation.domain import commands
+from allocation.entrypoints import bulk_import
+from .test_handlers import bootstrap_test_app
+
+
+def test_parses_csv():
+    lines = ["ref,sku,qty,eta\n", "b1,RED-CHAIR,10,2011-01-02\n", "b2,RED-CHAIR,5,\n"]
+    assert list(bulk_import.parse_csv(lines)) == [
+        commands.CreateBatch("b1", "RED-CHAIR", 10, date(2011, 1, 2)),
+        commands.CreateBatch("b2", "RED-CHAIR", 5, None),
+    ]
+
+
+def test_parses_ndjson():
+    lines = [
+        '{"ref": "b1", "sku": "RED-CHAIR", "qty": 10, "eta": "2011-01-02"}\n',
+        "\n",
+        '{"ref": "b2", "sku": "RED-CHAIR", "qty": 5, "eta": null}\n',
+    ]
+    assert list(bulk_import.parse_ndjson(lines)) == [
+        commands.CreateBatch("b1", "RED-CHAIR", 10, date(2011, 1, 2)),
+        commands.CreateBatch("b2", "RED-CHAIR", 5, None),
+    ]
+
+
+@pytest.mark.parametrize("fmt, lines", [
+    ("csv", ["ref,sku,qty,eta\n", "b1,RED-CHAIR\n"]),
+    ("csv", ["ref,sku,eta\n", "b1,RED-CHAIR,\n"]),
+    ("ndjson", ['["b1", "RED-CHAIR", 10]\n']),
+    ("ndjson", ['{"ref": "b1", "sku": "RED-CHAIR", "qty": [10]}\n']),
+])
+def test_rows_missing_values_are_invalid(fmt, lines):
+    with pytest.raises(ValueError):
+        list(bulk_import.PARSERS[fmt](lines))
+
+
+def test_chunks_lazily():
+    def numbers():
+        yield from range(5)
+        raise AssertionError("read past the chunks that were asked for")
+
+    chunks = bulk_import.chunked(numbers(), 2)
+    assert next(chunks) == [0, 1]
+    assert next(chunks) == [2, 3]
+
+
+def test_imports_in_chunks():
+    bus = bootstrap_test_app()
+    bus.handle(commands.CreateBatch("b0", "BLUE-CHAIR", 10, None))
+    lines = ["ref,sku,qty,eta\n"] + [
+        f"b{i},{sku},10,\n" for i, sku in enumerate(["BLUE-CHAIR", "GREEN-CHAIR"] * 5, 1)
+    ]
+
+    assert bulk_import.import_batches(bus, lines, "csv", chunk_size=3) == 10
+
+    assert len(bus.uow.products.get("BLUE-CHAIR").batches) == 6
+    assert len(bus.uow.products.get("GREEN-CHAIR").batches) == 5
+
+
+def test_reports_what_was_imported_before_an_invalid_row():
+    bus = bootstrap_test_app()
+    lines = ["ref,sku,qty,eta\n"] + [f"b{i},BLUE-CHAIR,10,\n" for i in range(5)] + [
+        "b5,BLUE-CHAIR,lots,\n", "b6,BLUE-CHAIR,10,\n",
+    ]
+
+    with pytest.raises(bulk_import.ImportFailed) as failure:
+        bulk_import.import_batches(bus, lines, "csv", chunk_size=2)
+
+    assert failure.value.imported == 4
+    assert not failure.value.duplicate
+    assert len(bus.uow.products.get("BLUE-CHAIR").batches) == 4
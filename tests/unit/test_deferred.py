@@ -0,0 +1,55 @@
+import threading
+import time
+from allocation.service_layer.deferred import DeferredHandlers
+
+
+def test_runs_handlers_off_the_calling_thread_and_drains_on_shutdown():
+    deferred = DeferredHandlers(workers=2, queue_size=10)
+    threads = []
+    handler = deferred.defer("slow", lambda m: (time.sleep(0.01), threads.append(m)))
+
+    for i in range(5):
+        handler(i)
+    deferred.shutdown()
+
+    assert sorted(threads) == [0, 1, 2, 3, 4]
+    assert deferred.stats() == dict(
+        in_flight=0, backpressure_waits=0, completed={"slow": 5}, errors={},
+    )
+
+
+def test_counts_errors_per_handler():
+    deferred = DeferredHandlers(workers=1, queue_size=10)
+    deferred.defer("broken", lambda m: 1 / 0)("message")
+    deferred.defer("fine", lambda m: None)("message")
+    deferred.shutdown()
+
+    assert deferred.stats()["errors"] == {"broken": 1}
+    assert deferred.stats()["completed"] == {"fine": 1}
+
+
+def test_blocks_the_caller_when_the_queue_is_full():
+    deferred = DeferredHandlers(workers=1, queue_size=1)
+    release = threading.Event()
+    blocking = deferred.defer("blocking", lambda m: release.wait())
+    blocking(1)
+    blocking(2)  # waits in the queue
+
+    third = threading.Thread(target=blocking, args=(3,))
+    third.start()
+    third.join(timeout=0.05)
+    assert third.is_alive()
+    assert deferred.stats()["backpressure_waits"] == 1
+
+    release.set()
+    third.join()
+    deferred.shutdown()
+    assert deferred.stats()["completed"] == {"blocking": 3}
+
+
+def test_runs_inline_once_shut_down():
+    deferred = DeferredHandlers(workers=1, queue_size=1)
+    deferred.shutdown()
+    ran_on = []
+    deferred.defer("late", lambda m: ran_on.append(threading.get_ident()))("message")
+    assert ran_on == [threading.get_ident()]
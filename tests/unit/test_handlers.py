@@ -1,12 +1,15 @@
 # pylint: disable=no-self-use
 from __future__ import annotations
+import asyncio
+import threading
 from collections import defaultdict
 from datetime import date
 from typing import Dict, List
 import pytest
+from sqlalchemy.orm.exc import StaleDataError
 from allocation import bootstrap
-from allocation.domain import commands
-from allocation.service_layer import handlers
+from allocation.domain import commands, events, model
+from allocation.service_layer import dispatch, handlers, messagebus
 from allocation.adapters import notifications, repository
 from allocation.service_layer import unit_of_work
 
@@ -28,10 +31,42 @@ class FakeRepository(repository.AbstractRepository):
             None,
         )
 
+    def _add_batches(self, batches):
+        for batch in batches:
+            product = self._get(batch.sku)
+            if product is None:
+                product = model.Product(batch.sku, batches=[])
+                self._products.add(product)
+            product.add_batch(batch)
+
+    def _get_many(self, skus):
+        return [p for p in self._products if p.sku in skus]
+
+    def _get_many_by_batchref(self, batchrefs):
+        return [
+            p for p in self._products
+            if any(b.reference in batchrefs for b in p.batches)
+        ]
+
+    def sku_for_batchref(self, batchref):
+        product = self._get_by_batchref(batchref)
+        return product.sku if product is not None else None
+
+
+class FakeSession:
+    """Stands in for the session the read-model handlers write with"""
+
+    def __init__(self):
+        self.executed = []
+
+    def execute(self, statement, params=None):
+        self.executed.append((statement, params))
+
 
 class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
     def __init__(self):
         self.products = FakeRepository([])
+        self.session = FakeSession()
         self.committed = False
 
     def _commit(self):
@@ -112,6 +147,75 @@ class TestAllocate:
         ]
 
 
+class TestAllocateOrder:
+    def test_allocates_every_line(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "TINY-KETTLE", 100, None))
+        bus.handle(commands.CreateBatch("b2", "HUGE-KETTLE", 100, None))
+        bus.handle(commands.AllocateOrder(
+            "o1", [("TINY-KETTLE", 10), ("HUGE-KETTLE", 20), ("TINY-KETTLE", 5)]
+        ))
+        [tiny] = bus.uow.products.get("TINY-KETTLE").batches
+        [huge] = bus.uow.products.get("HUGE-KETTLE").batches
+        assert tiny.available_quantity == 85
+        assert huge.available_quantity == 80
+        assert bus.uow.committed
+
+    def test_errors_for_invalid_sku_without_committing(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "AREALSKU", 100, None))
+        bus.uow.committed = False
+
+        with pytest.raises(handlers.InvalidSku, match="Invalid sku NONEXISTENTSKU"):
+            bus.handle(commands.AllocateOrder(
+                "o1", [("AREALSKU", 10), ("NONEXISTENTSKU", 10)]
+            ))
+        assert not bus.uow.committed
+
+    def test_sends_email_for_each_line_out_of_stock(self):
+        fake_notifs = FakeNotifications()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=fake_notifs,
+            publish=lambda *args: None,
+        )
+        bus.handle(commands.CreateBatch("b1", "RARE-TEAPOT", 9, None))
+        bus.handle(commands.AllocateOrder(
+            "o1", [("RARE-TEAPOT", 10), ("RARE-TEAPOT", 5), ("RARE-TEAPOT", 10)]
+        ))
+        assert fake_notifs.sent["stock@made.com"] == [
+            "Out of stock for RARE-TEAPOT",
+            "Out of stock for RARE-TEAPOT",
+        ]
+
+
+class TestImportBatches:
+    def test_adds_batches_and_missing_products(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch("b1", "SQUEAKY-DOOR", 100, None))
+        bus.handle(commands.ImportBatches([
+            commands.CreateBatch("b2", "SQUEAKY-DOOR", 10, None),
+            commands.CreateBatch("b3", "CREAKY-DOOR", 20, date.today()),
+        ]))
+        assert [b.reference for b in bus.uow.products.get("SQUEAKY-DOOR").batches] == [
+            "b1", "b2",
+        ]
+        assert bus.uow.products.get("CREAKY-DOOR") is not None
+        assert bus.uow.committed
+
+    def test_raises_one_event_for_the_whole_import(self):
+        uow = FakeUnitOfWork()
+        handlers.import_batches(commands.ImportBatches([
+            commands.CreateBatch("b1", "SQUEAKY-DOOR", 10, None),
+            commands.CreateBatch("b2", "CREAKY-DOOR", 20, None),
+        ]), uow)
+        assert list(uow.collect_new_events()) == [events.BatchesCreated([
+            events.BatchCreated("b1", "SQUEAKY-DOOR", 10, None),
+            events.BatchCreated("b2", "CREAKY-DOOR", 20, None),
+        ])]
+
+
 class TestChangeBatchQuantity:
     def test_changes_available_quantity(self):
         bus = bootstrap_test_app()
@@ -145,3 +249,319 @@ class TestChangeBatchQuantity:
         assert batch1.available_quantity == 5
         # and 20 will be reallocated to the next batch
         assert batch2.available_quantity == 30
+
+
+class TestEventCascade:
+    def test_collecting_events_only_walks_products_used_since_the_last_time(self):
+        lines = 500
+        uow = FakeUnitOfWork()
+        walked = []
+        collect_new_events = uow.collect_new_events
+
+        def counting_collect_new_events():
+            walked.append(len(uow.products.recent))
+            return collect_new_events()
+        uow.collect_new_events = counting_collect_new_events
+
+        batch1 = model.Batch("batch1", "BIG-SOFA", lines, None)
+        batch2 = model.Batch("batch2", "BIG-SOFA", lines, date.today())
+        for i in range(lines):
+            batch1.allocate(model.OrderLine(f"o{i}", "BIG-SOFA", 1))
+        uow.products.add(model.Product("BIG-SOFA", [batch1, batch2]))
+        for i in range(lines):
+            uow.products.add(model.Product(f"SMALL-SOFA-{i}", []))
+        list(uow.collect_new_events())
+        handled = []
+        bus = messagebus.MessageBus(
+            uow=uow,
+            event_handlers={
+                events.Deallocated: [lambda e: handlers.reallocate(e, uow), handled.append],
+                events.Allocated: [handled.append],
+            },
+            command_handlers={
+                commands.ChangeBatchQuantity:
+                    lambda c: handlers.change_batch_quantity(c, uow),
+            },
+        )
+
+        bus.handle(commands.ChangeBatchQuantity("batch1", 0))
+
+        assert len(handled) == 2 * lines
+        assert batch2.available_quantity == 0
+        # every product the unit of work has seen, each time, was quadratic
+        assert max(walked[1:]) == 1
+        assert len(uow.products.seen) == lines + 1
+
+
+class FakeAsyncNotifications(notifications.AbstractNotifications):
+    def __init__(self):
+        self.sent = defaultdict(list)  # type: Dict[str, List[str]]
+
+    async def send(self, destination, message):
+        await asyncio.sleep(0)
+        self.sent[destination].append(message)
+
+
+class TestAsyncMessageBus:
+    @staticmethod
+    def bootstrap_async_test_app():
+        published = []
+
+        async def publish(channel, event):
+            published.append((channel, event))
+
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeAsyncNotifications(),
+            publish=publish,
+            asynchronous=True,
+        )
+        return bus, published
+
+    def test_handles_commands_and_cascades_events(self):
+        bus, published = self.bootstrap_async_test_app()
+
+        async def scenario():
+            await bus.handle(commands.CreateBatch("b1", "ASYNC-LAMP", 10, None))
+            await bus.handle(commands.Allocate("o1", "ASYNC-LAMP", 10))
+            await bus.handle(commands.Allocate("o2", "ASYNC-LAMP", 10))
+        asyncio.run(scenario())
+
+        assert published == [
+            ("line_allocated", events.Allocated("o1", "ASYNC-LAMP", 10, "b1")),
+        ]
+
+    def test_sends_email_on_out_of_stock_with_async_notifications(self):
+        fake_notifs = FakeAsyncNotifications()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=fake_notifs,
+            publish=lambda *args: asyncio.sleep(0),
+            asynchronous=True,
+        )
+
+        async def scenario():
+            await bus.handle(commands.CreateBatch("b1", "POPULAR-LAMP", 9, None))
+            await bus.handle(commands.Allocate("o1", "POPULAR-LAMP", 10))
+        asyncio.run(scenario())
+
+        assert fake_notifs.sent["stock@made.com"] == ["Out of stock for POPULAR-LAMP"]
+
+    def test_raises_command_errors(self):
+        bus, _ = self.bootstrap_async_test_app()
+        with pytest.raises(handlers.InvalidSku):
+            asyncio.run(bus.handle(commands.Allocate("o1", "NO-SUCH-LAMP", 10)))
+
+    def test_close_stops_the_handler_threads(self):
+        bus, _ = self.bootstrap_async_test_app()
+        asyncio.run(bus.handle(commands.CreateBatch("b1", "ASYNC-LAMP", 10, None)))
+        bus.close()
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(bus.handle(commands.CreateBatch("b2", "ASYNC-LAMP", 10, None)))
+
+
+class TestDeferredHandlers:
+    def test_sends_out_of_stock_email_from_the_pool(self, monkeypatch):
+        monkeypatch.setenv("DEFERRED_HANDLER_THREADS", "2")
+        fake_notifs = FakeNotifications()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=fake_notifs,
+            publish=lambda *args: None,
+        )
+        bus.handle(commands.CreateBatch("b1", "POPULAR-CURTAINS", 9, None))
+        bus.handle(commands.Allocate("o1", "POPULAR-CURTAINS", 10))
+        bus.close()
+
+        assert fake_notifs.sent["stock@made.com"] == ["Out of stock for POPULAR-CURTAINS"]
+        assert bus.deferred.stats()["completed"] == {"send_out_of_stock_notification": 1}
+
+    def test_unmarked_handlers_still_run_before_handle_returns(self, monkeypatch):
+        monkeypatch.setenv("DEFERRED_HANDLER_THREADS", "2")
+        published_from = []
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=lambda *args: published_from.append(threading.get_ident()),
+        )
+        for msg in [
+            commands.CreateBatch("batch1", "INDIFFERENT-TABLE", 50, None),
+            commands.CreateBatch("batch2", "INDIFFERENT-TABLE", 50, date.today()),
+            commands.Allocate("order1", "INDIFFERENT-TABLE", 20),
+        ]:
+            bus.handle(msg)
+
+        bus.handle(commands.ChangeBatchQuantity("batch1", 10))
+        # reallocate isn't deferred, so it has already moved the line
+        [batch1, batch2] = bus.uow.products.get(sku="INDIFFERENT-TABLE").batches
+        assert batch2.available_quantity == 30
+
+        bus.close()
+        assert len(published_from) == 2
+        assert threading.get_ident() not in published_from
+
+
+class TestCoalescedReallocation:
+    @staticmethod
+    def shrink_batch(coalesce):
+        published = []
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=FakeNotifications(),
+            publish=lambda channel, event: published.append(event),
+        )
+        if not coalesce:
+            bus = messagebus.MessageBus(bus.uow, bus._event_handlers, bus._command_handlers)
+        bus.handle(commands.CreateBatch("b1", "SHRINKING-RUG", 300, None))
+        bus.handle(commands.CreateBatch("b2", "SHRINKING-RUG", 100, date.today()))
+        bus.handle(commands.CreateBatch("b3", "SHRINKING-RUG", 1000, date(2099, 1, 1)))
+        for i in range(300):
+            bus.handle(commands.Allocate(f"o{i}", "SHRINKING-RUG", 1 + i % 2))
+        del published[:]
+        bus.uow.session.executed.clear()
+
+        bus.handle(commands.ChangeBatchQuantity("b1", 20))
+        product = bus.uow.products.get("SHRINKING-RUG")
+        allocations = {
+            b.reference: sorted(line.orderid for line in b._allocations)
+            for b in product.batches
+        }
+        return allocations, product.version_number, published, bus.uow.session.executed
+
+    def test_ends_in_the_same_state_as_handling_each_event(self):
+        coalesced = self.shrink_batch(coalesce=True)
+        one_by_one = self.shrink_batch(coalesce=False)
+        assert coalesced[:3] == one_by_one[:3]
+
+    def test_updates_the_read_model_in_one_statement_per_step(self):
+        _, _, published, executed = self.shrink_batch(coalesce=True)
+        assert [statement.split()[0] for statement, _ in executed] == ["DELETE", "INSERT"]
+        (_, deleted), (_, inserted) = executed
+        assert len(deleted) == len(inserted) == len(published) > 100
+
+
+def bus_with_handler(allocate, attempts=3):
+    """A bus handling Allocate with ``allocate``, retried up to ``attempts`` times"""
+    uow = FakeUnitOfWork()
+    retry = dispatch.concurrency_retry(attempts, wait=0, max_wait=0)
+    return messagebus.MessageBus(
+        uow=uow,
+        event_handlers={},
+        command_handlers={commands.Allocate: bootstrap.inject_dependencies(
+            allocate, {"uow": uow}, [dispatch.retrying(retry, uow), dispatch.timed],
+        )},
+    )
+
+
+def bus_with_handler_failing(times, attempts=3):
+    """As bus_with_handler, with an Allocate handler that conflicts ``times`` times"""
+    calls = []
+
+    def allocate(command, uow):
+        calls.append(command)
+        if len(calls) <= times:
+            raise StaleDataError("products row changed since it was loaded")
+        return "b1"
+
+    return bus_with_handler(allocate, attempts), calls
+
+
+class TestConcurrencyRetry:
+    def test_retries_a_handler_that_conflicted(self):
+        bus, calls = bus_with_handler_failing(times=2)
+        assert bus.handle(commands.Allocate("o1", "CONTESTED-LAMP", 1)) == ["b1"]
+        assert len(calls) == 3
+
+    def test_gives_up_after_the_last_attempt(self):
+        bus, calls = bus_with_handler_failing(times=3)
+        with pytest.raises(StaleDataError):
+            bus.handle(commands.Allocate("o1", "CONTESTED-LAMP", 1))
+        assert len(calls) == 3
+
+    def test_does_not_retry_other_errors(self):
+        calls = []
+
+        def allocate(command, uow):
+            calls.append(command)
+            raise handlers.InvalidSku("Invalid sku NONEXISTENTSKU")
+
+        bus = bus_with_handler(allocate)
+        with pytest.raises(handlers.InvalidSku):
+            bus.handle(commands.Allocate("o1", "NONEXISTENTSKU", 1))
+        assert len(calls) == 1
+
+    def test_group_commit_bus_reruns_conflicts_only_if_asked_to(self):
+        for rerun_conflicts, expected_calls in [(False, 1), (True, 2)]:
+            calls = []
+
+            def allocate(command):
+                calls.append(command)
+                if len(calls) == 1:
+                    raise StaleDataError("products row changed since it was loaded")
+                return "b1"
+
+            bus = messagebus.GroupCommitMessageBus(
+                FakeUnitOfWork(), {}, {commands.Allocate: allocate},
+                rerun_conflicts=rerun_conflicts,
+            )
+            try:
+                if rerun_conflicts:
+                    assert bus.handle(commands.Allocate("o1", "CONTESTED-LAMP", 1)) == ["b1"]
+                else:
+                    with pytest.raises(StaleDataError):
+                        bus.handle(commands.Allocate("o1", "CONTESTED-LAMP", 1))
+            finally:
+                bus.close()
+            assert len(calls) == expected_calls
+
+
+class TestDispatch:
+    def test_binds_dependencies_by_position_and_keeps_the_handler_name(self):
+        def allocate(command, uow, publish):
+            return command, uow, publish
+
+        bound = dispatch.bind(allocate, {"publish": "p", "uow": "u", "notifications": "n"})
+        assert bound("c") == ("c", "u", "p")
+        assert bound.__name__ == "allocate"
+
+    def test_leaves_defaults_alone(self):
+        def allocate(command, uow=None, publish="default"):
+            return command, uow, publish
+
+        assert dispatch.bind(allocate, {"publish": "p"})("c") == ("c", None, "p")
+
+    def test_runs_middleware_in_order_and_skips_what_doesnt_apply(self):
+        calls = []
+
+        def recording(name):
+            def middleware(handler, call):
+                def recorded(message):
+                    calls.append(name)
+                    return call(message)
+                return recorded
+            return middleware
+
+        def publish_event(event, publish):
+            calls.append("handler")
+
+        uow = FakeUnitOfWork()
+        retry = dispatch.concurrency_retry(3, wait=0, max_wait=0)
+        call = bootstrap.inject_dependencies(
+            publish_event, {"publish": None, "uow": uow},
+            [recording("outer"), dispatch.retrying(retry, uow), recording("inner")],
+        )
+        call("event")
+        assert calls == ["outer", "inner", "handler"]
+        # no unit of work, so nothing for retrying to do
+        assert dispatch.retrying(retry, uow)(publish_event, print) is print
+
+    def test_unknown_messages_are_rejected(self):
+        bus = bootstrap_test_app()
+        with pytest.raises(Exception, match="was not an Event of Command"):
+            bus.handle(object())
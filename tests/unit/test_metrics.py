@@ -0,0 +1,72 @@
+import pytest
+from sqlalchemy.orm.exc import StaleDataError
+from allocation import metrics
+from allocation.domain import commands
+from allocation.service_layer import dispatch, handlers, messagebus, unit_of_work
+from .test_handlers import bootstrap_test_app, bus_with_handler_failing
+
+
+@pytest.fixture(autouse=True)
+def empty_registry():
+    metrics.REGISTRY.reset()
+    yield
+    metrics.REGISTRY.reset()
+
+
+def test_renders_counters_gauges_and_cumulative_histograms():
+    registry = metrics.Registry()
+    registry.inc("jobs_total", (("result", "ok"),))
+    registry.inc("jobs_total", (("result", "ok"),))
+    registry.set("queue_length", 3)
+    registry.observe("job_seconds", 0.003)
+    registry.observe("job_seconds", 20)
+    registry.register_collector("pool", lambda: [("pool_size", (("db", "main"),), 5)])
+
+    text = registry.render()
+
+    assert 'jobs_total{result="ok"} 2' in text
+    assert "queue_length 3" in text
+    assert 'pool_size{db="main"} 5' in text
+    assert "# TYPE job_seconds histogram" in text
+    assert 'job_seconds_bucket{le="0.0025"} 0' in text
+    assert 'job_seconds_bucket{le="0.005"} 1' in text
+    assert 'job_seconds_bucket{le="10"} 1' in text
+    assert 'job_seconds_bucket{le="+Inf"} 2' in text
+    assert "job_seconds_count 2" in text
+
+
+def test_bus_records_message_and_handler_timings_and_errors():
+    bus = bootstrap_test_app()
+    bus.handle(commands.CreateBatch("b1", "METERED-LAMP", 100, None))
+    bus.handle(commands.Allocate("o1", "METERED-LAMP", 10))
+    with pytest.raises(handlers.InvalidSku):
+        bus.handle(commands.Allocate("o2", "UNKNOWN-LAMP", 10))
+
+    registry = metrics.REGISTRY
+    assert registry.histogram(dispatch.HANDLER_SECONDS, (("handler", "allocate"),)).count == 2
+    assert registry.counter(dispatch.HANDLER_ERRORS, (("handler", "allocate"),)) == 1
+    assert registry.counter(
+        messagebus.MESSAGES, (("message", "Allocate"), ("result", "ok"))
+    ) == 1
+    assert registry.counter(
+        messagebus.MESSAGES, (("message", "Allocate"), ("result", "error"))
+    ) == 1
+    # one per handle(), which went as deep as Allocate -> Allocated
+    depths = registry.histogram(messagebus.CASCADE_DEPTH)
+    assert depths.count == 3
+    assert depths.buckets == messagebus.DEPTH_BUCKETS
+    assert depths.counts[:2] == [2, 1] and depths.sum == 1
+    # add_batch, allocate and the read model update
+    assert registry.histogram(unit_of_work.COMMIT_SECONDS).count == 3
+    # the allocation to an unknown sku
+    assert registry.histogram(unit_of_work.ROLLBACK_SECONDS).count == 1
+
+
+def test_counts_conflicts_and_retries_per_sku():
+    bus, _ = bus_with_handler_failing(times=2, attempts=2)
+    with pytest.raises(StaleDataError):
+        bus.handle(commands.Allocate("o1", "CONTESTED-LAMP", 1))
+
+    labels = (("sku", "CONTESTED-LAMP"),)
+    assert metrics.REGISTRY.counter(dispatch.CONCURRENCY_CONFLICTS, labels) == 2
+    assert metrics.REGISTRY.counter(dispatch.CONCURRENCY_RETRIES, labels) == 1
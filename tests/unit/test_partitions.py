@@ -0,0 +1,198 @@
+import os
+import threading
+
+import pytest
+
+from allocation.domain import commands
+from allocation.service_layer import handlers
+from allocation.service_layer.partitions import (
+    PartitionedMessageBus, WorkerCrashed, WorkerPool, partition_for,
+)
+
+
+class FakeBus:
+    """Answers with the process that handled the message"""
+
+    def handle(self, message):
+        if getattr(message, "sku", None) == "NONESUCH":
+            raise handlers.InvalidSku("Invalid sku NONESUCH")
+        if getattr(message, "sku", None) == "CRASH":
+            os._exit(1)
+        if isinstance(message, commands.ImportBatches):
+            return [(os.getpid(), batch.sku) for batch in message.batches]
+        return [os.getpid()]
+
+    def close(self):
+        pass
+
+
+BATCH_SKUS = {"batch-1": "RED-CHAIR"}
+
+
+def make_bus(workers=3, queue_size=100):
+    return PartitionedMessageBus(
+        uow=None, bus_factory=FakeBus, sku_for_batchref=BATCH_SKUS.get,
+        workers=workers, queue_size=queue_size,
+    )
+
+
+def handled_by(bus, message):
+    [pid] = bus.handle(message)
+    return pid
+
+
+def test_partitions_are_stable_and_spread():
+    skus = [f"sku-{i}" for i in range(100)]
+    assert [partition_for(sku, 4) for sku in skus] == [partition_for(sku, 4) for sku in skus]
+    assert set(partition_for(sku, 4) for sku in skus) == {0, 1, 2, 3}
+
+
+def test_messages_for_a_sku_are_handled_by_one_worker():
+    bus = make_bus()
+    try:
+        pids = {
+            sku: {handled_by(bus, commands.Allocate(f"o{i}", sku, 1)) for i in range(5)}
+            for sku in (f"sku-{i}" for i in range(20))
+        }
+        assert all(len(handled) == 1 for handled in pids.values())
+        assert len(set.union(*pids.values())) == 3
+        assert os.getpid() not in set.union(*pids.values())
+    finally:
+        bus.close()
+
+
+def test_batchrefs_are_resolved_to_their_sku():
+    bus = make_bus()
+    try:
+        assert handled_by(bus, commands.ChangeBatchQuantity("batch-1", 10)) == handled_by(
+            bus, commands.CreateBatch("batch-2", "RED-CHAIR", 10)
+        )
+    finally:
+        bus.close()
+
+
+def test_raises_what_the_worker_raised():
+    bus = make_bus()
+    try:
+        with pytest.raises(handlers.InvalidSku, match="NONESUCH"):
+            bus.handle(commands.Allocate("o1", "NONESUCH", 1))
+        assert bus.stats()["errors"][str(bus.partition(commands.Allocate("o1", "NONESUCH", 1)))] == 1
+    finally:
+        bus.close()
+
+
+def test_splits_imports_by_worker():
+    bus = make_bus()
+    try:
+        batches = [commands.CreateBatch(f"b{i}", f"sku-{i}", 10) for i in range(20)]
+        results = bus.handle(commands.ImportBatches(batches))
+        assert sorted(sku for _, sku in results) == sorted(b.sku for b in batches)
+        for pid, sku in results:
+            assert pid == handled_by(bus, commands.Allocate("o1", sku, 1))
+    finally:
+        bus.close()
+
+
+def test_restarts_a_crashed_worker_and_fails_only_its_message():
+    bus = make_bus(workers=1)
+    try:
+        before = handled_by(bus, commands.Allocate("o1", "sku", 1))
+        crashed = bus.submit(commands.Allocate("o2", "CRASH", 1))
+        queued = [bus.submit(commands.Allocate(f"o{i}", "sku", 1)) for i in range(5)]
+
+        with pytest.raises(WorkerCrashed):
+            crashed.result(timeout=10)
+        after = {future.result(timeout=10)[0] for future in queued}
+        assert len(after) == 1 and after != {before}
+        assert bus.stats()["restarts"] == {"0": 1}
+    finally:
+        bus.close()
+
+
+def test_close_waits_for_submitted_messages():
+    bus = make_bus(workers=2, queue_size=1)
+    # a queue of one, so most of these wait for the one before
+    futures = [bus.submit(commands.Allocate(f"o{i}", f"sku-{i}", 1)) for i in range(20)]
+    bus.close()
+    assert all(future.done() and future.exception() is None for future in futures)
+    assert sum(bus.stats()["handled"].values()) == 20
+
+
+class ThreadBus:
+    """Records the thread each message was handled on, once let through"""
+
+    def __init__(self):
+        self.handled = []
+        self.started = threading.Event()
+        self.go = threading.Event()
+        self.go.set()
+
+    def handle(self, message):
+        self.started.set()
+        self.go.wait()
+        if message.sku == "NONESUCH":
+            raise handlers.InvalidSku("Invalid sku NONESUCH")
+        self.handled.append((message.orderid, threading.current_thread().name))
+        return [message.orderid]
+
+
+def test_pool_handles_a_skus_messages_in_order_on_one_thread():
+    bus = ThreadBus()
+    pool = WorkerPool(bus, BATCH_SKUS.get, workers=3)
+    try:
+        futures = [
+            pool.submit(commands.Allocate(f"o{i}-{sku}", sku, 1))
+            for i in range(10) for sku in ("sku-1", "sku-2", "sku-3", "sku-4")
+        ]
+        assert [future.result(timeout=10) for future in futures] == [
+            [f"o{i}-{sku}"] for i in range(10) for sku in ("sku-1", "sku-2", "sku-3", "sku-4")
+        ]
+        for sku in ("sku-1", "sku-2", "sku-3", "sku-4"):
+            handled = [(orderid, thread) for orderid, thread in bus.handled if orderid.endswith(sku)]
+            assert [orderid for orderid, _ in handled] == [f"o{i}-{sku}" for i in range(10)]
+            assert len({thread for _, thread in handled}) == 1
+        with pytest.raises(handlers.InvalidSku):
+            pool.submit(commands.Allocate("o1", "NONESUCH", 1)).result(timeout=10)
+        assert pool.stats()["errors"] == 1
+    finally:
+        pool.close()
+
+
+def test_pool_stats_can_be_read_by_more_than_one_reader():
+    pool = WorkerPool(ThreadBus(), BATCH_SKUS.get, workers=2)
+    try:
+        for future in [pool.submit(commands.Allocate(f"o{i}", "sku", 1)) for i in range(10)]:
+            future.result(timeout=10)
+        first, second = pool.stats(), pool.stats()
+        assert first["handled"] == second["handled"] == 10
+        assert first["messages_per_second"] > 0
+        assert second["messages_per_second"] > 0
+    finally:
+        pool.close()
+
+
+def test_pool_holds_back_submitters_when_its_queue_is_full():
+    bus = ThreadBus()
+    bus.go.clear()
+    pool = WorkerPool(bus, BATCH_SKUS.get, workers=1, queue_size=2)
+    try:
+        futures = [pool.submit(commands.Allocate("o0", "sku", 1))]
+        assert bus.started.wait(timeout=10)
+        # one being handled, and two waiting
+        futures += [pool.submit(commands.Allocate(f"o{i}", "sku", 1)) for i in range(1, 3)]
+        blocked = threading.Thread(
+            target=lambda: futures.append(pool.submit(commands.Allocate("o3", "sku", 1)))
+        )
+        blocked.start()
+        blocked.join(timeout=0.2)
+        assert blocked.is_alive()
+        assert pool.stats()["in_flight"] == 4
+        assert pool.stats()["backpressure_waits"] == 1
+
+        bus.go.set()
+        blocked.join(timeout=10)
+        assert [future.result(timeout=10) for future in futures] == [[f"o{i}"] for i in range(4)]
+        assert pool.stats()["in_flight"] == 0
+    finally:
+        bus.go.set()
+        pool.close()
@@ -1,5 +1,6 @@
+import random
 from datetime import date, timedelta
-from allocation.domain import events
+from allocation.domain import events, model
 from allocation.domain.model import Product, OrderLine, Batch
 
 
@@ -77,3 +78,89 @@ def test_increments_version_number():
     product.version_number = 7
     product.allocate(line)
     assert product.version_number == 8
+
+
+def test_allocates_to_batches_added_later_in_eta_order():
+    product = Product(sku="DRAB-SOFA", batches=[
+        Batch("later-batch", "DRAB-SOFA", 100, eta=later),
+    ])
+    product.allocate(OrderLine("order1", "DRAB-SOFA", 10))
+    product.add_batch(Batch("tomorrow-batch", "DRAB-SOFA", 100, eta=tomorrow))
+
+    assert product.allocate(OrderLine("order2", "DRAB-SOFA", 10)) == "tomorrow-batch"
+
+
+def test_skips_exhausted_batches_until_restocked():
+    in_stock_batch = Batch("in-stock-batch", "FADED-RUG", 10, eta=None)
+    shipment_batch = Batch("shipment-batch", "FADED-RUG", 100, eta=tomorrow)
+    product = Product(sku="FADED-RUG", batches=[in_stock_batch, shipment_batch])
+
+    assert product.allocate(OrderLine("order1", "FADED-RUG", 10)) == "in-stock-batch"
+    assert product.allocate(OrderLine("order2", "FADED-RUG", 10)) == "shipment-batch"
+
+    product.change_batch_quantity("in-stock-batch", 20)
+    assert product.allocate(OrderLine("order3", "FADED-RUG", 10)) == "in-stock-batch"
+
+
+def test_batches_deallocated_directly_are_put_back_in_the_index():
+    in_stock_batch = Batch("in-stock-batch", "FADED-RUG", 10, eta=None)
+    product = Product(sku="FADED-RUG", batches=[in_stock_batch] + [
+        Batch(f"shipment-{i}", "FADED-RUG", 100, eta=tomorrow)
+        for i in range(model.INDEX_MIN_BATCHES)
+    ])
+    line = OrderLine("order1", "FADED-RUG", 10)
+    assert product.allocate(line) == "in-stock-batch"
+    assert in_stock_batch not in product.batch_index
+
+    in_stock_batch.deallocate(line)
+    assert product.allocate(OrderLine("order2", "FADED-RUG", 10)) == "in-stock-batch"
+
+
+def test_small_products_are_sorted_rather_than_indexed():
+    product = Product(sku="FADED-RUG", batches=[
+        Batch("shipment-batch", "FADED-RUG", 100, eta=tomorrow),
+        Batch("in-stock-batch", "FADED-RUG", 10, eta=None),
+    ])
+    assert product.allocate(OrderLine("order1", "FADED-RUG", 10)) == "in-stock-batch"
+    assert product._batch_index is None
+
+
+def test_allocates_like_sorting_the_batches_every_time():
+    rng = random.Random(42)
+    etas = [None, today, tomorrow, later]
+    batches = [
+        Batch(f"b{i}", "WOBBLY-STOOL", rng.randint(1, 30), eta=rng.choice(etas))
+        for i in range(20)
+    ]
+    mirrors = [Batch(b.reference, b.sku, b._purchased_quantity, b.eta) for b in batches]
+    product = Product(sku="WOBBLY-STOOL", batches=batches)
+
+    for i in range(60):
+        line = OrderLine(f"order{i}", "WOBBLY-STOOL", rng.randint(1, 10))
+        expected = next((b for b in sorted(mirrors) if b.can_allocate(line)), None)
+        if expected:
+            expected.allocate(line)
+        allocation = product.allocate(line)
+        assert allocation == (expected.reference if expected else None)
+
+
+def test_allocate_many_matches_allocating_each_line_in_turn():
+    rng = random.Random(7)
+    etas = [None, today, tomorrow, later]
+
+    def make_product():
+        rng_batches = random.Random(3)
+        return Product(sku="TALL-LAMP", batches=[
+            Batch(f"b{i}", "TALL-LAMP", rng_batches.randint(1, 30),
+                  eta=rng_batches.choice(etas))
+            for i in range(15)
+        ])
+
+    lines = [OrderLine(f"order{i}", "TALL-LAMP", rng.randint(1, 12)) for i in range(50)]
+    one_by_one, all_at_once = make_product(), make_product()
+
+    expected = [one_by_one.allocate(line) for line in lines]
+
+    assert all_at_once.allocate_many(lines) == expected
+    assert all_at_once.events == one_by_one.events
+    assert all_at_once.version_number == one_by_one.version_number
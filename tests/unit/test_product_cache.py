@@ -0,0 +1,70 @@
+from allocation.adapters.product_cache import ProductCache, approximate_size
+from allocation.domain.model import Batch, OrderLine, Product
+
+
+def make_product(sku, version_number=1, lines=0):
+    batch = Batch(f"{sku}-batch", sku, 1000, eta=None)
+    for i in range(lines):
+        batch.allocate(OrderLine(f"order{i}", sku, 1))
+    return Product(sku, [batch], version_number=version_number)
+
+
+def test_hands_out_cached_product_while_its_version_is_current():
+    cache = ProductCache(max_entries=10, max_bytes=10 ** 6)
+    product = make_product("SHABBY-CHAIR", version_number=3)
+    cache.put(product)
+
+    assert cache.take("SHABBY-CHAIR", lambda: 3) is product
+    assert cache.take("OTHER-CHAIR", lambda: 3) is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_products_in_use_are_not_cached():
+    cache = ProductCache(max_entries=10, max_bytes=10 ** 6)
+    product = make_product("SHABBY-CHAIR")
+    cache.put(product)
+    cache.take("SHABBY-CHAIR", lambda: 1)
+
+    assert cache.take("SHABBY-CHAIR", lambda: 1) is None
+    cache.put(product)
+    assert cache.take("SHABBY-CHAIR", lambda: 1) is product
+
+
+def test_drops_stale_products():
+    cache = ProductCache(max_entries=10, max_bytes=10 ** 6)
+    cache.put(make_product("SHABBY-CHAIR", version_number=3))
+
+    assert cache.take("SHABBY-CHAIR", lambda: 4) is None
+    assert cache.stats()["stale"] == 1
+    assert cache.stats()["entries"] == 0
+
+
+def test_evicts_least_recently_used_beyond_max_entries():
+    cache = ProductCache(max_entries=2, max_bytes=10 ** 6)
+    cache.put(make_product("A"))
+    cache.put(make_product("B"))
+    cache.put(cache.take("A", lambda: 1))
+    cache.put(make_product("C"))
+
+    assert cache.take("B", lambda: 1) is None
+    assert cache.take("A", lambda: 1) is not None
+    assert cache.take("C", lambda: 1) is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_evicts_beyond_max_bytes():
+    big = make_product("BIG", lines=100)
+    cache = ProductCache(max_entries=10, max_bytes=approximate_size(big) + 1)
+    cache.put(make_product("SMALL"))
+    cache.put(big)
+
+    assert cache.stats()["bytes"] == approximate_size(big)
+    assert cache.take("SMALL", lambda: 1) is None
+    assert cache.take("BIG", lambda: 1) is big
+
+
+def test_does_not_cache_products_bigger_than_the_whole_cache():
+    cache = ProductCache(max_entries=10, max_bytes=10)
+    cache.put(make_product("BIG", lines=100))
+    assert cache.stats()["entries"] == 0
@@ -0,0 +1,133 @@
+import time
+
+import pytest
+
+from allocation.adapters.read_model import AllocationsCache, RedisReadModel, from_settings
+from allocation.domain import events
+
+
+class FakeRedis:
+    """
+    Stands in for Redis, with the hash and string commands the read
+    models use, taking ``latency`` seconds for each round trip
+    """
+
+    def __init__(self, latency=0.0):
+        self.data = {}
+        self.expires = {}
+        self.latency = latency
+        self.round_trips = 0
+        self.down = False
+
+    def _round_trip(self):
+        if self.down:
+            raise ConnectionError("redis is down")
+        self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def hset(self, key, field, value):
+        self._round_trip()
+        self._hset(key, field, value)
+
+    def _hset(self, key, field, value):
+        self.data.setdefault(key, {})[field.encode()] = value.encode()
+
+    def _hdel(self, key, field):
+        self.data.get(key, {}).pop(field.encode(), None)
+
+    def hgetall(self, key):
+        self._round_trip()
+        return dict(self.data.get(key, {}))
+
+    def get(self, key):
+        self._round_trip()
+        if key in self.expires and self.expires[key] <= time.monotonic():
+            self._delete(key)
+        return self.data.get(key)
+
+    def set(self, key, value, px=None):
+        self._round_trip()
+        self.data[key] = value.encode()
+        if px is not None:
+            self.expires[key] = time.monotonic() + px / 1000
+
+    def delete(self, *keys):
+        self._round_trip()
+        for key in keys:
+            self._delete(key)
+
+    def _delete(self, key):
+        self.data.pop(key, None)
+        self.expires.pop(key, None)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def hset(self, key, field, value):
+        self.commands.append((self.redis._hset, key, field, value))
+
+    def hdel(self, key, field):
+        self.commands.append((self.redis._hdel, key, field))
+
+    def execute(self):
+        self.redis._round_trip()
+        for command, *args in self.commands:
+            command(*args)
+
+
+def test_redis_read_model_keeps_a_hash_per_order():
+    redis = FakeRedis()
+    read_model = RedisReadModel(redis)
+    read_model.add([
+        events.Allocated("o1", "SKU-B", 10, "b1"),
+        events.Allocated("o1", "SKU-A", 10, "b2"),
+        events.Allocated("o2", "SKU-A", 10, "b2"),
+    ])
+    read_model.remove([events.Deallocated("o2", "SKU-A", 10)])
+
+    assert read_model.allocations("o1") == [
+        {"sku": "SKU-A", "batchref": "b2"}, {"sku": "SKU-B", "batchref": "b1"},
+    ]
+    assert read_model.allocations("o2") == []
+    assert redis.round_trips == 4
+
+
+def test_cache_expires_and_is_invalidated():
+    redis = FakeRedis()
+    cache = AllocationsCache(redis, ttl=0.05)
+    cache.set("o1", [{"sku": "SKU-A", "batchref": "b1"}])
+    cache.set("o2", [])
+
+    assert cache.get("o1") == [{"sku": "SKU-A", "batchref": "b1"}]
+    assert cache.get("o2") == []
+    cache.invalidate(["o2", "o2"])
+    assert cache.get("o2") is None
+    time.sleep(0.06)
+    assert cache.get("o1") is None
+    assert cache.stats() == dict(hits=2, misses=2, invalidations=1, errors=0)
+
+
+def test_cache_misses_rather_than_fails_without_redis():
+    redis = FakeRedis()
+    cache = AllocationsCache(redis, ttl=60)
+    redis.down = True
+
+    cache.set("o1", [])
+    assert cache.get("o1") is None
+    cache.invalidate(["o1"])
+    assert cache.stats() == dict(hits=0, misses=1, invalidations=0, errors=3)
+
+
+def test_read_model_from_settings():
+    assert from_settings("postgres", 0) is None
+    assert isinstance(from_settings("postgres", 30), AllocationsCache)
+    assert isinstance(from_settings("redis", 30), RedisReadModel)
+    with pytest.raises(ValueError):
+        from_settings("mongo")
@@ -0,0 +1,287 @@
+import itertools
+import json
+import time
+
+import pytest
+import redis
+
+from allocation import metrics
+from allocation.domain import commands
+from allocation.entrypoints import redis_eventconsumer
+from allocation.entrypoints.redis_eventconsumer import StreamConsumer
+from allocation.service_layer.partitions import WorkerPool
+
+
+class FakeStreams:
+    """
+    Stands in for Redis, with the stream and consumer group commands that
+    StreamConsumer uses, answering as redis-py does
+    """
+
+    def __init__(self):
+        self.streams = {}  # name -> [(id, fields)]
+        self.groups = {}  # (stream, group) -> how many entries were delivered
+        self.pending = {}  # (stream, group) -> {id: [consumer, delivered at, count]}
+        self._ids = itertools.count(1)
+
+    def xadd(self, name, fields):
+        message_id = f"{next(self._ids)}-0".encode()
+        self.streams.setdefault(name, []).append((message_id, {
+            k.encode() if isinstance(k, str) else k: v.encode() if isinstance(v, str) else v
+            for k, v in fields.items()
+        }))
+        return message_id
+
+    def xgroup_create(self, name, groupname, id="$", mkstream=False):
+        if (name, groupname) in self.groups:
+            raise redis.exceptions.ResponseError("BUSYGROUP Consumer Group name already exists")
+        entries = self.streams.setdefault(name, [])
+        self.groups[name, groupname] = 0 if id == "0" else len(entries)
+        self.pending[name, groupname] = {}
+
+    def xreadgroup(self, groupname, consumername, streams, count=None, block=None):
+        response = []
+        for name, after in streams.items():
+            key = (name, groupname)
+            if after == ">":
+                start = self.groups[key]
+                entries = self.streams[name][start:start + count]
+                self.groups[key] = start + len(entries)
+                for message_id, _ in entries:
+                    self.pending[key][message_id] = [consumername, time.monotonic(), 1]
+            else:
+                entries = [
+                    entry for entry in self.streams[name]
+                    if self._after(entry[0], after)
+                    and self.pending[key].get(entry[0], [None])[0] == consumername
+                ][:count]
+                for message_id, _ in entries:
+                    self.pending[key][message_id][2] += 1
+            if entries or after != ">":
+                response.append([name.encode(), entries])
+        return response
+
+    def xack(self, name, groupname, *ids):
+        return sum(self.pending[name, groupname].pop(i, None) is not None for i in ids)
+
+    def xautoclaim(self, name, groupname, consumername, min_idle_time, start_id="0-0", count=None):
+        pending = self.pending[name, groupname]
+        claimed = []
+        for message_id, fields in self.streams[name]:
+            delivery = pending.get(message_id)
+            if delivery is None or not self._after(message_id, start_id, inclusive=True):
+                continue
+            if (time.monotonic() - delivery[1]) * 1000 < min_idle_time:
+                continue
+            pending[message_id] = [consumername, time.monotonic(), delivery[2] + 1]
+            claimed.append((message_id, fields))
+            if len(claimed) == count:
+                break
+        return [b"0-0", claimed, []]
+
+    def xpending_range(self, name, groupname, min, max, count):
+        return [
+            dict(message_id=i, consumer=d[0].encode(), times_delivered=d[2])
+            for i, d in self.pending[name, groupname].items() if i == min
+        ][:count]
+
+    def xinfo_groups(self, name):
+        return [
+            dict(
+                name=group.encode(), pending=len(self.pending[stream, group]),
+                lag=len(self.streams[stream]) - delivered,
+            )
+            for (stream, group), delivered in self.groups.items() if stream == name
+        ]
+
+    @staticmethod
+    def _after(message_id, after, inclusive=False):
+        after = after.decode() if isinstance(after, bytes) else after
+        number, bound = int(message_id.split(b"-")[0]), int(after.split("-")[0])
+        return number >= bound if inclusive else number > bound
+
+
+class FakeBus:
+    def __init__(self, fail_for=()):
+        self.handled = []
+        self.fail_for = set(fail_for)
+
+    def handle(self, message):
+        if getattr(message, "ref", None) in self.fail_for:
+            raise ValueError(f"cannot handle {message.ref}")
+        self.handled.append(message)
+
+
+STREAM = "change_batch_quantity"
+
+
+def add_messages(client, refs):
+    for ref in refs:
+        client.xadd(STREAM, {"data": json.dumps({"batchref": ref, "qty": 5})})
+
+
+@pytest.fixture(autouse=True)
+def empty_registry():
+    metrics.REGISTRY.reset()
+    yield
+    metrics.REGISTRY.reset()
+
+
+@pytest.fixture(autouse=True)
+def pools():
+    pools = []
+    yield pools
+    for pool in pools:
+        pool.close()
+
+
+@pytest.fixture
+def make_consumer(pools):
+    def make_consumer(client, bus, name="c1", **kwargs):
+        pools.append(WorkerPool(bus, sku_for_batchref=lambda ref: None, workers=2))
+        consumer = StreamConsumer(
+            client, pools[-1], [STREAM], group="allocation", consumer=name, **kwargs
+        )
+        consumer.start()
+        return consumer
+    return make_consumer
+
+
+def test_handles_and_acknowledges_messages_in_batches(make_consumer):
+    client, bus = FakeStreams(), FakeBus()
+    # sent before the group existed, which still sees them
+    add_messages(client, ["b1", "b2", "b3"])
+    consumer = make_consumer(client, bus, batch_size=2)
+
+    assert consumer.poll() == 2
+    assert consumer.stats() == dict(lag={STREAM: 1}, pending={STREAM: 0})
+    assert consumer.poll() == 1
+
+    assert sorted(bus.handled, key=lambda m: m.ref) == [
+        commands.ChangeBatchQuantity(ref, 5) for ref in ["b1", "b2", "b3"]
+    ]
+    assert consumer.stats() == dict(lag={STREAM: 0}, pending={STREAM: 0})
+    assert metrics.REGISTRY.counter(
+        redis_eventconsumer.STREAM_MESSAGES, (("stream", STREAM), ("result", "ok"))
+    ) == 3
+
+
+def test_consumers_in_a_group_share_its_messages(make_consumer):
+    client = FakeStreams()
+    add_messages(client, [f"b{i}" for i in range(10)])
+    first, second = FakeBus(), FakeBus()
+    consumers = [
+        make_consumer(client, first, "c1", batch_size=3),
+        make_consumer(client, second, "c2", batch_size=3),
+    ]
+    # in turn, as processes polling at once would
+    while sum([consumer.poll() for consumer in consumers]):
+        pass
+
+    refs = [m.ref for m in first.handled] + [m.ref for m in second.handled]
+    assert sorted(refs) == sorted(f"b{i}" for i in range(10))
+    assert first.handled and second.handled
+
+
+def test_claims_the_messages_a_dead_consumer_left_pending(make_consumer):
+    client = FakeStreams()
+    add_messages(client, ["b1", "b2"])
+    make_consumer(client, FakeBus(), "dead")
+    # read by a consumer that died before it acknowledged them
+    client.xreadgroup("allocation", "dead", {STREAM: ">"}, count=10)
+    bus = FakeBus()
+
+    consumer = make_consumer(client, bus, "c1", claim_idle=0)
+    consumer.poll()
+
+    assert sorted(m.ref for m in bus.handled) == ["b1", "b2"]
+    assert consumer.stats()["pending"] == {STREAM: 0}
+    assert metrics.REGISTRY.counter(redis_eventconsumer.STREAM_CLAIMED, (("stream", STREAM),)) == 2
+
+
+def test_a_consumer_handles_its_own_pending_messages_when_it_starts_again(make_consumer):
+    client = FakeStreams()
+    add_messages(client, ["b1"])
+    make_consumer(client, FakeBus(), "c1")
+    client.xreadgroup("allocation", "c1", {STREAM: ">"}, count=10)
+    bus = FakeBus()
+
+    make_consumer(client, bus, "c1")
+
+    assert [m.ref for m in bus.handled] == ["b1"]
+    assert client.pending[STREAM, "allocation"] == {}
+
+
+def test_a_failing_message_is_retried_then_moved_to_the_dead_letter_stream(make_consumer):
+    client = FakeStreams()
+    add_messages(client, ["bad", "good"])
+    bus = FakeBus(fail_for={"bad"})
+    consumer = make_consumer(client, bus, claim_idle=0, max_deliveries=3)
+
+    consumer.poll()
+    assert consumer.stats()["pending"] == {STREAM: 1}
+    consumer.poll()
+    consumer.poll()
+
+    assert [m.ref for m in bus.handled] == ["good"]
+    assert consumer.stats()["pending"] == {STREAM: 0}
+    [(_, fields)] = client.streams[f"{STREAM}:dead"]
+    assert json.loads(fields[b"data"])["batchref"] == "bad"
+    assert metrics.REGISTRY.counter(
+        redis_eventconsumer.STREAM_MESSAGES, (("stream", STREAM), ("result", "error"))
+    ) == 3
+
+
+def test_a_message_that_cannot_be_decoded_is_moved_to_the_dead_letter_stream(make_consumer):
+    client = FakeStreams()
+    client.xadd(STREAM, {"data": "not json"})
+    add_messages(client, ["b1"])
+    bus = FakeBus()
+    consumer = make_consumer(client, bus)
+
+    consumer.poll()
+
+    assert [m.ref for m in bus.handled] == ["b1"]
+    assert consumer.stats()["pending"] == {STREAM: 0}
+    assert len(client.streams[f"{STREAM}:dead"]) == 1
+
+
+def test_pubsub_messages_are_decoded_by_channel(pools):
+    bus = FakeBus(fail_for={"b2"})
+    pools.append(WorkerPool(bus, sku_for_batchref=lambda ref: None, workers=2))
+    [pool] = pools
+
+    futures = [
+        redis_eventconsumer.submit(pool, {
+            "channel": b"change_batch_quantity",
+            "data": json.dumps({"batchref": "b1", "qty": 5}),
+        }),
+        redis_eventconsumer.submit(pool, {
+            "channel": b"allocate",
+            "data": json.dumps({"orderid": "o1", "sku": "RED-CHAIR", "qty": 3}),
+        }),
+    ]
+    failing = redis_eventconsumer.submit(pool, {
+        "channel": b"change_batch_quantity",
+        "data": json.dumps({"batchref": "b2", "qty": 5}),
+    })
+    for future in futures:
+        future.result(timeout=10)
+    with pytest.raises(ValueError):
+        failing.result(timeout=10)
+    assert redis_eventconsumer.submit(pool, {"channel": b"allocate", "data": b"{}"}) is None
+
+    assert sorted(bus.handled, key=str) == [
+        commands.Allocate("o1", "RED-CHAIR", 3), commands.ChangeBatchQuantity("b1", 5),
+    ]
+    assert metrics.REGISTRY.counter(
+        redis_eventconsumer.UNDECODABLE, (("channel", "allocate"),)
+    ) == 1
+    pool.close()  # so that every outcome has been counted
+    assert metrics.REGISTRY.counter(
+        redis_eventconsumer.PUBSUB_MESSAGES,
+        (("channel", "change_batch_quantity"), ("result", "error")),
+    ) == 1
+    assert metrics.REGISTRY.counter(
+        redis_eventconsumer.PUBSUB_MESSAGES, (("channel", "allocate"), ("result", "ok")),
+    ) == 1
@@ -0,0 +1,151 @@
+import json
+import threading
+import time
+
+from allocation import bootstrap
+from allocation.adapters.redis_eventpublisher import (
+    BufferedRedisEventPublisher, RedisEventPublisher,
+)
+from allocation.domain import commands, events
+from .test_handlers import FakeNotifications, FakeUnitOfWork
+
+
+class FakeRedis:
+    def __init__(self, fail=False):
+        self.pipelines = []
+        self.fail = fail
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def publish(self, channel, message):
+        self.commands.append((channel, json.loads(message)["orderid"]))
+
+    def execute(self):
+        if self.redis.fail:
+            raise ConnectionError("redis is down")
+        self.redis.pipelines.append(self.commands)
+
+
+def allocated(orderid):
+    return events.Allocated(orderid, "RED-CHAIR", 1, "b1")
+
+
+def test_the_bus_publishes_a_messages_events_in_one_pipeline_when_done():
+    redis = FakeRedis()
+    publisher = RedisEventPublisher(redis)
+    bus = bootstrap.bootstrap(
+        start_orm=False, uow=FakeUnitOfWork(), notifications=FakeNotifications(),
+        publish=publisher,
+    )
+    bus.handle(commands.CreateBatch("b1", "RED-CHAIR", 100, None))
+    bus.handle(commands.CreateBatch("b2", "RED-CHAIR", 100, None))
+    for i in range(5):
+        bus.handle(commands.Allocate(f"o{i}", "RED-CHAIR", 10))
+    assert len(redis.pipelines) == 5
+
+    # deallocates all five, and reallocates them to b2
+    bus.handle(commands.ChangeBatchQuantity("b1", 0))
+
+    assert sorted(redis.pipelines[-1]) == [("line_allocated", f"o{i}") for i in range(5)]
+    assert publisher.stats() == dict(published=10, flushes=6, errors=0)
+
+
+def test_each_thread_flushes_its_own_events():
+    redis = FakeRedis()
+    publisher = RedisEventPublisher(redis)
+    publisher("line_allocated", allocated("main"))
+
+    other = threading.Thread(target=lambda: (
+        publisher("line_allocated", allocated("other")), publisher.flush()
+    ))
+    other.start()
+    other.join()
+    assert redis.pipelines == [[("line_allocated", "other")]]
+
+    publisher.end_cycle()
+    assert redis.pipelines[-1] == [("line_allocated", "main")]
+
+
+def test_failed_flushes_are_counted_not_raised():
+    publisher = RedisEventPublisher(FakeRedis(fail=True))
+    publisher("line_allocated", allocated("o1"))
+    assert publisher.flush() == 0
+    assert publisher.stats() == dict(published=0, flushes=0, errors=1)
+
+
+def test_buffered_publisher_flushes_when_full():
+    redis = FakeRedis()
+    publisher = BufferedRedisEventPublisher(redis, max_events=3, max_delay=60)
+    for i in range(7):
+        publisher("line_allocated", allocated(f"o{i}"))
+        publisher.end_cycle()
+    assert [len(pipeline) for pipeline in redis.pipelines] == [3, 3]
+
+    publisher.close()
+    assert [len(pipeline) for pipeline in redis.pipelines] == [3, 3, 1]
+    assert publisher.stats()["buffered"] == 0
+
+
+def test_buffered_publisher_flushes_what_has_waited_long_enough():
+    redis = FakeRedis()
+    publisher = BufferedRedisEventPublisher(redis, max_events=100, max_delay=0.05)
+    try:
+        publisher("line_allocated", allocated("o1"))
+        publisher("line_allocated", allocated("o2"))
+        assert redis.pipelines == []
+
+        deadline = time.monotonic() + 5
+        while not redis.pipelines and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert redis.pipelines == [[("line_allocated", "o1"), ("line_allocated", "o2")]]
+    finally:
+        publisher.close()
+
+
+class HeldRedis(FakeRedis):
+    """Holds the first pipeline it's sent until let through"""
+
+    def __init__(self):
+        super().__init__()
+        self.sending = threading.Event()
+        self.go = threading.Event()
+
+    def pipeline(self, transaction=True):
+        pipeline = super().pipeline(transaction)
+        if not self.sending.is_set():
+            self.sending.set()
+            execute = pipeline.execute
+            pipeline.execute = lambda: (self.go.wait(), execute())
+        return pipeline
+
+
+def test_buffered_publisher_sends_full_buffers_in_the_order_they_filled():
+    redis = HeldRedis()
+    publisher = BufferedRedisEventPublisher(redis, max_events=2, max_delay=60)
+
+    def publish(*orderids):
+        for orderid in orderids:
+            publisher("line_allocated", allocated(orderid))
+
+    first = threading.Thread(target=publish, args=("o1", "o2"))
+    first.start()
+    assert redis.sending.wait(timeout=10)
+    second = threading.Thread(target=publish, args=("o3", "o4"))
+    second.start()
+    second.join(timeout=0.2)
+    redis.go.set()
+    first.join()
+    second.join()
+    publisher.close()
+
+    assert redis.pipelines == [
+        [("line_allocated", "o1"), ("line_allocated", "o2")],
+        [("line_allocated", "o3"), ("line_allocated", "o4")],
+    ]